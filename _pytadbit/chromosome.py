@@ -15,6 +15,8 @@ from pytadbit                          import tadbit
 from pytadbit.utils.extraviews         import tadbit_savefig
 from pytadbit.utils.extraviews         import _tad_density_plot
 from pytadbit.experiment               import Experiment
+from pytadbit.parsers.hic_binary_parser import is_hic_binary
+from pytadbit.parsers.hic_binary_parser import read_hic_binary_header
 from pytadbit.alignment                import Alignment, randomization_test
 
 try:
@@ -439,7 +441,8 @@ class Chromosome(object):
         :param resolution: resolution of the experiment (needed if name is not
            an Experiment object)
         :param None hic_data: whether a file or a list of lists corresponding to
-           the Hi-C data
+           the Hi-C data. In the case of a TADbit binary matrix, only the
+           chromosome with the name of this Chromosome is loaded (if found)
         :param None tad_def: a file or a dict with precomputed TADs for this
            experiment
         :param False replace: overwrite the experiments loaded under the same
@@ -473,6 +476,11 @@ class Chromosome(object):
                     This experiment will be kept under %s.\n''' % (name,
                                                                    name + '_'))
                 name += '_'
+        if (isinstance(hic_data, str) and is_hic_binary(hic_data) and
+            not 'focus' in kwargs):
+            level = read_hic_binary_header(hic_data)['levels'][0]
+            if self.name in dict(level['chromosomes'] or []):
+                kwargs['focus'] = self.name
         if isinstance(name, Experiment):
             self.experiments.append(name)
         elif resolution:
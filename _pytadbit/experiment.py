@@ -6,15 +6,19 @@
 
 from math                         import isnan
 from numpy                        import log2, array
+import numpy as np
 from pytadbit.modelling.IMP_CONFIG import CONFIG
 from copy                         import deepcopy as copy
 from sys                          import stderr
 from warnings                     import warn
-from pytadbit                     import HiC_data
+from pytadbit                     import HiC_data, SparseHiC_data
 from pytadbit.parsers.hic_parser  import read_matrix
+from pytadbit.parsers.hic_binary_parser import load_hic_binary, is_hic_binary
+from pytadbit.parsers.hic_binary_parser import read_hic_binary_header
 from pytadbit.utils.extraviews    import nicer
 from pytadbit.utils.extraviews    import tadbit_savefig
-from pytadbit.utils.tadmaths      import zscore, nozero_log_matrix
+from pytadbit.utils.tadmaths      import zscore_array, zscores_to_dict
+from pytadbit.utils.tadmaths      import nozero_log_matrix
 from pytadbit.utils.normalize_hic import iterative
 from pytadbit.utils.hic_filtering import hic_filtering_for_modelling
 from pytadbit.parsers.tad_parser  import parse_tads
@@ -108,7 +112,11 @@ class Experiment(object):
     :param Hi-C exp_type: name of the experiment used (currently only Hi-C is
        supported)
     :param None hic_data: whether a file or a list of lists corresponding to
-       the Hi-C data
+       the Hi-C data. The file can also be a TADbit binary matrix (see
+       :func:`pytadbit.parsers.hic_binary_parser.build_hic_pyramid`), in which
+       case changing the resolution loads the corresponding level of the file
+    :param None focus: in case hic_data is a TADbit binary matrix, chromosome
+       or genomic region to be loaded
     :param None tad_def: a file or a dict with precomputed TADs for this
        experiment
     :param None parser: a parser function that returns a tuple of lists
@@ -160,7 +168,8 @@ class Experiment(object):
     def __init__(self, name, resolution, hic_data=None, norm_data=None,
                  tad_def=None, parser=None, no_warn=False, weights=None,
                  conditions=None, identifier=None,
-                 cell_type=None, enzyme=None, exp_type='Hi-C', **kw_descr):
+                 cell_type=None, enzyme=None, exp_type='Hi-C', focus=None,
+                 **kw_descr):
         self.name            = name
         self.resolution      = resolution
         self.identifier      = identifier
@@ -183,8 +192,10 @@ class Experiment(object):
         self._filtered_cols  = False
         self._zeros          = {}
         self._zscores        = {}
+        self._pyramid        = None
+        self._resolutions    = {}
         if hic_data:
-            self.load_hic_data(hic_data, parser, **kw_descr)
+            self.load_hic_data(hic_data, parser, focus=focus, **kw_descr)
         if norm_data:
             self.load_norm_data(norm_data, parser, **kw_descr)
         if tad_def:
@@ -323,6 +334,8 @@ class Experiment(object):
         Experiment._ori_hic and replace the Experiment.hic_data
         with the data corresponding to new data
         (:func:`pytadbit.Chromosome.compare_condition`).
+        Each resolution computed is kept, so that switching back to it is
+        immediate.
 
         :param resolution: an integer representing the resolution. This number
            must be a multiple of the original resolution, and higher than it
@@ -336,6 +349,11 @@ class Experiment(object):
                             '  otherwise it is too complicated for me :P')
         if resolution == self.resolution:
             return
+        # keep the current resolution, to switch back to it without
+        # recomputing it
+        if self.resolution != self._ori_resolution:
+            self._resolutions[self.resolution] = (self.hic_data, self.norm,
+                                                  self.size)
         # if we want to go back to original resolution
         if resolution == self._ori_resolution:
             self.hic_data   = self._ori_hic
@@ -346,7 +364,7 @@ class Experiment(object):
         # if current resolution is the original one
         if self.resolution == self._ori_resolution:
             if self.hic_data:
-                self._ori_hic  = copy(self.hic_data)
+                self._ori_hic  = self.hic_data[:]
             if self.norm:
                 self._ori_norm = self.norm[:]
                 # change the factor value in normalization description
@@ -359,40 +377,10 @@ class Experiment(object):
                 except IndexError: # no factor there
                     pass
         self.resolution = resolution
-        fact = self.resolution / self._ori_resolution
-        # super for!
-        try:
-            size = len(self._ori_hic[0])
-        except TypeError:
-            size = len(self._ori_norm[0])
-        self.size     = size / fact
-        rest = size % fact
-        if rest:
-            self.size += 1
-        self.hic_data = [HiC_data([], size / fact + (1 if rest else 0))]
-        self.norm     = [HiC_data([], size / fact + (1 if rest else 0))]
-        def resize(mtrx, copee):
-            "resize both hic_data and normalized data"
-            for i in xrange(0, size, fact):
-                for j in xrange(0, size, fact):
-                    val = 0
-                    for k in xrange(fact):
-                        if i + k >= size:
-                            break
-                        for l in  xrange(fact):
-                            if j + l >= size:
-                                break
-                            val += copee[(i + k) * size + j + l]
-                    if val:
-                        mtrx[i/fact * self.size + j/fact] = val
-        try:
-            resize(self.hic_data[0], self._ori_hic[0])
-        except TypeError:
-            pass
-        try:
-            resize(self.norm[0], self._ori_norm[0])
-        except TypeError:
-            pass
+        if resolution in self._resolutions:
+            self.hic_data, self.norm, self.size = self._resolutions[resolution]
+        else:
+            self._coarsen_data()
         # we need to recalculate zeros:
         if self._filtered_cols:
             stderr.write('WARNING: definition of filtered columns lost at ' +
@@ -403,6 +391,35 @@ class Experiment(object):
             del(self._ori_norm)
 
 
+    def _coarsen_data(self):
+        """
+        Computes hic_data and norm at the current resolution, from the
+        original ones (or from the binary file of the Hi-C data if this
+        resolution is stored in it).
+        """
+        fact = self.resolution / self._ori_resolution
+        try:
+            size = len(self._ori_hic[0])
+        except TypeError:
+            size = len(self._ori_norm[0])
+        self.size     = (size - 1) / fact + 1
+        self.hic_data = [HiC_data([], self.size)]
+        self.norm     = [HiC_data([], self.size)]
+        # this resolution may be stored in the binary file of the Hi-C data
+        pyramid = None
+        if self._pyramid:
+            fnam, focus = self._pyramid
+            if self.resolution in [l['resolution'] for l in
+                                   read_hic_binary_header(fnam)['levels']]:
+                pyramid = load_hic_binary(fnam, focus=focus,
+                                          resolution=self.resolution)
+        if pyramid is not None:
+            self.hic_data = [pyramid]
+        elif self._ori_hic:
+            self.hic_data = [_coarsen(self._ori_hic[0], size, fact)]
+        if self._ori_norm:
+            self.norm = [_coarsen(self._ori_norm[0], size, fact)]
+
     def filter_columns(self, silent=False, draw_hist=False, savefig=None,
                        diagonal=True, perc_zero=90, auto=True, min_count=None):
         """
@@ -451,7 +468,8 @@ class Experiment(object):
 
 
     def load_hic_data(self, hic_data, parser=None, wanted_resolution=None,
-                      data_resolution=None, silent=False, **kwargs):
+                      data_resolution=None, silent=False, focus=None,
+                      **kwargs):
         """
         Add a Hi-C experiment to the Chromosome object.
 
@@ -482,9 +500,24 @@ class Experiment(object):
         :param True filter_columns: filter the columns with unexpectedly high
            content of low values
         :param False silent: does not warn for removed columns
+        :param None focus: in case hic_data is a TADbit binary matrix,
+           chromosome or genomic region to be loaded
 
         """
+        if isinstance(hic_data, str) and is_hic_binary(hic_data):
+            # load the level of the pyramid at the wanted resolution, or the
+            # finest one
+            self._pyramid = hic_data, focus
+            levels = [l['resolution'] for l in
+                      read_hic_binary_header(hic_data)['levels']]
+            wanted_resolution = wanted_resolution or self._ori_resolution
+            if not data_resolution:
+                data_resolution = (wanted_resolution
+                                   if wanted_resolution in levels else levels[0])
+            hic_data = load_hic_binary(hic_data, focus=focus,
+                                       resolution=data_resolution)
         self.hic_data = read_matrix(hic_data, parser=parser, one=False)
+        self._resolutions    = {}
         self._ori_size       = self.size       = len(self.hic_data[0])
         self._ori_resolution = self.resolution = (data_resolution or
                                                   self._ori_resolution)
@@ -526,6 +559,7 @@ class Experiment(object):
 
         """
         self.norm = read_matrix(norm_data, parser=parser, hic=False, one=False)
+        self._resolutions    = {}
         self._ori_size       = self.size       = len(self.norm[0])
         self._ori_resolution = self.resolution = resolution or self._ori_resolution
         if not self._zeros: # in case we do not have original Hi-C data
@@ -637,6 +671,7 @@ class Experiment(object):
             raise Exception('ERROR: No Hi-C data loaded\n')
         if self.norm and not silent:
             stderr.write('WARNING: removing previous weights\n')
+        self._resolutions = {}
         size = self.size
         self.bias = iterative(self.hic_data[0], iterations=iterations,
                               max_dev=max_dev, bads=self._zeros,
@@ -667,43 +702,53 @@ class Experiment(object):
            interaction are informative.
 
         """
-        values = {}
-        zeros  = {}
-        self._zscores = {}
-        if normalized:
-            for i in xrange(self.size):
-                # zeros are rows or columns having a zero in the diagonal
-                if i in self._zeros:
-                    continue
-                for j in xrange(i + 1, self.size):
-                    if j in self._zeros:
-                        continue
-                    if (not self.norm[0][i * self.size + j]
-                        and remove_zeros):
-                        zeros[(i, j)] = None
-                        continue
-                    values[(i, j)] = self.norm[0][i * self.size + j]
-        else:
-            for i in xrange(self.size):
-                if i in self._zeros:
-                    continue
-                for j in xrange(i + 1, self.size):
-                    if j in self._zeros:
-                        continue
-                    values[(i, j)] = self.hic_data[0][i * self.size + j]
-        # compute Z-score
+        rows, cols, values = self._zscore_arrays(
+            normalized=normalized, zscored=zscored, remove_zeros=remove_zeros)
+        self._zscores = zscores_to_dict(rows, cols, values)
+
+    def _zscore_arrays(self, start=0, end=None, normalized=True, zscored=True,
+                       remove_zeros=True):
+        """
+        Computes the Z-scores of the interactions (upper triangle, diagonal
+        excluded) of a region of the Hi-C matrix, in coordinate format.
+        Filtered columns are skipped.
+
+        :param 0 start: first bin of the region
+        :param None end: last bin of the region (not included), by default the
+           last bin of the matrix
+        :param True normalized: whether to use the normalized data
+        :param True zscored: calculate the z-score of the data
+        :param True remove_zeros: remove null interactions (only with
+           normalized data)
+
+        :returns: rows, columns (relative to start) and Z-scores, as NumPy
+           arrays sorted by row and column
+        """
+        end = end or self.size
+        matrix = self._get_array(start, end, normalized=normalized)
+        # zeros are rows or columns having a zero in the diagonal
+        good = np.ones(end - start, dtype=bool)
+        good[[z - start for z in self._zeros if start <= z < end]] = False
+        keep = np.triu(good[:, None] & good[None, :], 1)
+        if normalized and remove_zeros:
+            keep &= matrix != 0
+        rows, cols = np.nonzero(keep)
+        values = matrix[rows, cols].astype(float)
         if zscored:
-            zscore(values)
-        for i in xrange(self.size):
-            if i in self._zeros:
-                continue
-            for j in xrange(i + 1, self.size):
-                if j in self._zeros:
-                    continue
-                if (i, j) in zeros and remove_zeros:
-                    continue
-                self._zscores.setdefault(str(i), {})
-                self._zscores[str(i)][str(j)] = values[(i, j)]
+            values = zscore_array(values)
+        return rows, cols, values
+
+    def _get_array(self, start, end, normalized=True):
+        """
+        :returns: the (normalized) Hi-C data between bins start and end (not
+           included) as a NumPy array
+        """
+        hic = self.norm[0] if normalized else self.hic_data[0]
+        try:
+            return hic.get_array(focus=(start + 1, end))
+        except AttributeError: # weights given as a list
+            return np.asarray(hic, dtype=float).reshape(
+                self.size, self.size)[start:end, start:end]
 
 
     def model_region(self, start=1, end=None, n_models=5000, n_keep=1000,
@@ -784,7 +829,8 @@ class Experiment(object):
                          'Experiment.normalize_hic()\n')
         if not end:
             end = self.size
-        zscores, values, zeros = self._sub_experiment_zscore(start, end)
+        zscores, values, zeros = self._sub_experiment_zscore(start, end,
+                                                             as_dict=False)
         coords = {'crm'  : self.crm.name,
                   'start': start,
                   'end'  : end}
@@ -890,66 +936,43 @@ class Experiment(object):
         return optimizer
 
 
-    def _sub_experiment_zscore(self, start, end):
+    def _sub_experiment_zscore(self, start, end, as_dict=True):
         """
         Get the z-score of a sub-region of an  experiment.
 
-        TODO: find a nicer way to do this...
-
         :param start: first bin to model (bin number)
         :param end: first bin to model (bin number)
+        :param True as_dict: returns z-scores as a dictionary of dictionaries,
+           otherwise as a tuple of rows, columns and values arrays (see
+           :func:`pytadbit.modelling.imp_modelling.generate_3d_models`)
 
         :returns: z-score, raw values and zzeros of the experiment
         """
         if not self._normalization.startswith('visibility'):
             stderr.write('WARNING: normalizing according to visibility method\n')
             self.normalize_hic()
-        from pytadbit import Chromosome
         if start < 1:
             raise ValueError('ERROR: start should be higher than 0\n')
         start -= 1 # things starts at 0 for python. we keep the end coordinate
                    # at its original value because it is inclusive
-        siz = self.size
-        try:
-            matrix = self.get_hic_matrix()
-            new_matrix = [[matrix[i][j] for i in xrange(start, end)]
-                          for j in xrange(start, end)]
-            tmp = Chromosome('tmp')
-            tmp.add_experiment('exp1', hic_data=[new_matrix],
-                               resolution=self.resolution, filter_columns=False)
-            exp = tmp.experiments[0]
-            # We want the weights and zeros calculated in the full chromosome
-            exp.norm = [[self.norm[0][i + siz * j] for i in xrange(start, end)
-                         for j in xrange(start, end)]]
-        except TypeError: # no Hi-C data provided
-            matrix = self.get_hic_matrix(normalized=True)
-            new_matrix = [[matrix[i][j] for i in xrange(start, end)]
-                           for j in xrange(start, end)]
-            tmp = Chromosome('tmp')
-            tmp.add_experiment('exp1', norm_data=[new_matrix],
-                               resolution=self.resolution, filter_columns=False)
-            exp = tmp.experiments[0]
-        exp._zeros = dict([(z - start, None) for z in self._zeros
-                           if start <= z <= end - 1])
-        if len(exp._zeros) == (end - start):
+        zeros = dict([(z - start, None) for z in self._zeros
+                      if start <= z <= end - 1])
+        if len(zeros) == (end - start):
             raise Exception('ERROR: no interaction found in selected regions')
-        # ... but the z-scores in this particular region
-        exp.get_hic_zscores()
-        values = [[float('nan') for _ in xrange(exp.size)]
-                  for _ in xrange(exp.size)]
-        for i in xrange(exp.size):
-            # zeros are rows or columns having a zero in the diagonal
-            if i in exp._zeros:
-                continue
-            for j in xrange(i + 1, exp.size):
-                if j in exp._zeros:
-                    continue
-                if (not exp.norm[0][i * exp.size + j]
-                    or not exp.norm[0][i * exp.size + j]):
-                    continue
-                values[i][j] = exp.norm[0][i * exp.size + j]
-                values[j][i] = exp.norm[0][i * exp.size + j]
-        return exp._zscores, values, exp._zeros
+        # the z-scores are computed in this particular region, with the
+        # weights calculated in the full chromosome
+        rows, cols, zscores = self._zscore_arrays(start, end)
+        if not as_dict:
+            zscores = rows, cols, zscores
+        else:
+            zscores = zscores_to_dict(rows, cols, zscores)
+        matrix = self._get_array(start, end).astype(float)
+        good = np.ones(end - start, dtype=bool)
+        good[zeros.keys()] = False
+        keep = good[:, None] & good[None, :] & (matrix != 0)
+        keep[np.diag_indices_from(keep)] = False
+        values = np.where(keep, matrix, float('nan')).tolist()
+        return zscores, values, zeros
 
 
     def write_interaction_pairs(self, fname, normalized=True, zscored=True,
@@ -1465,3 +1488,37 @@ class Experiment(object):
     #     for i in self.size:
     #         dens[i] = self.resolution
     #     return dens
+
+
+def _coarsen(mtrx, size, fact):
+    """
+    Sums the cells of a matrix by squares of fact x fact bins (the last row and
+    column of squares may be smaller).
+
+    :param mtrx: HiC_data object
+    :param size: number of rows (and columns) of mtrx
+    :param fact: number of bins merged in each new bin
+
+    :returns: a HiC_data object with the coarser matrix
+    """
+    new_size = (size - 1) / fact + 1
+    if isinstance(mtrx, SparseHiC_data):
+        rows, cols, vals = mtrx.get_upper_triangle()
+        lower = rows != cols
+        rows, cols = (np.concatenate((rows, cols[lower])),
+                      np.concatenate((cols, rows[lower])))
+        vals = np.concatenate((vals, vals[lower]))
+    else:
+        rows, cols = np.divmod(np.fromiter(mtrx.iterkeys(), dtype=np.int64),
+                               size)
+        vals = np.fromiter(mtrx.itervalues(), dtype=float)
+    # new bin of each cell, and sum of the cells falling in the same one
+    keys, inverse = np.unique(rows / fact * new_size + cols / fact,
+                              return_inverse=True)
+    vals = np.bincount(inverse, weights=vals, minlength=len(keys))
+    # keep interaction counts as integers
+    if isinstance(next(mtrx.itervalues(), 0.), (int, long, np.integer)):
+        vals = vals.round().astype(np.int64)
+    nonzero = vals != 0
+    return HiC_data(zip(keys[nonzero].tolist(), vals[nonzero].tolist()),
+                    new_size)
@@ -7,12 +7,13 @@ from pytadbit.utils.extraviews      import plot_compartments
 from pytadbit.utils.extraviews      import plot_compartments_summary
 from pytadbit.utils.hic_filtering   import filter_by_mean, filter_by_zero_count
 from pytadbit.utils.normalize_hic   import iterative, expected
+from pytadbit.utils.normalize_hic   import iterative_out_of_core
 from pytadbit.parsers.genome_parser import parse_fasta
 from pytadbit.parsers.bed_parser    import parse_bed
-from pytadbit.utils.file_handling   import mkdir
+from pytadbit.utils.file_handling   import mkdir, magic_write, BgzfWriter
 from pytadbit.utils.hmm             import gaussian_prob, best_path, train
 from numpy.linalg                   import LinAlgError
-from numpy                          import corrcoef, nansum, array, isnan, mean
+from numpy                          import corrcoef, nansum, isnan, mean
 from numpy                          import meshgrid, asarray, exp, linspace, std
 from numpy                          import nanpercentile as npperc, log as nplog
 from numpy                          import nanmax
@@ -25,8 +26,16 @@ from collections                    import OrderedDict
 from warnings                       import warn
 from bisect                         import bisect_right as bisect
 from scipy.sparse                   import csr_matrix
+from copy_reg                       import __newobj__
+from array                          import array as py_array
+from tempfile                       import mkstemp
+import multiprocessing as mu
+import numpy as np
 import os
 
+# Hi-C data shared with the processes forked by _iter_correlation_matrices
+_SHARED_HIC_DATA = None
+
 class HiC_data(dict):
     """
     This may also hold the print/write-to-file matrix functions
@@ -36,6 +45,7 @@ class HiC_data(dict):
         super(HiC_data, self).__init__(items)
         self.__size = size
         self._size2 = size**2
+        self._expected_cache = {}
         self.bias = None
         self.bads = masked or {}
         self.chromosomes = chromosomes
@@ -55,9 +65,27 @@ class HiC_data(dict):
             self.sections = dict([((None, i), i)
                                   for i in xrange(0, self.__size)])
 
+    @property
+    def bias(self):
+        # objects pickled by previous versions store it as bias
+        return self.__dict__.get('_bias', self.__dict__.get('bias'))
+
+    @bias.setter
+    def bias(self, bias):
+        """
+        expected values computed from normalized interactions depend on the
+        biases
+        """
+        self._bias = bias
+        self._clear_expected()
+
     def _update_size(self, size):
-        self.__size +=  size
-        self._size2 = self.__size**2
+        self._set_size(self.__size + size)
+
+    def _set_size(self, size):
+        self.__size = size
+        self._size2 = size**2
+        self._clear_expected()
 
     def __len__(self):
         return self.__size
@@ -99,6 +127,13 @@ class HiC_data(dict):
                     'ERROR: position %d larger than %s^2' % (row_col,
                                                              self.__size))
             super(HiC_data, self).__setitem__(row_col, val)
+        if self._expected_cache:
+            self._clear_expected()
+
+    def __reduce__(self):
+        # cells are restored once the size of the matrix is known
+        return _rebuild_hic_data, (self.__class__, self.__dict__,
+                                   dict.copy(self))
 
     def get_hic_data_as_csr(self):
         """
@@ -117,6 +152,197 @@ class HiC_data(dict):
 
         return csr_matrix((values, (rows, cols)), shape=(self.__size,self.__size))
 
+    def get_upper_triangle(self):
+        """
+        Returns the upper triangle of the Hi-C matrix (diagonal included) in
+        coordinate format.
+
+        :returns: three numpy arrays with rows, columns and values of the
+           non-zero cells, sorted by row and column
+        """
+        N = self.__size
+        keys = np.fromiter(self.iterkeys(), dtype=np.int64)
+        vals = np.fromiter(self.itervalues(), dtype=float)
+        vals = self._as_counts(vals)
+        rows, cols = np.divmod(keys, N)
+        upper = (rows <= cols) & (vals != 0)
+        keys = keys[upper]
+        order = keys.argsort()
+        return rows[upper][order], cols[upper][order], vals[upper][order]
+
+    def iter_upper_triangle(self, chunk=1000000):
+        """
+        Iterates over the upper triangle of the Hi-C matrix (diagonal
+        included), chunk by chunk, without copying the whole matrix.
+
+        :param 1000000 chunk: number of cells in each chunk
+
+        :yields: three numpy arrays with rows, columns and values of the
+           non-zero cells of each chunk
+        """
+        N = self.__size
+        keys = py_array('l')
+        vals = py_array('d')
+        for key, val in self.iteritems():
+            if key / N <= key % N and val:
+                keys.append(key)
+                vals.append(val)
+            if len(keys) >= chunk:
+                rows, cols = np.divmod(np.frombuffer(keys, dtype=np.int_), N)
+                yield rows, cols, np.frombuffer(vals, dtype=float)
+                keys = py_array('l')
+                vals = py_array('d')
+        if keys:
+            rows, cols = np.divmod(np.frombuffer(keys, dtype=np.int_), N)
+            yield rows, cols, np.frombuffer(vals, dtype=float)
+
+    def _get_block(self, start1, end1, start2, end2):
+        """
+        Non-zero cells of the rectangle defined by rows start1 to end1 and
+        columns start2 to end2.
+
+        :returns: rows, columns (relative to the rectangle) and values
+        """
+        N = self.__size
+        # small rectangle, faster to get cell by cell
+        if (end1 - start1) * (end2 - start2) < dict.__len__(self):
+            rows, cols = np.indices((end1 - start1, end2 - start2))
+            keys = (rows + start1) * N + cols + start2
+            vals = self._as_counts(np.fromiter(
+                (self.get(k, 0) for k in keys.ravel().tolist()), dtype=float,
+                count=keys.size)).reshape(keys.shape)
+            nonzero = vals != 0
+            return rows[nonzero], cols[nonzero], vals[nonzero]
+        if self.symmetricized:
+            # lower triangle mirrored from the upper one
+            rows, cols, vals = self.get_upper_triangle()
+            lower = rows != cols
+            rows, cols = (np.concatenate((rows, cols[lower])),
+                          np.concatenate((cols, rows[lower])))
+            vals = np.concatenate((vals, vals[lower]))
+        else:
+            keys = np.fromiter(self.iterkeys(), dtype=np.int64)
+            vals = self._as_counts(np.fromiter(self.itervalues(), dtype=float))
+            rows, cols = np.divmod(keys, N)
+        keep = ((rows >= start1) & (rows < end1) & (cols >= start2) &
+                (cols < end2) & (vals != 0))
+        return rows[keep] - start1, cols[keep] - start2, vals[keep]
+
+    def get_expected(self, signal_to_noise=0.05, inter_chrom=False,
+                     normalized=False):
+        """
+        Expected interactions at each distance from the diagonal (see
+        :func:`pytadbit.utils.normalize_hic.expected`). Values are computed
+        once for each set of parameters (and of filtered columns), until
+        the interactions, the sections or the biases of the matrix change.
+
+        :param 0.05 signal_to_noise: to calculate expected interaction counts,
+           if not enough reads are observed at a given distance the
+           observations of the distance+1 are summed
+        :param False inter_chrom: compute distances over the whole matrix,
+           instead of within chromosomes
+        :param False normalized: average normalized interactions
+
+        :returns: a dictionary with the expected value at each distance
+        """
+        # objects pickled by previous versions have no cache
+        cache = self.__dict__.setdefault('_expected_cache', {})
+        key = self._expected_key(signal_to_noise, inter_chrom, normalized)
+        try:
+            return cache[key]
+        except KeyError:
+            pass
+        cache[key] = expected(self, bads=self.bads,
+                              signal_to_noise=signal_to_noise,
+                              inter_chrom=inter_chrom, normalized=normalized)
+        return cache[key]
+
+    def _expected_key(self, signal_to_noise=0.05, inter_chrom=False,
+                      normalized=False):
+        return (normalized, self.resolution, signal_to_noise, inter_chrom,
+                tuple(sorted(self.bads)))
+
+    def _clear_expected(self):
+        """
+        drops the expected values computed with get_expected
+        """
+        if self.__dict__.get('_expected_cache'):
+            self._expected_cache.clear()
+
+    def _as_counts(self, vals):
+        """
+        converts values to integers if stored as such (interaction counts)
+        """
+        if (isinstance(next(self.itervalues(), 0), (int, long)) and
+            not np.any(np.mod(vals, 1))):
+            return vals.astype(np.int64)
+        return vals
+
+    def _bias_array(self, start, end):
+        return np.array([self.bias[i] for i in xrange(start, end)], dtype=float)
+
+    def to_sparse(self, dtype=None):
+        """
+        Returns a memory efficient copy of the Hi-C data, the matrix being
+        stored in NumPy arrays (see :class:`SparseHiC_data`).
+
+        :param None dtype: type of the stored values (numpy.int32 or
+           numpy.float32), by default guessed from the values
+
+        :returns: a SparseHiC_data object
+        """
+        hic = SparseHiC_data(self.iteritems(), self.__size,
+                             chromosomes=self.chromosomes,
+                             dict_sec=self.sections,
+                             resolution=self.resolution,
+                             masked=dict(self.bads),
+                             symmetricized=self.symmetricized, dtype=dtype)
+        hic.section_pos  = dict(self.section_pos)
+        hic.bias         = self.bias
+        hic.expected     = self.expected
+        hic.compartments = self.compartments
+        return hic
+
+    def rebin(self, resolution):
+        """
+        Sums adjacent bins, inside each chromosome, to get the interaction
+        matrix at a lower resolution. Biases and filtered columns are not kept.
+
+        :param resolution: new resolution, should be a multiple of the current
+           one
+
+        :returns: a SparseHiC_data object
+        """
+        if resolution % self.resolution:
+            raise Exception('ERROR: new resolution should be a multiple of '
+                            'the original one (%s)' % self.resolution)
+        fact = resolution / self.resolution
+        if self.chromosomes:
+            nbins = [self.chromosomes[crm] for crm in self.chromosomes]
+        else:
+            nbins = [self.__size]
+        # new bin of each original bin, chromosome by chromosome
+        new_nbins = [(n - 1) / fact + 1 for n in nbins]
+        offsets = np.cumsum([0] + new_nbins)
+        new_bins = np.concatenate([np.arange(n, dtype=np.int64) / fact + off
+                                   for n, off in zip(nbins, offsets)])
+        rows, cols, vals = self.get_upper_triangle()
+        new_rows, new_cols = new_bins[rows], new_bins[cols]
+        # cells from both halves of the matrix fall in the new diagonal
+        vals = np.where((new_rows == new_cols) & (rows != cols), 2 * vals, vals)
+        size = int(offsets[-1])
+        chromosomes = None
+        dict_sec = {}
+        if self.chromosomes:
+            chromosomes = OrderedDict(zip(self.chromosomes, new_nbins))
+            for crm, off in zip(chromosomes, offsets):
+                dict_sec.update(((crm, i), int(off) + i)
+                                for i in xrange(chromosomes[crm]))
+        return SparseHiC_data((), size, chromosomes=chromosomes,
+                              dict_sec=dict_sec, resolution=resolution,
+                              symmetricized=self.symmetricized,
+                              coo=(new_rows, new_cols, vals))
+
     def add_sections_from_fasta(self, fasta):
         """
         Add genomic coordinate to HiC_data object by getting them from a FASTA
@@ -147,8 +373,7 @@ class HiC_data(dict):
         if size != self.__size:
             warn('WARNING: different sizes (%d, now:%d), ' % (self.__size, size)
                  + 'should adjust the resolution')
-        self.__size = size
-        self._size2 = size**2
+        self._set_size(size)
 
     def add_sections(self, lengths, chr_names=None, binned=False):
         """
@@ -183,8 +408,7 @@ class HiC_data(dict):
         if size != self.__size:
             warn('WARNING: different sizes (%d, now:%d), ' % (self.__size, size)
                  + 'should adjust the resolution')
-        self.__size = size
-        self._size2 = size**2
+        self._set_size(size)
 
     def cis_trans_ratio(self, normalized=False, exclude=None, diagonal=True,
                         equals=None):
@@ -313,7 +537,8 @@ class HiC_data(dict):
                 norm_sum += v
         return norm_sum
 
-    def normalize_hic(self, iterations=0, max_dev=0.1, silent=False, factor=1):
+    def normalize_hic(self, iterations=0, max_dev=0.1, silent=False, factor=1,
+                      memory=None, source=None, tmp_dir=None):
         """
         Normalize the Hi-C data.
 
@@ -326,16 +551,52 @@ class HiC_data(dict):
         :param False silent: does not warn when overwriting weights
         :param 1 factor: final mean number of normalized interactions wanted
            per cell (excludes filtered, or bad, out columns)
+        :param None memory: maximum memory (in Mb) to be used by the
+           normalization. If set, the interactions are read chunk by chunk at
+           each iteration (see
+           :func:`pytadbit.utils.normalize_hic.iterative_out_of_core`)
+        :param None source: path to a file with the interactions to be read,
+           chunk by chunk, instead of this object: either a file with reads1
+           and reads2 (binned at the resolution of this object), or a TADbit
+           binary matrix
+        :param None tmp_dir: directory where to write the interactions binned
+           from a file of reads given as source (system temporary directory by
+           default)
         """
-        bias = iterative(self, iterations=iterations,
-                         max_dev=max_dev, bads=self.bads,
-                         verbose=not silent)
+        if memory or source:
+            chunk = 10000000
+            if memory:
+                # about 80 bytes per cell, plus vectors of the size of the
+                # matrix
+                chunk = max(100000,
+                            int((memory * 2**20 - 64 * len(self)) / 80))
+            tmp = None
+            try:
+                chunks, tmp = self._interaction_chunks(chunk, source, silent,
+                                                       tmp_dir=tmp_dir)
+                bias = iterative_out_of_core(chunks, len(self), bads=self.bads,
+                                             iterations=iterations,
+                                             max_dev=max_dev,
+                                             verbose=not silent)
+                if factor:
+                    if not silent:
+                        print 'rescaling to factor %d' % factor
+                        print '  - getting the sum of the matrix'
+                    norm_sum = _sum_chunks(chunks(), len(self), bias, self.bads)
+            finally:
+                if tmp:
+                    os.remove(tmp)
+        else:
+            bias = iterative(self, iterations=iterations,
+                             max_dev=max_dev, bads=self.bads,
+                             verbose=not silent)
+            if factor:
+                if not silent:
+                    print 'rescaling to factor %d' % factor
+                    print '  - getting the sum of the matrix'
+                # get the sum on half of the matrix
+                norm_sum = self.sum(bias)
         if factor:
-            if not silent:
-                print 'rescaling to factor %d' % factor
-                print '  - getting the sum of the matrix'
-            # get the sum on half of the matrix
-            norm_sum = self.sum(bias)
             if not silent:
                 print '    => %.3f' % norm_sum
                 print '  - rescaling biases'
@@ -344,6 +605,43 @@ class HiC_data(dict):
             bias = dict([(b, bias[b] * target) for b in bias])
         self.bias = bias
 
+    def _interaction_chunks(self, chunk, source=None, silent=True,
+                            tmp_dir=None):
+        """
+        :param None tmp_dir: directory of the temporary file with the
+           interactions binned from source, if it is a file of reads
+
+        :returns: a function returning an iterator over chunks of the upper
+           triangle of the matrix, read from this object or from source, and
+           the path to a temporary file to be removed once done
+        """
+        # here to avoid circular imports
+        from pytadbit.parsers.hic_binary_parser import is_hic_binary
+        from pytadbit.parsers.hic_binary_parser import iter_hic_binary
+        from pytadbit.parsers.hic_binary_parser import write_contact_store
+        from pytadbit.parsers.hic_binary_parser import iter_contact_store
+        if source is None:
+            return lambda: self.iter_upper_triangle(chunk), None
+        if is_hic_binary(source):
+            return lambda: iter_hic_binary(source, resolution=self.resolution,
+                                           chunk=chunk), None
+        if not silent:
+            print '  - binning reads from %s' % source
+        fhandler, tmp = mkstemp(prefix='tadbit_contacts_', dir=tmp_dir)
+        os.close(fhandler)
+        try:
+            size = write_contact_store(source, self.resolution, tmp,
+                                       chunk=chunk)
+        except:
+            os.remove(tmp)
+            raise
+        if size != len(self):
+            os.remove(tmp)
+            raise Exception('ERROR: reads in %s do not correspond to this '
+                            'matrix (%d bins instead of %d)' % (
+                                source, size, len(self)))
+        return lambda: iter_contact_store(tmp, size, chunk=chunk), tmp
+
     def get_as_tuple(self):
         return tuple([self[i, j]
                       for j in xrange(len(self))
@@ -351,9 +649,10 @@ class HiC_data(dict):
 
 
     def write_coord_table(self, fname, focus=None, diagonal=True,
-                          normalized=False, format='BED'):
+                          normalized=False, format='BED', compress=False):
         """
-        writes a coordinate table to a file.
+        writes a coordinate table to a file (upper triangle of the matrix,
+        diagonal excluded).
 
         :param None focus: a tuple with the (start, end) position of the desired
            window of data (start, starting at 1, and both start and end are
@@ -368,84 +667,49 @@ class HiC_data(dict):
            or "long-range" format:
                chr1:111-222   \t   chr2:333-444   \t   55
                chr2:333-444   \t   chr1:111-222   \t   55
+        :param False compress: gzip the output file (BGZF blocks compressed
+           in parallel, that can be read back in parallel with magic_open).
+           File names ending with '.gz' are always compressed
         """
-        if focus:
-            if isinstance(focus, tuple) and isinstance(focus[0], int):
-                if len(focus) == 2:
-                    start1, end1 = focus
-                    start2, end2 = focus
-                    start1 -= 1
-                    start2 -= 1
-                else:
-                    start1, end1, start2, end2 = focus
-                    start1 -= 1
-                    start2 -= 1
-            elif isinstance(focus, tuple) and isinstance(focus[0], str):
-                start1, end1 = self.section_pos[focus[0]]
-                start2, end2 = self.section_pos[focus[1]]
-            else:
-                start1, end1 = self.section_pos[focus]
-                start2, end2 = self.section_pos[focus]
-        else:
-            start1 = start2 = 0
-            end1   = end2   = len(self)
-        out = open(fname, 'w')
+        if not format in ['long-range', 'BED']:
+            raise Exception('ERROR: format "%s" not found\n' % format)
+        _, start2, _, end2 = self._focus_coords(focus)
+        coords = [(k[0], k[1] * self.resolution, (k[1] + 1) * self.resolution)
+                  for k in sorted(self.sections, key=lambda x: self.sections[x])
+                  if start2 <= self.sections[k] < end2]
+        if not coords:
+            raise Exception('ERROR: HiC data object should have genomic coordinates')
+        colnam = ['%s:%d-%d' % k for k in coords]
         if format == 'long-range':
-            rownam = ['%s:%d-%d' % (k[0],
-                                     k[1] * self.resolution,
-                                     (k[1] + 1) * self.resolution)
-                      for k in sorted(self.sections,
-                                      key=lambda x: self.sections[x])
-                      if start2 <= self.sections[k] < end2]
-            if not rownam:
-                raise Exception('ERROR: HiC data object should have genomic coordinates')
-            iter_rows = self.yield_matrix(focus=focus, diagonal=diagonal,
-                                          normalized=normalized)
+            rownam = colnam
             pair_string = '%s\t%s\t%f\n' if normalized else '%s\t%s\t%d\n'
-            for nrow, row in enumerate(rownam, 1):
-                line = iter_rows.next()
-                iter_cols = iter(line)
-                for col in rownam[nrow:]:
-                    val = iter_cols.next()
-                    if not val:
-                        continue
-                    out.write(pair_string % (row, col, val))
-        elif format == 'BED':
-            rownam = ['%s\t%d\t%d' % (k[0],
-                                     k[1] * self.resolution,
-                                     (k[1] + 1) * self.resolution)
-                      for k in sorted(self.sections,
-                                      key=lambda x: self.sections[x])
-                      if start2 <= self.sections[k] < end2]
-            colnam = ['%s:%d-%d' % (k[0],
-                                     k[1] * self.resolution,
-                                     (k[1] + 1) * self.resolution)
-                      for k in sorted(self.sections,
-                                      key=lambda x: self.sections[x])
-                      if start2 <= self.sections[k] < end2]
-            if not rownam:
-                raise Exception('ERROR: HiC data object should have genomic coordinates')
-            iter_rows = self.yield_matrix(focus=focus, diagonal=diagonal,
-                                          normalized=normalized)
-            pair_string = '%s\t%s,%f\t%d\t.\n' if normalized else '%s\t%s,%d\t%d\t.\n'
-            count = 1
-            for nrow, row in enumerate(rownam, 1):
-                line = iter_rows.next()
-                iter_cols = iter(line)
-                for col in colnam[nrow:]:
-                    val = iter_cols.next()
-                    if not val:
-                        continue
-                    out.write(pair_string % (row, col, val, count))
-                    count += 1
         else:
-            raise Exception('ERROR: format "%s" not found\n' % format)
+            rownam = ['%s\t%d\t%d' % k for k in coords]
+            pair_string = '%s\t%s,%f\t%d\t.\n' if normalized else '%s\t%s,%d\t%d\t.\n'
+        out = _open_output(fname, compress)
+        count = 1
+        for beg, block in self._yield_blocks(focus=focus, diagonal=diagonal,
+                                             normalized=normalized,
+                                             step=1000000):
+            # cells above the diagonal
+            rows, cols = np.nonzero(np.triu(block, beg + 1))
+            cells = zip([rownam[i] for i in (rows + beg).tolist()],
+                        [colnam[j] for j in cols.tolist()],
+                        block[rows, cols].tolist())
+            if format == 'long-range':
+                out.write(''.join([pair_string % cell for cell in cells]))
+            else:
+                out.write(''.join([pair_string % (row, col, val, num)
+                                   for num, (row, col, val)
+                                   in enumerate(cells, count)]))
+                count += len(cells)
         out.close()
 
 
-    def write_matrix(self, fname, focus=None, diagonal=True, normalized=False):
+    def write_matrix(self, fname, focus=None, diagonal=True, normalized=False,
+                     sparse=False, compress=False):
         """
-        writes the matrix to a file.
+        writes the matrix to a file. Rows are formatted by blocks.
 
         :param None focus: a tuple with the (start, end) position of the desired
            window of data (start, starting at 1, and both start and end are
@@ -454,49 +718,53 @@ class HiC_data(dict):
            region
         :param True diagonal: if False, diagonal is replaced by zeroes
         :param False normalized: get normalized data
+        :param False sparse: writes only the non-zero cells, one per line, as
+           row, column (relative to the focus) and value. If the focus is not
+           an inter-chromosomal region, only the upper triangle of the matrix
+           is written
+        :param False compress: gzip the output file (BGZF blocks compressed
+           in parallel, that can be read back in parallel with magic_open).
+           File names ending with '.gz' are always compressed
         """
-        if focus:
-            if isinstance(focus, tuple) and isinstance(focus[0], int):
-                if len(focus) == 2:
-                    start1, end1 = focus
-                    start2, end2 = focus
-                    start1 -= 1
-                    start2 -= 1
-                else:
-                    start1, end1, start2, end2 = focus
-                    start1 -= 1
-                    start2 -= 1
-            elif isinstance(focus, tuple) and isinstance(focus[0], str):
-                start1, end1 = self.section_pos[focus[0]]
-                start2, end2 = self.section_pos[focus[1]]
-            else:
-                start1, end1 = self.section_pos[focus]
-                start2, end2 = self.section_pos[focus]
-        else:
-            start1 = start2 = 0
-            end1   = end2   = len(self)
-        out = open(fname, 'w')
+        start1, start2, end1, end2 = self._focus_coords(focus)
+        out = _open_output(fname, compress)
         out.write('# MASKED %s\n' % (' '.join([str(k - start1)
                                                for k in self.bads.keys()
                                                if start1 <= k <= end1])))
+        blocks = self._yield_blocks(focus=focus, diagonal=diagonal,
+                                    normalized=normalized, step=1000000)
+        if sparse:
+            symmetric = (start1, end1) == (start2, end2)
+            for beg, block in blocks:
+                if symmetric:
+                    block = np.triu(block, beg)
+                rows, cols = np.nonzero(block)
+                out.write(''.join(['%d\t%d\t%s\n' % cell for cell in
+                                   zip((rows + beg).tolist(), cols.tolist(),
+                                       block[rows, cols].tolist())]))
+            out.close()
+            return
         rownam = ['%s\t%d-%d' % (k[0],
                                  k[1] * self.resolution,
                                  (k[1] + 1) * self.resolution)
                   for k in sorted(self.sections,
                                   key=lambda x: self.sections[x])
                   if start2 <= self.sections[k] < end2]
-        if rownam:
-            for line in self.yield_matrix(focus=focus, diagonal=diagonal,
-                                          normalized=normalized):
-                out.write(rownam.pop(0) + '\t' +
-                          '\t'.join([str(i) for i in line]) + '\n')
-        else:
-            for line in self.yield_matrix(focus=focus, diagonal=diagonal,
-                                          normalized=normalized):
-                out.write('\t'.join([str(i) for i in line]) + '\n')
+        # one format string for the whole row
+        line = '\t'.join(['%s'] * (end1 - start1)) + '\n'
+        named_line = '%s\t' + line
+        for beg, block in blocks:
+            if rownam:
+                out.write(''.join([
+                    named_line % tuple([rownam[beg + i]] + row)
+                    for i, row in enumerate(block.tolist())]))
+            else:
+                out.write(''.join([line % tuple(row)
+                                   for row in block.tolist()]))
         out.close()
 
-    def get_matrix(self, focus=None, diagonal=True, normalized=False):
+    def get_matrix(self, focus=None, diagonal=True, normalized=False,
+                   as_array=False):
         """
         returns a matrix.
 
@@ -508,9 +776,14 @@ class HiC_data(dict):
         :param True diagonal: if False, diagonal is replaced by ones, or zeroes
            if normalized
         :param False normalized: get normalized data
+        :param False as_array: returns a NumPy array (see
+           :func:`HiC_data.get_array`)
 
         :returns: matrix (a list of lists of values)
         """
+        if as_array:
+            return self.get_array(focus=focus, diagonal=diagonal,
+                                  normalized=normalized)
         if normalized and not self.bias:
             raise Exception('ERROR: experiment not normalized yet')
         start1, start2, end1, end2 = self._focus_coords(focus)
@@ -539,6 +812,44 @@ class HiC_data(dict):
                         mtrx[i][i] = 1 if mtrx[i][i] else 0
                 return mtrx
 
+    def get_array(self, focus=None, diagonal=True, normalized=False,
+                  sparse=False):
+        """
+        returns a matrix as a NumPy array. Same as get_matrix, but cells are
+        sliced directly from the stored data, and normalization is vectorized.
+
+        :param None focus: a tuple with the (start, end) position of the desired
+           window of data (start, starting at 1, and both start and end are
+           inclusive). Alternatively a chromosome name can be input or a tuple
+           of chromosome name, in order to retrieve a specific inter-chromosomal
+           region
+        :param True diagonal: if False, diagonal is replaced by ones, or zeroes
+           if normalized
+        :param False normalized: get normalized data
+        :param False sparse: returns a scipy.sparse.csr_matrix instead of a
+           dense array
+
+        :returns: a 2D NumPy array, rows corresponding to the first region of
+           the focus
+        """
+        if normalized and not self.bias:
+            raise Exception('ERROR: experiment not normalized yet')
+        start1, start2, end1, end2 = self._focus_coords(focus)
+        # as in get_matrix, cell (i, j) of the data goes to row j, column i
+        cols, rows, vals = self._get_block(start2, end2, start1, end1)
+        if normalized:
+            vals = (vals.astype(float) / self._bias_array(start2, end2)[cols]
+                    / self._bias_array(start1, end1)[rows])
+        if not diagonal and start1 == start2:
+            diag = rows == cols
+            vals[diag] = 0 if normalized else vals[diag] != 0
+        shape = (end1 - start1, end2 - start2)
+        if sparse:
+            return csr_matrix((vals, (rows, cols)), shape=shape)
+        matrix = np.zeros(shape, dtype=vals.dtype)
+        matrix[rows, cols] = vals
+        return matrix
+
     def _focus_coords(self, focus):
         siz = len(self)
         if focus:
@@ -566,7 +877,8 @@ class HiC_data(dict):
     def find_compartments(self, crms=None, savefig=None, savedata=None,
                           savecorr=None, show=False, suffix='', how='',
                           label_compartments='hmm', log=None, max_mean_size=10000,
-                          ev_index=None, rich_in_A=None, max_ev=3, **kwargs):
+                          ev_index=None, rich_in_A=None, max_ev=3, ncpus=1,
+                          **kwargs):
         """
         Search for A/B compartments in each chromosome of the Hi-C matrix.
         Hi-C matrix is normalized by the number interaction expected at a given
@@ -617,6 +929,10 @@ class HiC_data(dict):
            cluster.
         :param 'ratio' how: ratio divide by column, subratio divide by
            compartment, diagonal only uses diagonal
+        :param 1 ncpus: number of CPUs used to compute the correlation matrices
+           of the chromosomes in parallel (each process accesses the contact
+           data of the main one, without copying it), and to train the HMMs
+           with different number of categories
 
 
         TODO: this is really slow...
@@ -639,7 +955,9 @@ class HiC_data(dict):
         if not self.expected:
             if kwargs.get('verbose', False):
                 print 'Normalizing by expected values'
-            self.expected = expected(self, bads=self.bads, **kwargs)
+            self.expected = self.get_expected(
+                **dict((k, kwargs[k]) for k in ('signal_to_noise',
+                                                'inter_chrom') if k in kwargs))
         if not self.bias:
             if kwargs.get('verbose', False):
                 print 'Normalizing by ICE (1 round)'
@@ -660,28 +978,16 @@ class HiC_data(dict):
         ev_nums = {}
         count = 0
 
-        for sec in self.section_pos:
-            if crms and sec not in crms:
-                continue
+        secs = [sec for sec in self.section_pos if not crms or sec in crms]
+        for sec, matrix in _iter_correlation_matrices(self, secs, ncpus):
             if kwargs.get('verbose', False):
                 print 'Processing chromosome', sec
-            matrix = [[(float(self[i,j]) / self.expected[abs(j-i)]
-                       / self.bias[i] / self.bias[j])
-                      for i in xrange(*self.section_pos[sec])
-                       if not i in self.bads]
-                     for j in xrange(*self.section_pos[sec])
-                      if not j in self.bads]
-            if not matrix: # MT chromosome will fall there
+            if not matrix.size: # MT chromosome will fall there
                 warn('Chromosome %s is probably MT :)' % (sec))
                 cmprts[sec] = []
                 count += 1
                 continue
-            for i in xrange(len(matrix)):
-                for j in xrange(i+1, len(matrix)):
-                    matrix[i][j] = matrix[j][i]
-            try:
-                matrix = [list(m) for m in corrcoef(matrix)]
-            except TypeError:
+            if matrix.ndim < 2:
                 # very small chromosome?
                 warn('Chromosome %s is probably MT :)' % (sec))
                 cmprts[sec] = []
@@ -724,7 +1030,7 @@ class HiC_data(dict):
 
             try:
                 # This eighs is very very fast, only ask for one eigvector
-                _, evect = eigsh(array(matrix), k=max_ev)
+                _, evect = eigsh(matrix, k=max_ev)
             except (LinAlgError, ValueError):
                 warn('Chromosome %s too small to compute PC1' % (sec))
                 cmprts[sec] = [] # Y chromosome, or so...
@@ -766,10 +1072,14 @@ class HiC_data(dict):
             for evect in n_first:
                 _ = [evect.insert(b, float('nan')) for b in bads]
             _ = [first.insert(b, 0) for b in bads]
-            _ = [matrix.insert(b, [float('nan')] * len(matrix[0]))
-                 for b in bads]
-            _ = [matrix[i].insert(b, float('nan'))
-                 for b in bads for i in xrange(len(first))]
+            # same insertion for the rows and columns of the matrix (-1 for
+            # filtered ones)
+            order = range(len(matrix))
+            _ = [order.insert(b, -1) for b in bads]
+            order = np.array(order)
+            matrix = matrix[order[:, None], order]
+            matrix[order == -1] = float('nan')
+            matrix[:, order == -1] = float('nan')
             breaks = [i for i, (a, b) in
                       enumerate(zip(first[1:], first[:-1]))
                       if a * b < 0] + [len(first) - 1]
@@ -842,7 +1152,20 @@ class HiC_data(dict):
             #  - one with 4 states A a B b
             #  - one with 5 states A a B b I
             models = {}
+            if ncpus > 1:
+                # each model is trained on the values it would have got if
+                # trained one after the other
+                pool = mu.Pool(min(ncpus, 4))
+                for n in range(2, 6):
+                    models[n] = pool.apply_async(
+                        _training, args=(dict(x), n, False))
+                    _standardize(x)
+                pool.close()
+                pool.join()
+                models = dict((n, models[n].get()) for n in models)
             for n in range(2, 6):
+                if n in models:
+                    continue
                 if kwargs.get('verbose', False):
                     print ('Training HMM for %d categories of '
                            'compartments' % n)
@@ -1023,7 +1346,8 @@ class HiC_data(dict):
         out.close()
 
 
-    def yield_matrix(self, focus=None, diagonal=True, normalized=False):
+    def yield_matrix(self, focus=None, diagonal=True, normalized=False,
+                     as_array=False):
         """
         Yields a matrix line by line.
         Bad row/columns are returned as null row/columns.
@@ -1035,63 +1359,532 @@ class HiC_data(dict):
            region
         :param True diagonal: if False, diagonal is replaced by zeroes
         :param False normalized: get normalized data
+        :param False as_array: yields NumPy arrays instead of lists
 
         :yields: matrix line by line (a line being a list of values)
         """
-        siz = len(self)
+        for _, block in self._yield_blocks(focus=focus, diagonal=diagonal,
+                                           normalized=normalized):
+            for row in block:
+                yield row if as_array else row.tolist()
+
+    def _yield_blocks(self, focus=None, diagonal=True, normalized=False,
+                      step=10000000):
+        """
+        Yields a matrix by blocks of rows, as NumPy arrays. Same options as
+        yield_matrix.
+
+        :param 10000000 step: approximate number of cells in each block
+
+        :yields: the index of the first row of the block (relative to the
+           focus), and the block
+        """
         if normalized and not self.bias:
             raise Exception('ERROR: experiment not normalized yet')
-        if focus:
-            if isinstance(focus, tuple) and isinstance(focus[0], int):
-                if len(focus) == 2:
-                    start1, end1 = focus
-                    start2, end2 = focus
-                    start1 -= 1
-                    start2 -= 1
-                else:
-                    start1, end1, start2, end2 = focus
-                    start1 -= 1
-                    start2 -= 1
-            elif isinstance(focus, tuple) and isinstance(focus[0], str):
-                start1, end1 = self.section_pos[focus[0]]
-                start2, end2 = self.section_pos[focus[1]]
-            else:
-                start1, end1 = self.section_pos[focus]
-                start2, end2 = self.section_pos[focus]
-        else:
-            start1 = start2 = 0
-            end1   = end2   = siz
+        start1, start2, end1, end2 = self._focus_coords(focus)
         if normalized:
-            for i in xrange(start2, end2):
-                # if bad column:
+            bias_cols = self._bias_array(start1, end1)
+        # rows are extracted by blocks of around step cells
+        step = max(1, step / max(1, end1 - start1))
+        for beg in xrange(start2, end2, step):
+            end = min(beg + step, end2)
+            rows, cols, vals = self._get_block(beg, end, start1, end1)
+            if normalized:
+                vals = (vals.astype(float) / self._bias_array(beg, end)[rows]
+                        / bias_cols[cols])
+            block = np.zeros((end - beg, end1 - start1), dtype=vals.dtype)
+            block[rows, cols] = vals
+            # diagonal replaced by zeroes
+            if not diagonal and start1 == start2:
+                diag = np.arange(beg, min(end, end1))
+                block[diag - beg, diag - start1] = 0
+            # bad rows
+            for i in xrange(beg, end):
                 if i in self.bads:
-                    yield [0.0 for j in xrange(start1, end1)]
-                # if we want the diagonal, or we don't but are looking at a
-                # region that is not symmetric
-                elif diagonal or start1 != start2:
-                    yield [self[i, j] / self.bias[i] / self.bias[j]
-                           for j in xrange(start1, end1)]
-                # diagonal replaced by zeroes
-                else:
-                    yield ([self[i, j] / self.bias[i] / self.bias[j]
-                            for j in xrange(start1, i)] +
-                           [0.0] +
-                           [self[i, j] / self.bias[i] / self.bias[j]
-                            for j in xrange(i + 1, end1)])
+                    block[i - beg] = 0
+            yield beg - start2, block
+
+class SparseHiC_data(HiC_data):
+    """
+    Memory efficient version of HiC_data.
+
+    Only the upper triangle of the interaction matrix (diagonal included) is
+    stored, in compressed sparse row format, using NumPy arrays of int32
+    column indices and int32 (or float32) values. Cells (i, j) and (j, i)
+    thus always hold the same value.
+
+    The interface is the one of HiC_data: cells can be accessed with
+    ``hic[i, j]``, ``hic.get(i * size + j)`` or ``hic.iteritems()``, and
+    ``bads``, ``bias``, ``sections`` or ``section_pos`` are kept as attributes.
+
+    :param items: iterable of (position, value) pairs, position being
+       ``row * size + column``. Only cells from the upper triangle are kept (the
+       matrix is expected to be symmetric).
+    :param size: number of rows (and columns) of the matrix
+    :param None coo: alternatively to items, a tuple of three arrays with the
+       rows, columns and values of the cells. Cells from the lower triangle are
+       mirrored and values found several times for the same cell are summed.
+    :param None dtype: type of the stored values (numpy.int32 or
+       numpy.float32), by default guessed from the values
+    """
+    def __init__(self, items, size, chromosomes=None, dict_sec=None,
+                 resolution=1, masked=None, symmetricized=False, coo=None,
+                 dtype=None):
+        super(SparseHiC_data, self).__init__(
+            (), size, chromosomes=chromosomes, dict_sec=dict_sec,
+            resolution=resolution, masked=masked, symmetricized=symmetricized)
+        self._pending = {}
+        if coo is None:
+            keys, vals = _items_to_arrays(items, size)
         else:
-            for i in xrange(start2, end2):
-                # if bad column:
-                if i in self.bads:
-                    yield [0 for j in xrange(start1, end1)]
-                # if we want the diagonal, or we don't but are looking at a
-                # region that is not symmetric
-                elif diagonal or start1 != start2:
-                    yield [self[i, j] for j in xrange(start1, end1)]
-                # diagonal replaced by zeroes
-                else:
-                    yield ([self[i, j] for j in xrange(start1, i)] +
-                           [0] +
-                           [self[i, j] for j in xrange(i + 1, end1)])
+            rows, cols, vals = coo
+            rows = np.asarray(rows, dtype=np.int64)
+            cols = np.asarray(cols, dtype=np.int64)
+            keys = np.minimum(rows, cols) * size + np.maximum(rows, cols)
+            keys, vals = _sum_duplicates(keys, np.asarray(vals))
+        self._set_arrays(keys, vals, dtype)
+
+    def _set_arrays(self, keys, vals, dtype=None):
+        """
+        stores sorted flat positions (row * size + column) of the upper
+        triangle, and their values, in compressed sparse row arrays
+        """
+        size = len(self)
+        nonzero = vals != 0
+        keys = keys[nonzero]
+        vals = vals[nonzero]
+        if dtype is None:
+            dtype = (np.int32 if vals.dtype.kind in 'iub' or
+                     not np.any(np.mod(vals, 1)) else np.float32)
+        rows, cols = np.divmod(keys, size)
+        self._indptr = np.zeros(size + 1, dtype=np.int64)
+        np.cumsum(np.bincount(rows, minlength=size), out=self._indptr[1:])
+        self._indices = cols.astype(np.int32)
+        self._values = vals.astype(dtype)
+
+    def _set_size(self, size):
+        """
+        changes the number of rows (and columns) of the matrix, keeping the row
+        and column of the stored cells (cells out of the new matrix are dropped)
+        """
+        if size == len(self):
+            return
+        self._consolidate()
+        rows, cols = np.divmod(self._flat_keys(), len(self))
+        # only cells of the upper triangle are stored (row <= col)
+        keep = cols < size
+        super(SparseHiC_data, self)._set_size(size)
+        self._set_arrays(rows[keep] * size + cols[keep], self._values[keep],
+                         self._values.dtype)
+
+    def _flat_keys(self):
+        """
+        flat positions of the stored cells
+        """
+        size = len(self)
+        rows = np.repeat(np.arange(size, dtype=np.int64),
+                         np.diff(self._indptr))
+        return rows * size + self._indices
+
+    def _consolidate(self):
+        """
+        merges cells assigned through __setitem__ into the arrays
+        """
+        if not self._pending:
+            return
+        keys = self._flat_keys()
+        new_keys = np.fromiter(self._pending.iterkeys(), dtype=np.int64,
+                               count=len(self._pending))
+        new_vals = np.fromiter(self._pending.itervalues(), dtype=float,
+                               count=len(self._pending))
+        dtype = self._values.dtype
+        if np.any(np.mod(new_vals, 1)):
+            dtype = np.float32
+        vals = self._values.astype(dtype)
+        if len(keys):
+            pos = np.minimum(keys.searchsorted(new_keys), len(keys) - 1)
+            found = keys[pos] == new_keys
+        else:
+            pos = np.zeros(len(new_keys), dtype=int)
+            found = np.zeros(len(new_keys), dtype=bool)
+        vals[pos[found]] = new_vals[found]
+        keys = np.concatenate((keys, new_keys[~found]))
+        vals = np.concatenate((vals, new_vals[~found].astype(dtype)))
+        order = keys.argsort()
+        self._pending = {}
+        self._set_arrays(keys[order], vals[order], dtype)
+
+    def _get_cell(self, row, col, default):
+        if row > col:
+            row, col = col, row
+        if self._pending:
+            try:
+                return self._pending[row * len(self) + col]
+            except KeyError:
+                pass
+        beg = self._indptr[row]
+        end = self._indptr[row + 1]
+        pos = beg + self._indices[beg:end].searchsorted(col)
+        if pos < end and self._indices[pos] == col:
+            return self._values[pos].item()
+        return default
+
+    def _row_col(self, row_col):
+        """
+        row and column of a cell given as (row, column) or as flat position
+        """
+        size = len(self)
+        try:
+            row, col = row_col
+            if row * size + col > self._size2:
+                raise IndexError(
+                    'ERROR: row or column larger than %s' % size)
+        except TypeError:
+            if row_col > self._size2:
+                raise IndexError(
+                    'ERROR: position %d larger than %s^2' % (row_col, size))
+            row, col = divmod(row_col, size)
+        return row, col
+
+    def __getitem__(self, row_col):
+        """
+        slow one... for user
+        for fast item getting, use self.get()
+        """
+        row, col = self._row_col(row_col)
+        return self._get_cell(row, col, 0)
+
+    def __setitem__(self, row_col, val):
+        """
+        sets the value of cell (i, j), and thus of cell (j, i)
+        """
+        row, col = self._row_col(row_col)
+        if row > col:
+            row, col = col, row
+        self._pending[row * len(self) + col] = val
+        if self._expected_cache:
+            self._clear_expected()
+        # keep the buffer of modified cells small
+        if len(self._pending) > 1000000:
+            self._consolidate()
+
+    def __delitem__(self, row_col):
+        """
+        removes cell (i, j), and thus cell (j, i)
+        """
+        row, col = self._row_col(row_col)
+        if not self._get_cell(row, col, 0):
+            raise KeyError(row_col)
+        # cells set to zero are dropped from the arrays when consolidated
+        self[row, col] = 0
+
+    def get(self, pos, default=None):
+        return self._get_cell(*divmod(pos, len(self)), default=default)
+
+    def __contains__(self, pos):
+        # cells set to zero are not stored
+        return self.get(pos, 0) != 0
+
+    has_key = __contains__
+
+    def __eq__(self, other):
+        if not isinstance(other, dict):
+            return False
+        if isinstance(other, SparseHiC_data):
+            self._consolidate()
+            other._consolidate()
+            return (len(self) == len(other) and
+                    np.array_equal(self._indptr , other._indptr ) and
+                    np.array_equal(self._indices, other._indices) and
+                    np.array_equal(self._values , other._values ))
+        return dict(self.iteritems()) == dict(other.iteritems())
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __reduce__(self):
+        self._consolidate()
+        return __newobj__, (self.__class__, ), self.__dict__
+
+    def iteritems(self, chunk=100000):
+        """
+        Iterates over the non-zero cells of the full matrix, as in HiC_data.
+
+        :param 100000 chunk: number of stored cells processed at a time
+        """
+        self._consolidate()
+        size = len(self)
+        keys = self._flat_keys()
+        for beg in xrange(0, len(keys), chunk):
+            upper = keys[beg:beg + chunk]
+            vals = self._values[beg:beg + chunk]
+            rows, cols = np.divmod(upper, size)
+            lower = rows != cols
+            for item in zip(upper.tolist(), vals.tolist()):
+                yield item
+            for item in zip((cols[lower] * size + rows[lower]).tolist(),
+                            vals[lower].tolist()):
+                yield item
+
+    def iterkeys(self):
+        for key, _ in self.iteritems():
+            yield key
+
+    __iter__ = iterkeys
+
+    def itervalues(self):
+        for _, val in self.iteritems():
+            yield val
+
+    def items(self):
+        return list(self.iteritems())
+
+    def keys(self):
+        return list(self.iterkeys())
+
+    def values(self):
+        return list(self.itervalues())
+
+    def get_upper_triangle(self):
+        self._consolidate()
+        rows, cols = np.divmod(self._flat_keys(), len(self))
+        return rows, cols, self._values.copy()
+
+    def iter_upper_triangle(self, chunk=1000000):
+        self._consolidate()
+        for beg in xrange(0, len(self._values), chunk):
+            end = min(beg + chunk, len(self._values))
+            rows = self._indptr.searchsorted(np.arange(beg, end),
+                                             side='right') - 1
+            yield rows, self._indices[beg:end], self._values[beg:end]
+
+    def _get_block(self, start1, end1, start2, end2):
+        """
+        Non-zero cells of the rectangle defined by rows start1 to end1 and
+        columns start2 to end2, sliced from the stored rows.
+
+        :returns: rows, columns (relative to the rectangle) and values
+        """
+        self._consolidate()
+        # cells (i, j) with i <= j are stored in rows start1 to end1
+        beg, end = self._indptr[start1], self._indptr[end1]
+        rows = np.repeat(np.arange(start1, end1),
+                         np.diff(self._indptr[start1:end1 + 1]))
+        cols = self._indices[beg:end]
+        keep = (cols >= start2) & (cols < end2)
+        rows1, cols1, vals1 = rows[keep], cols[keep], self._values[beg:end][keep]
+        # cells (i, j) with i > j are stored, transposed, in rows start2 to end2
+        beg, end = self._indptr[start2], self._indptr[end2]
+        rows = np.repeat(np.arange(start2, end2),
+                         np.diff(self._indptr[start2:end2 + 1]))
+        cols = self._indices[beg:end]
+        keep = (cols >= start1) & (cols < end1) & (cols > rows)
+        rows2, cols2, vals2 = cols[keep], rows[keep], self._values[beg:end][keep]
+        return (np.concatenate((rows1, rows2)) - start1,
+                np.concatenate((cols1, cols2)) - start2,
+                np.concatenate((vals1, vals2)))
+
+    def get_hic_data_as_csr(self):
+        """
+        Returns a scipy sparse matrix in Compressed Sparse Row format of the
+        HiC data (full matrix).
+
+        :returns: scipy sparse matrix in Compressed Sparse Row format
+        """
+        rows, cols, vals = self.get_upper_triangle()
+        lower = rows != cols
+        return csr_matrix((np.concatenate((vals, vals[lower])),
+                           (np.concatenate((rows, cols[lower])),
+                            np.concatenate((cols, rows[lower])))),
+                          shape=(len(self), len(self)))
+
+    def to_sparse(self, dtype=None):
+        if dtype is None or dtype == self._values.dtype:
+            return self
+        self._consolidate()
+        hic = SparseHiC_data((), len(self), chromosomes=self.chromosomes,
+                             dict_sec=self.sections, resolution=self.resolution,
+                             masked=dict(self.bads),
+                             symmetricized=self.symmetricized)
+        hic._indptr  = self._indptr
+        hic._indices = self._indices
+        hic._values  = self._values.astype(dtype)
+        hic.section_pos  = dict(self.section_pos)
+        hic.bias         = self.bias
+        hic.expected     = self.expected
+        hic.compartments = self.compartments
+        return hic
+
+    def sum(self, bias=None, bads=None):
+        """
+        Sum Hi-C data matrix
+        WARNING: parameters are not meant to be used by external users
+
+        :params None bias: expects a dictionary of biases to use normalized matrix
+        :params None bads: extends computed bad columns
+
+        :returns: the sum of the Hi-C matrix skipping bad columns
+        """
+        size = len(self)
+        bads = bads or self.bads
+        rows, cols, vals = self.get_upper_triangle()
+        vals = vals.astype(float)
+        if bias:
+            bias = np.array([bias[i] for i in xrange(size)], dtype=float)
+            vals /= bias[rows] * bias[cols]
+        if bads:
+            good = np.ones(size, dtype=bool)
+            good[[b for b in bads if b < size]] = False
+            vals[~(good[rows] & good[cols])] = 0
+        # off-diagonal cells are stored once
+        return 2 * vals.sum() - vals[rows == cols].sum()
+
+
+def _rebuild_hic_data(cls, state, cells):
+    """
+    unpickles a HiC_data object, setting its attributes before its cells
+    """
+    hic_data = cls.__new__(cls)
+    hic_data.__dict__.update(state)
+    dict.update(hic_data, cells)
+    return hic_data
+
+
+def _open_output(fname, compress=False):
+    """
+    opens a file for writing, BGZF compressed if compress (or if the file name
+    ends with '.gz')
+    """
+    if compress and not fname.endswith('.gz'):
+        return BgzfWriter(fname)
+    return magic_write(fname)
+
+
+def _items_to_arrays(items, size):
+    """
+    converts an iterable of (position, value) pairs into sorted arrays of
+    positions and values in the upper triangle of the matrix
+    """
+    if isinstance(items, dict):
+        keys = np.fromiter(items.iterkeys(), dtype=np.int64)
+        vals = np.fromiter(items.itervalues(), dtype=float)
+    else:
+        keys = py_array('l')
+        vals = py_array('d')
+        for key, val in items:
+            keys.append(key)
+            vals.append(val)
+        keys = np.frombuffer(keys, dtype=np.int_).astype(np.int64)
+        vals = np.frombuffer(vals, dtype=float)
+    rows, cols = np.divmod(keys, size)
+    upper = rows <= cols
+    keys = keys[upper]
+    vals = vals[upper]
+    order = keys.argsort()
+    return keys[order], vals[order]
+
+
+def _sum_duplicates(keys, vals):
+    """
+    sums values of repeated keys
+
+    :returns: sorted unique keys and their summed values
+    """
+    keys, inverse = np.unique(keys, return_inverse=True)
+    sums = np.bincount(inverse, weights=vals, minlength=len(keys))
+    if vals.dtype.kind in 'iub':
+        sums = sums.astype(np.int64)
+    return keys, sums
+
+
+def _sum_chunks(chunks, size, bias, bads):
+    """
+    sums the normalized interactions of a matrix read chunk by chunk (see
+    HiC_data.sum)
+    """
+    bias = np.array([bias[i] for i in xrange(size)], dtype=float)
+    good = np.ones(size, dtype=bool)
+    if bads:
+        good[[b for b in bads if b < size]] = False
+    total = 0.
+    for rows, cols, vals in chunks:
+        keep = good[rows] & good[cols]
+        rows, cols = rows[keep], cols[keep]
+        vals = vals[keep] / bias[rows] / bias[cols]
+        # off-diagonal cells are stored once
+        total += 2 * vals.sum() - vals[rows == cols].sum()
+    return total
+
+
+def _correlation_matrix(hic_data, sec):
+    """
+    correlation matrix of the interactions of a chromosome, normalized by
+    biases and by expected counts, without its filtered columns
+
+    :returns: a 2D NumPy array (empty if all columns are filtered, not 2D if
+       only one column is left)
+    """
+    beg, end = hic_data.section_pos[sec]
+    good = np.array([i for i in xrange(beg, end) if not i in hic_data.bads],
+                    dtype=int)
+    if not len(good):
+        return np.empty((0, 0))
+    # the upper triangle is normalized and copied into the lower one
+    matrix = np.triu(hic_data.get_array(focus=(beg + 1, end)).astype(float))
+    matrix = matrix[(good - beg)[:, None], good - beg]
+    bias = np.array([hic_data.bias[i] for i in good], dtype=float)
+    dist = np.abs(good[None, :] - good[:, None])
+    expc = np.array([hic_data.expected[d] for d in xrange(dist.max() + 1)],
+                    dtype=float)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        matrix = matrix / expc[dist] / bias[:, None] / bias[None, :]
+    matrix = np.triu(matrix)
+    matrix += np.triu(matrix, 1).T
+    return corrcoef(matrix)
+
+
+def _correlation_matrix_to_file(sec):
+    """
+    computes the correlation matrix of a chromosome of the shared Hi-C data,
+    and saves it in a temporary file
+
+    :returns: path to the file
+    """
+    corr = _correlation_matrix(_SHARED_HIC_DATA, sec)
+    fhandler, fnam = mkstemp(suffix='.npy')
+    os.close(fhandler)
+    np.save(fnam, corr)
+    return fnam
+
+
+def _iter_correlation_matrices(hic_data, secs, ncpus=1):
+    """
+    yields chromosome names and their correlation matrices, in the same order
+    as secs. With several CPUs, matrices are computed by forked processes
+    reading the Hi-C data of the main process.
+    """
+    if ncpus < 2 or len(secs) < 2:
+        for sec in secs:
+            yield sec, _correlation_matrix(hic_data, sec)
+        return
+    global _SHARED_HIC_DATA
+    _SHARED_HIC_DATA = hic_data
+    try:
+        pool = mu.Pool(min(ncpus, len(secs)))
+    finally:
+        _SHARED_HIC_DATA = None
+    procs = [(sec, pool.apply_async(_correlation_matrix_to_file, args=(sec,)))
+             for sec in secs]
+    pool.close()
+    try:
+        for sec, proc in procs:
+            fnam = proc.get()
+            corr = np.load(fnam)
+            os.remove(fnam)
+            yield sec, corr
+    finally:
+        pool.terminate()
+        pool.join()
 
 
 def _hmm_refine_compartments(xsec, models, bads, verbose):
@@ -1142,14 +1935,19 @@ def _training(x, n, verbose):
     T = [[0.9 if i==j else 0.1/(n-1) for i in xrange(n)] for j in xrange(n)]
     E =  asarray(zip(linspace(-1, 1, n), [1./n for _ in range(n)]))
 
-    # normalize values of the first eigenvector
+    _standardize(x)
+    train(pi, T, E, x.values(), verbose=verbose, threshold=1e-6, n_iter=1000)
+    return E, pi, T
+
+def _standardize(x):
+    """
+    normalize values of the first eigenvector of each chromosome (in place)
+    """
     for c in x:
         this_mean = mean(x[c])
         this_std  = std (x[c])
         x[c] = [v - this_mean for v in x[c]]
         x[c] = [v / this_std  for v in x[c]]
-    train(pi, T, E, x.values(), verbose=verbose, threshold=1e-6, n_iter=1000)
-    return E, pi, T
 
 def _cluster_ab_compartments(gamma, matrix, breaks, cmprtsec, rich_in_A, save=True,
                              ev_num=1, log=None, verbose=False, savefig=None,
@@ -1158,6 +1956,7 @@ def _cluster_ab_compartments(gamma, matrix, breaks, cmprtsec, rich_in_A, save=Tr
     gamma += 1
     func = lambda x: -abs(x)**gamma / x
     funczero = lambda x: 0.0
+    matrix = asarray(matrix)
     # calculate distance_matrix
     dist_matrix = [[0 for _ in xrange(len(breaks))]
                    for _ in xrange(len(breaks))]
@@ -1168,8 +1967,7 @@ def _cluster_ab_compartments(gamma, matrix, breaks, cmprtsec, rich_in_A, save=Tr
         scores[(k,k)] = dist_matrix[k][k] = -1
         for l in xrange(k + 1, len(cmprtsec)):
             beg2, end2 = cmprtsec[l]['start'], cmprtsec[l]['end'] + 1
-            val = nansum([matrix[i][j] for i in xrange(beg1, end1)
-                          for j in xrange(beg2, end2)]) / (end2 - beg2) / diff1
+            val = nansum(matrix[beg1:end1, beg2:end2].ravel()) / (end2 - beg2) / diff1
             try:
                 scores[(k,l)] = dist_matrix[k][l] = scores[(l,k)] = dist_matrix[l][k] = func(val)
             except ZeroDivisionError:
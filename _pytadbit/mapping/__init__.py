@@ -1,5 +1,9 @@
 from pytadbit.utils.file_handling         import mkdir, magic_open
-from itertools                            import combinations
+from pytadbit.utils.file_handling         import magic_write
+from pytadbit.parsers.reads_cache         import ReadsCacheWriter
+from pytadbit.parsers.map_parser          import read_names_path
+from itertools                            import combinations, chain
+from heapq                                import merge
 from os                                   import path, system
 from sys                                  import stdout
 from collections import OrderedDict
@@ -16,6 +20,42 @@ def gt_reads(rd1, rd2):
     """
     return rd1.split('~', 1)[0] > rd2.split('~', 1)[0]
 
+def _read_name(line):
+    """
+    name of the read in a line, without the suffix of multicontacts
+    """
+    return line.split('\t', 1)[0].split('~', 1)[0]
+
+def _read_id(line):
+    """
+    integer ID of the read in a line (see
+    :func:`pytadbit.parsers.map_parser.merge_parsed_read_ids`), without the
+    suffix of multicontacts (~N~, or #N/M once intersected)
+    """
+    return int(line.split('\t', 1)[0].split('#', 1)[0].split('~', 1)[0])
+
+def _shift_read_id(line, offset):
+    """
+    adds offset to the integer ID of the read in a line, keeping the suffix of
+    multicontacts
+    """
+    rid = line.split('\t', 1)[0].split('#', 1)[0].split('~', 1)[0]
+    return str(int(rid) + offset) + line[len(rid):]
+
+def _names_file(ids_line, fnam):
+    """
+    path to the file with read names given in the '# READ IDS' line of the
+    header of fnam (relative paths are searched from the working directory,
+    and then from the directory of fnam)
+    """
+    names_path = ids_line.rstrip('\n').split('\t', 1)[1]
+    if not path.exists(names_path):
+        names_path = path.join(path.dirname(fnam), names_path)
+    if not path.exists(names_path):
+        raise Exception('ERROR: file with read names not found: %s\n' %
+                        names_path)
+    return names_path
+
 def merge_2d_beds(path1, path2, outpath):
     """
     Merge two result files (file resulting from get_intersection or from
@@ -23,77 +63,122 @@ def merge_2d_beds(path1, path2, outpath):
 
     :param path1: path to first file
     :param path2: path to first file
+    :param outpath: path to the output file (compressed if its name ends with
+       '.gz')
+
+    Input files may be compressed (see
+    :func:`pytadbit.utils.file_handling.magic_open`).
+
+    If both files were parsed with integer read IDs (read_ids option of
+    :func:`pytadbit.parsers.map_parser.parse_map`), the IDs of the second
+    file are shifted after the ones of the first file, and the read names of
+    both are written to a new file, next to outpath (see
+    :func:`pytadbit.parsers.map_parser.read_names_path`).
 
     :returns: number of reads processed
     """
-    fh1 = open(path1)
-    fh2 = open(path2)
+    def _parse_header(fhandler):
+        """
+        :returns: the chromosome lengths in the header, the '# READ IDS' line
+           (empty if none), and an iterator over the reads
+        """
+        crm_lengths = OrderedDict()
+        ids_line = ''
+        line = fhandler.readline()
+        while line.startswith('#'):
+            if line.startswith('# CRM'):
+                _, _, crm, val = line.split()
+                crm_lengths[crm] = val
+            elif line.startswith('# READ IDS'):
+                ids_line = line
+            line = fhandler.readline()
+        return crm_lengths, ids_line, chain([line] if line else [], fhandler)
+    fh1 = magic_open(path1)
+    fh2 = magic_open(path2)
     # parse header
-    chromosomes = OrderedDict()
-    parsed = 0
-    for line in fh1:
-        if not line.startswith('#'):
-            break
-        parsed += len(line)
-        if not line.startswith('# CRM'):
-            continue
-        _, _, crm, val = line.split()
-        chromosomes[crm] = val
-    fh1.seek(parsed)
+    chromosomes, ids1, reads1 = _parse_header(fh1)
     # check other headers
-    parsed = 0
-    for line in fh2:
-        if not line.startswith('#'):
-            break
-        parsed += len(line)
-        if not line.startswith('# CRM'):
-            continue
-        _, _, crm, val = line.split()
-        if chromosomes[crm] != val:
+    chromosomes2, ids2, reads2 = _parse_header(fh2)
+    for crm, val in chromosomes2.iteritems():
+        if chromosomes.get(crm) != val:
             raise Exception('ERROR: files are the result of mapping on '
                             'different reference genomes')
-    fh2.seek(parsed)
-    # comparison function
-    greater = lambda x, y: x.split('\t', 1)[0].split('~')[0] > y.split('\t', 1)[0].split('~')[0]
+    if bool(ids1) != bool(ids2):
+        raise Exception('ERROR: only one of the files was parsed with read '
+                        'IDs\n')
     # write headers
-    out = open(outpath, 'w')
+    out = magic_write(outpath)
     for crm in chromosomes:
         out.write('# CRM %s\t%s\n' % (crm, chromosomes[crm]))
+    # reads are compared by name, or by integer ID if parsed with read_ids
+    if ids1:
+        # IDs of each file start at 0, the ones of the second file are put
+        # after the ones of the first file
+        names_path = read_names_path(outpath)
+        names_out = magic_write(names_path)
+        offset = 0
+        for line in magic_open(_names_file(ids1, path1)):
+            names_out.write(line)
+            offset += 1
+        for line in magic_open(_names_file(ids2, path2)):
+            names_out.write(line)
+        names_out.close()
+        out.write('# READ IDS\t%s\n' % names_path)
+        reads2 = (_shift_read_id(line, offset) for line in reads2)
+        read_key = _read_id
+    else:
+        read_key = _read_name
+    greater = lambda x, y: read_key(x) > read_key(y)
+    # reads are also written as binary columns (see
+    # pytadbit.parsers.reads_cache)
+    columns = ReadsCacheWriter(outpath, OrderedDict(
+        (crm, int(chromosomes[crm])) for crm in chromosomes))
+    lines = []
+    def write(read):
+        lines.append(read)
+        if len(lines) >= 100000:
+            out.write(''.join(lines))
+            columns.write(lines)
+            del lines[:]
     # merge sort the two files
-    read1 = fh1.next()
-    read2 = fh2.next()
+    read1 = reads1.next()
+    read2 = reads2.next()
     nreads = 0
     while True:
         if greater(read2, read1):
-            out.write(read1)
+            write(read1)
             nreads += 1
             try:
-                read1 = fh1.next()
+                read1 = reads1.next()
             except StopIteration:
-                out.write(read2)
+                write(read2)
                 nreads += 1
                 break
         else:
-            out.write(read2)
+            write(read2)
             nreads += 1
             try:
-                read2 = fh2.next()
+                read2 = reads2.next()
             except StopIteration:
-                out.write(read1)
+                write(read1)
                 nreads += 1
                 break
-    for read in fh1:
-        out.write(read)
+    for read in reads1:
+        write(read)
         nreads += 1
-    for read in fh2:
-        out.write(read)
+    for read in reads2:
+        write(read)
         nreads += 1
+    out.write(''.join(lines))
+    columns.write(lines)
     fh1.close()
     fh2.close()
     out.close()
+    columns.close()
     return nreads
     
-def get_intersection(fname1, fname2, out_path, verbose=False):
+def get_intersection(fname1, fname2, out_path, verbose=False,
+                     buffer_size=1000000):
     """
     Merges the two files corresponding to each reads sides. Reads found in both
        files are merged and written in an output file.
@@ -108,12 +193,19 @@ def get_intersection(fname1, fname2, out_path, verbose=False):
           - otherwise, they are merged into one longer (as if they were mapped
             in the positive strand)
 
+    If the two files were parsed with integer read IDs (read_ids option of
+    :func:`pytadbit.parsers.map_parser.parse_map`), reads are compared by ID,
+    and the output keeps the path to the file with the original read names.
+
     :param fname1: path to a tab separated file generated by the function
        :func:`pytadbit.parsers.sam_parser.parse_sam`
     :param fname2: path to a tab separated file generated by the function
        :func:`pytadbit.parsers.sam_parser.parse_sam`
     :param out_path: path to an outfile. It will written in a similar format as
-       the inputs
+       the inputs (compressed if its name ends with '.gz')
+    :param 1000000 buffer_size: number of pairs of reads kept in memory. When
+       reached, they are sorted and written to a temporary file, all temporary
+       files being merged at the end. Bounds the memory used.
 
     :returns: final number of pair of interacting fragments, and a dictionary with
        the number of multiple contacts (keys of the dictionary being the number of
@@ -124,26 +216,35 @@ def get_intersection(fname1, fname2, out_path, verbose=False):
     reads1 = magic_open(fname1)
     line1 = reads1.next()
     header1 = ''
+    ids1 = ''
     while line1.startswith('#'):
         if line1.startswith('# CRM'):
             header1 += line1
+        elif line1.startswith('# READ IDS'):
+            ids1 = line1
         line1 = reads1.next()
-    read1 = line1.split('\t', 1)[0]
 
     reads2 = magic_open(fname2)
     line2 = reads2.next()
     header2 = ''
+    ids2 = ''
     while line2.startswith('#'):
         if line2.startswith('# CRM'):
             header2 += line2
+        elif line2.startswith('# READ IDS'):
+            ids2 = line2
         line2 = reads2.next()
-    read2 = line2.split('\t', 1)[0]
     if header1 != header2:
         raise Exception('seems to be mapped onover different chromosomes\n')
+    if ids1 != ids2:
+        raise Exception('ERROR: read IDs of the two files do not match, both '
+                        'should be parsed together with read_ids\n')
+    # reads are compared by name, or by integer ID if parsed with read_ids
+    read_key = _read_id if ids1 else _read_name
+    read1 = read_key(line1)
+    read2 = read_key(line2)
 
-    # prepare to write read pairs into different files
-    # depending on genomic position
-    nchunks = 1024
+    # position of each chromosome in the genome, to sort reads
     global CHROM_START
     CHROM_START = {}
     cum_pos = 0
@@ -152,17 +253,15 @@ def get_intersection(fname1, fname2, out_path, verbose=False):
             _, _, crm, pos = line.split()
             CHROM_START[crm] = cum_pos
             cum_pos += int(pos)
-    lchunk = cum_pos / nchunks
-    buf = dict([(i, []) for i in xrange(nchunks + 1)])
-    # prepare temporary directories
+    buf = []
+    runs = []
+    # prepare temporary directory
     tmp_dir = out_path + '_tmp_files'
     mkdir(tmp_dir)
-    for i in xrange(nchunks / int(nchunks**0.5) + 1):
-        mkdir(path.join(tmp_dir, 'rep_%03d' % i))
 
     # iterate over reads in each of the two input files
-    # and store them into a dictionary and then into temporary files
-    # dicitonary ois emptied each 1 milion entries
+    # and store them into a list, sorted and written into temporary files
+    # each time it reaches buffer_size entries
     if verbose:
         print ('Getting intersection of reads 1 and reads 2:')
     count = 0
@@ -181,56 +280,111 @@ def get_intersection(fname1, fname2, out_path, verbose=False):
                     stdout.write('.')
                     stdout.flush()
                 count_dots += 1
-            for _ in xrange(1000000): # iterate 1 million times, write to files
+            for _ in xrange(1000000): # iterate 1 million times
                 # same read id in both lianes, we store put the more upstream
                 # before and store them
-                if eq_reads(read1, read2):
+                if read1 == read2:
                     count += 1
-                    _process_lines(line1, line2, buf, multiples, lchunk)
+                    _process_lines(line1, line2, buf, multiples)
                     line1 = reads1.next()
-                    read1 = line1.split('\t', 1)[0]
+                    read1 = read_key(line1)
                     line2 = reads2.next()
-                    read2 = line2.split('\t', 1)[0]
+                    read2 = read_key(line2)
+                    if len(buf) >= buffer_size:
+                        _write_run(buf, tmp_dir, runs)
                 # if first element of line1 is greater than the one of line2:
-                elif gt_reads(read1, read2):
+                elif read1 > read2:
                     line2 = reads2.next()
-                    read2 = line2.split('\t', 1)[0]
+                    read2 = read_key(line2)
                 else:
                     line1 = reads1.next()
-                    read1 = line1.split('\t', 1)[0]
-            write_to_files(buf, tmp_dir, nchunks)
+                    read1 = read_key(line1)
     except StopIteration:
         reads1.close()
         reads2.close()
-    write_to_files(buf, tmp_dir, nchunks)
     if verbose:
         print '\nFound %d pair of reads mapping uniquely' % count
 
-    # sort each tmp file according to first element (idx) and write them
-    # to output file (without the idx)
-    # sort also according to read 2 (to filter duplicates)
-    #      and also according to strand
+    # merge sorted temporary files (and last buffer) into output file, sorted
+    # by genomic coordinate of read 1, and then of read 2 (to filter
+    # duplicates), and by RE fragment
     if verbose:
-        print 'Sorting each temporary file by genomic coordinate'
-
-    out = open(out_path, 'w')
+        print 'Merging %d sorted temporary files' % (len(runs))
+    buf.sort(key=_sort_key)
+    out = magic_write(out_path)
     out.write(header1)
-    for b in buf:
-        if verbose:
-            stdout.write('\r    %4d/%d sorted files' % (b + 1, len(buf)))
-            stdout.flush()
-        out.write(''.join(['\t'.join(l[1:]) for l in sorted(
-            [l.split('\t') for l in open(
-                path.join(tmp_dir, 'rep_%03d' % (b / int(nchunks**0.5)),
-                          'tmp_%05d.tsv' % b))],
-            key=lambda x: (x[0], x[8], x[9], x[6]))]))
+    out.write(ids1)
+    columns = ReadsCacheWriter(out_path, OrderedDict(
+        (l.split()[2], int(l.split()[3])) for l in header1.split('\n') if l))
+    lines = []
+    for line in merge(*[_read_run(run) for run in _merge_runs(runs, tmp_dir)] +
+                      [((_sort_key(l), l) for l in buf)]):
+        lines.append(line[1].split('\t', 1)[1])
+        if len(lines) >= 100000:
+            out.write(''.join(lines))
+            columns.write(lines)
+            lines = []
+    out.write(''.join(lines))
+    columns.write(lines)
     out.close()
+    columns.close()
 
     if verbose:
         print '\nRemoving temporary files...'
     system('rm -rf ' + tmp_dir)
     return count, multiples
 
+
+def _sort_key(line):
+    """
+    key to sort pairs of reads (lines starting with the genomic position of
+    read 1), by position of read 1, then of read 2, and by RE fragment
+    """
+    x = line.split('\t', 8)
+    crm2, pos2, _ = x[8].split('\t', 2)
+    return int(x[0]), crm2, int(pos2), int(x[6])
+
+
+def _write_run(buf, tmp_dir, runs):
+    """
+    sorts buffered pairs of reads and writes them into a temporary file
+    """
+    fname = path.join(tmp_dir, 'run_%05d.tsv' % len(runs))
+    out = open(fname, 'w')
+    buf.sort(key=_sort_key)
+    out.write(''.join(buf))
+    out.close()
+    runs.append(fname)
+    del(buf[:])
+
+
+def _read_run(fname):
+    for line in open(fname):
+        yield _sort_key(line), line
+
+
+def _merge_runs(runs, tmp_dir, max_open=256):
+    """
+    merges sorted temporary files by groups, until there are few enough of
+    them to be opened at the same time
+
+    :returns: the list of sorted temporary files
+    """
+    while len(runs) > max_open:
+        merged = []
+        for beg in xrange(0, len(runs), max_open):
+            fname = path.join(tmp_dir, 'merged_%05d_%05d.tsv' % (
+                len(runs), beg))
+            out = open(fname, 'w')
+            for _, line in merge(*[_read_run(run)
+                                   for run in runs[beg:beg + max_open]]):
+                out.write(line)
+            out.close()
+            merged.append(fname)
+        runs = merged
+    return runs
+
+
 def _loc_reads(r1, r2):
     """
     Put upstream read before, get position in buf
@@ -242,17 +396,7 @@ def _loc_reads(r1, r2):
         pos1, pos2 = pos2, pos1
     return r1, r2, pos1
 
-def write_to_files(buf, tmp_dir, nchunks):
-    for b in buf:
-        out = open(path.join(tmp_dir, 'rep_%03d' % (b / int(nchunks**0.5)),
-                             'tmp_%05d.tsv' % b), 'a')
-        out.write('\n'.join(buf[b]))
-        if buf[b]: # case the file was empty
-            out.write('\n')
-        out.close()
-        del(buf[b][:])
-
-def _process_lines(line1, line2, buf, multiples, lchunk):
+def _process_lines(line1, line2, buf, multiples):
     # case we have potential multicontacts
     if '|||' in line1 or '|||' in line2:
         elts = {}
@@ -307,16 +451,16 @@ def _process_lines(line1, line2, buf, multiples, lchunk):
             prod_cont = contacts * (contacts + 1) / 2
             for i, (r1, r2) in enumerate(combinations(elts.values(), 2)):
                 r1, r2, idx = _loc_reads(r1, r2)
-                buf[idx / lchunk].append('%d\t%s#%d/%d\t%s\t%s' % (
+                buf.append('%d\t%s#%d/%d\t%s\t%s\n' % (
                     idx, r1[0], i + 1, prod_cont, '\t'.join(r1[1:]),
                     '\t'.join(r2[1:])))
         elif contacts == 1:
             r1, r2, idx = _loc_reads(elts.values()[0], elts.values()[1])
-            buf[idx / lchunk].append('%d\t%s\t%s' % (idx, '\t'.join(r1), '\t'.join(r2[1:])))
+            buf.append('%d\t%s\t%s\n' % (idx, '\t'.join(r1), '\t'.join(r2[1:])))
         else:
             r1, r2, idx = _loc_reads(elts1.values()[0], elts2.values()[0])
-            buf[idx / lchunk].append('%d\t%s\t%s' % (idx, '\t'.join(r1), '\t'.join(r2[1:])))
+            buf.append('%d\t%s\t%s\n' % (idx, '\t'.join(r1), '\t'.join(r2[1:])))
     else:
         r1, r2, idx = _loc_reads(line1.strip().split('\t'), line2.strip().split('\t'))
-        buf[idx / lchunk].append('%d\t%s\t%s' % (idx, '\t'.join(r1), '\t'.join(r2[1:])))
+        buf.append('%d\t%s\t%s\n' % (idx, '\t'.join(r1), '\t'.join(r2[1:])))
 
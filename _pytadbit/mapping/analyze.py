@@ -8,9 +8,12 @@ from pytadbit.utils.tadmaths      import nozero_log_matrix as nozero_log
 from pytadbit.utils.tadmaths      import right_double_mad as mad
 from warnings                     import warn
 from collections                  import OrderedDict
+from itertools                    import chain
 from pytadbit.parsers.hic_parser  import load_hic_data_from_reads
+from pytadbit.parsers.reads_cache import load_reads_cache, is_cache_fresh
+from pytadbit.parsers.hic_binary_parser import load_hic_binary, is_hic_binary
 from pytadbit.utils.extraviews    import nicer
-from pytadbit.utils.file_handling import mkdir
+from pytadbit.utils.file_handling import mkdir, magic_open
 from scipy.stats                  import norm as sc_norm, skew, kurtosis
 from scipy.stats                  import pearsonr, spearmanr, linregress
 from numpy.linalg                 import eigh
@@ -28,16 +31,19 @@ except ImportError:
 def hic_map(data, resolution=None, normalized=False, masked=None,
             by_chrom=False, savefig=None, show=False, savedata=None,
             focus=None, clim=None,  perc_clim=None, cmap='jet', pdf=False, decay=True,
-            perc=20, name=None, decay_resolution=None, **kwargs):
+            perc=20, name=None, decay_resolution=None, sparse=False,
+            compress=False, **kwargs):
     """
     function to retrieve data from HiC-data object. Data can be stored as
     a square matrix, or drawn using matplotlib
 
     :param data: can be either a path to a file with pre-processed reads
-       (filtered or not), or a Hi-C-data object
+       (filtered or not), a path to a TADbit binary matrix, or a Hi-C-data
+       object
     :param None resolution: at which to bin the data (try having a dense matrix
        with < 10% of cells with zero interaction counts). Note: not necessary
-       if a hic_data object is passed as 'data'.
+       if a hic_data object is passed as 'data'. In the case of a binary matrix
+       storing several resolutions, the one to be loaded (by default the finest)
     :param False normalized: used normalized data, based on precalculated biases
     :param masked: a list of columns to be removed. Usually because to few
        interactions
@@ -75,8 +81,20 @@ def hic_map(data, resolution=None, normalized=False, masked=None,
     :param None decay_resolution: chromatin fragment size to consider when
        calculating decay of the number of interactions with genomic distance.
        Default is equal to resolution of the matrix.
+    :param False sparse: store only the non-zero cells of the matrices (see
+       :func:`pytadbit.hic_data.HiC_data.write_matrix`)
+    :param False compress: gzip the stored matrices (in the case of the
+       by_chrom option, '.gz' is appended to the file names)
     """
-    if isinstance(data, str):
+    if isinstance(data, str) and is_hic_binary(data):
+        # only the chromosomes needed are read from the binary file
+        crms = None
+        if isinstance(focus, str):
+            crms = focus
+        elif focus and all(isinstance(f, str) for f in focus):
+            crms = list(focus)
+        data = load_hic_binary(data, focus=crms, resolution=resolution)
+    elif isinstance(data, str):
         data = load_hic_data_from_reads(data, resolution=resolution, **kwargs)
         if not kwargs.get('get_sections', True) and decay:
             warn('WARNING: not decay not available when get_sections is off.')
@@ -124,10 +142,12 @@ def hic_map(data, resolution=None, normalized=False, masked=None,
                                 if j in masked2:
                                     subdata[i][j] = float('nan')
                     if savedata:
-                        hic_data.write_matrix('%s/%s.mat' % (
-                            savedata, '_'.join(set((crm1, crm2)))),
+                        hic_data.write_matrix('%s/%s.mat%s' % (
+                            savedata, '_'.join(set((crm1, crm2))),
+                            '.gz' if compress else ''),
                                               focus=(crm1, crm2),
-                                              normalized=normalized)
+                                              normalized=normalized,
+                                              sparse=sparse, compress=compress)
                     if show or savefig:
                         if (len(subdata) > 10000
                             and not kwargs.get('force_image', False)):
@@ -154,7 +174,8 @@ def hic_map(data, resolution=None, normalized=False, masked=None,
     else:
         if savedata:
             hic_data.write_matrix(savedata, focus=focus,
-                                  normalized=normalized)
+                                  normalized=normalized, sparse=sparse,
+                                  compress=compress)
         if show or savefig:
             subdata = hic_data.get_matrix(focus=focus, normalized=normalized)
             if (len(subdata) > 10000 and not kwargs.get('force_image', False)):
@@ -392,10 +413,27 @@ def plot_distance_vs_interactions(data, min_diff=1, max_diff=1000, show=False,
     :returns: slope, intercept and R square of each of the 3 correlations
     """
     resolution = resolution or 1
-    if isinstance(data, str):
+    if isinstance(data, str) and is_cache_fresh(data):
+        cols = load_reads_cache(data)[1]
+        ps1 = np.asarray(cols['pos1']) / resolution
+        ps2 = np.asarray(cols['pos2']) / resolution
+        diff = np.abs(ps1 - ps2)
+        keep = ((np.asarray(cols['crm1']) == np.asarray(cols['crm2'])) &
+                (diff < max_diff) & (diff >= min_diff))
+        nbins = ps1.max() + 1 if len(ps1) else 1
+        cells, counts = np.unique(diff[keep] * nbins + ps1[keep],
+                                  return_counts=True)
+        dist_intr = dict([(i, {}) for i in xrange(min_diff, max_diff)])
+        for diff, bin1, count in zip(*[v.tolist() for v in np.divmod(
+            cells, nbins) + (counts, )]):
+            dist_intr[diff][bin1] = float(count)
+        for diff in dist_intr:
+            dist_intr[diff] = [dist_intr[diff].get(k, 0)
+                               for k in xrange(max(dist_intr[diff]) - diff)]
+    elif isinstance(data, str):
         dist_intr = dict([(i, {})
                           for i in xrange(min_diff, max_diff)])
-        fhandler = open(data)
+        fhandler = magic_open(data)
         line = fhandler.next()
         while line.startswith('#'):
             line = fhandler.next()
@@ -612,7 +650,7 @@ def plot_iterative_mapping(fnam1, fnam2, total_reads=None, axe=None, savefig=Non
     colors = ['olive', 'darkcyan']
     iteration = False
     for i, fnam in enumerate([fnam1, fnam2]):
-        fhandler = open(fnam)
+        fhandler = magic_open(fnam)
         line = fhandler.next()
         count_by_len[i] = {}
         while line.startswith('#'):
@@ -657,6 +695,28 @@ def plot_iterative_mapping(fnam1, fnam2, total_reads=None, axe=None, savefig=Non
     return count_by_len
 
 
+def _dangling_ends_sizes(fnam, nreads=None):
+    """
+    :returns: the list of distances between the reads of each dangling-end
+    """
+    fhandler = magic_open(fnam)
+    line = fhandler.readline()
+    while line.startswith('#'):
+        line = fhandler.readline()
+    des = []
+    for line in chain([line] if line else [], fhandler):
+        (crm1, pos1, dir1, _, re1, _,
+         crm2, pos2, dir2, _, re2) = line.strip().split('\t')[1:12]
+        if re1==re2 and crm1 == crm2 and dir1 != dir2:
+            pos1, pos2 = int(pos1), int(pos2)
+            if (pos2 > pos1) == int(dir1):
+                des.append(abs(pos2 - pos1))
+            if len(des) == nreads:
+                break
+    fhandler.close()
+    return des
+
+
 def insert_sizes(fnam, savefig=None, nreads=None, max_size=99.9, axe=None,
                  show=False, xlog=False, stats=('median', 'perc_max'),
                  too_large=10000):
@@ -680,33 +740,22 @@ def insert_sizes(fnam, savefig=None, nreads=None, max_size=99.9, axe=None,
 
     :returns: the median value and the percentile inputed as max_size.
     """
-    distr = {}
-    genome_seq = OrderedDict()
-    pos = 0
-    fhandler = open(fnam)
-    for line in fhandler:
-        if line.startswith('#'):
-            if line.startswith('# CRM '):
-                crm, clen = line[6:].split('\t')
-                genome_seq[crm] = int(clen)
-        else:
-            break
-        pos += len(line)
-    fhandler.seek(pos)
-    des = []
     if nreads:
         nreads /= 2
-    for line in fhandler:
-        (crm1, pos1, dir1, _, re1, _,
-         crm2, pos2, dir2, _, re2) = line.strip().split('\t')[1:12]
-        if re1==re2 and crm1 == crm2 and dir1 != dir2:
-            pos1, pos2 = int(pos1), int(pos2)
-            if (pos2 > pos1) == int(dir1):
-                des.append(abs(pos2 - pos1))
-            if len(des) == nreads:
-                break
+    cached = load_reads_cache(fnam)
+    if cached is not None:
+        cols = cached[1]
+        pos1 = np.asarray(cols['pos1'])
+        pos2 = np.asarray(cols['pos2'])
+        dir1 = np.asarray(cols['strand1'])
+        des = ((np.asarray(cols['beg1']) == np.asarray(cols['beg2'])) &
+               (np.asarray(cols['crm1']) == np.asarray(cols['crm2'])) &
+               (dir1 != np.asarray(cols['strand2'])) &
+               ((pos2 > pos1) == dir1))
+        des = np.abs(pos2[des] - pos1[des])[:nreads].tolist()
+    else:
+        des = _dangling_ends_sizes(fnam, nreads)
     des = [i for i in des if i <= too_large]
-    fhandler.close()
     max_perc = np.percentile(des, max_size)
     perc99   = np.percentile(des, 99)
     perc01   = np.percentile(des, 1)
@@ -795,22 +844,19 @@ def plot_genomic_distribution(fnam, first_read=True, resolution=10000,
         cond2 = lambda x: False
     cond = lambda x, y: cond1(x) and cond2(y)
     count = 0
-    pos = 0
-    fhandler = open(fnam)
-    for line in fhandler:
-        if line.startswith('#'):
-            if line.startswith('# CRM '):
-                crm, clen = line[6:].split('\t')
-                genome_seq[crm] = int(clen)
-        else:
-            break
-        pos += len(line)
-    fhandler.seek(pos)
-    for line in fhandler:
+    fhandler = magic_open(fnam)
+    line = fhandler.readline()
+    while line.startswith('#'):
+        if line.startswith('# CRM '):
+            crm, clen = line[6:].split('\t')
+            genome_seq[crm] = int(clen)
+        line = fhandler.readline()
+    lines = chain([line] if line else [], fhandler)
+    for line in lines:
         crm, pos = line.strip().split('\t')[idx1:idx2]
         count += 1
         if cond(crm, count):
-            line = fhandler.next()
+            line = lines.next()
             if cond2(count):
                 break
             continue
@@ -1077,7 +1123,7 @@ def plot_rsite_reads_distribution(reads_file, outprefix, window=20,
     de_right={}
     de_left={}
     print "process reads"
-    fl=open(reads_file)
+    fl=magic_open(reads_file)
     while True:
         line=fl.next()
         if not line.startswith('#'):
@@ -1177,7 +1223,7 @@ def plot_diagonal_distributions(reads_file, outprefix, ma_window=20,
     rejoined={}
     des={}
     print "process reads"
-    fl=open(reads_file)
+    fl=magic_open(reads_file)
     while True:
         line=fl.next()
         if not line.startswith('#'):
@@ -1324,13 +1370,11 @@ def plot_strand_bias_by_distance(fnam, nreads=None, half_step=20, half_len=2000,
     :param None savefig: path where to store the output images.
     """
 
-    fhandler = open(fnam)
-    pos = 0
-    for line in fhandler:
-        if not line.startswith('#'):
-            break
-        pos += len(line)
-    fhandler.seek(pos)
+    fhandler = magic_open(fnam)
+    line = fhandler.readline()
+    while line.startswith('#'):
+        line = fhandler.readline()
+    fhandler = chain([line] if line else [], fhandler)
 
     max_len = 100000
     dirs = [[0 for i in range(max_len)],
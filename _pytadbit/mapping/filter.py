@@ -4,15 +4,26 @@
 
 """
 from pytadbit.mapping.restriction_enzymes import count_re_fragments
+from pytadbit.parsers.reads_cache         import ReadsCacheWriter
+from pytadbit.parsers.reads_cache         import load_reads_cache, _stamp
+from collections                          import OrderedDict
+from shutil                               import copyfileobj
+from array                                import array
+from itertools                            import compress, chain
+from pytadbit.utils.file_handling         import magic_open, magic_write
+from pytadbit.utils.file_handling         import is_compressed
 import multiprocessing as mu
+import os
+import numpy as np
 
 def apply_filter(fnam, outfile, masked, filters=None, reverse=False, 
-                 verbose=True):
+                 verbose=True, include=None):
     """
     Create a new file with reads filtered
 
     :param fnam: input file path, where non-filtered read are stored
     :param outfile: output file path, where filtered read will be stored
+       (compressed if its name ends with '.gz')
     :param masked: dictionary given by the
        :func:`pytadbit.mapping.filter.filter_reads`
     :param None filters: list of numbers corresponding to the filters we want
@@ -20,10 +31,22 @@ def apply_filter(fnam, outfile, masked, filters=None, reverse=False,
     :param False reverse: if set, the resulting outfile will only contain the
        reads filtered, not the valid pairs.
     :param False verbose:
+    :param None include: list of numbers corresponding to filters, only reads
+       caught by one of them are kept (before applying the other filters).
+       Requires the bitmask written by
+       :func:`pytadbit.mapping.filter.filter_reads`, and that fnam was not
+       modified since then
 
     :returns: number of reads kept
     """
     filters = filters or masked.keys()
+    bitmask = masked[filters[0]].get('bitmask') if filters else None
+    if bitmask and is_bitmask_fresh(fnam, bitmask):
+        return _apply_bitmask(fnam, outfile, bitmask, filters, reverse,
+                              include, verbose)
+    if include:
+        raise Exception('ERROR: no bitmask found for %s, include needs one\n'
+                        % fnam)
     filter_names = []
     filter_handlers = {}
     for k in filters:
@@ -34,17 +57,21 @@ def apply_filter(fnam, outfile, masked, filters=None, reverse=False,
         except StopIteration:
             pass
 
-    out = open(outfile, 'w')
-    fhandler = open(fnam)
+    out = magic_write(outfile)
+    fhandler = magic_open(fnam)
     # get the header
-    pos = 0
+    crm_lengths = OrderedDict()
     while True:
         line = next(fhandler)
         if not line.startswith('#'):
             break
-        pos += len(line)
+        if line.startswith('# CRM '):
+            crm, clen = line[6:].split()
+            crm_lengths[crm] = int(clen)
         out.write(line)
-    fhandler.seek(pos)
+    fhandler = chain([line], fhandler)
+    columns = ReadsCacheWriter(outfile, crm_lengths)
+    kept = []
 
     current = set([v for v, _ in filter_handlers.values()])
     count = 0
@@ -54,6 +81,10 @@ def apply_filter(fnam, outfile, masked, filters=None, reverse=False,
             if read in current:
                 count += 1
                 out.write(line)
+                kept.append(line)
+                if len(kept) >= 1000000:
+                    columns.write(kept)
+                    kept = []
             else:
                 continue
             # iterate over different filters to update current filters
@@ -71,6 +102,10 @@ def apply_filter(fnam, outfile, masked, filters=None, reverse=False,
             if read not in current:
                 count += 1
                 out.write(line)
+                kept.append(line)
+                if len(kept) >= 1000000:
+                    columns.write(kept)
+                    kept = []
                 continue
             # iterate over different filters to update current filters
             for k in filter_handlers.keys():
@@ -85,12 +120,103 @@ def apply_filter(fnam, outfile, masked, filters=None, reverse=False,
         print '    saving to file %d reads %s %s.' % (
             count, 'with' if reverse else 'without', ', '.join(filter_names))
     out.close()
+    columns.write(kept)
+    columns.close()
     return count
 
+def _write_bitmask_stamp(fnam, bitmask):
+    """
+    Stores, next to the bitmask, the size and modification time of the file
+    of reads it was computed from
+    """
+    out = open(bitmask + '_stamp', 'w')
+    out.write(_stamp(fnam))
+    out.close()
+
+
+def is_bitmask_fresh(fnam, bitmask):
+    """
+    :param fnam: path to the file with pairs of reads
+    :param bitmask: path to the bitmask written by :func:`filter_reads`
+
+    :returns: True if the bitmask exists and was computed from the current
+       content of fnam
+    """
+    try:
+        return open(bitmask + '_stamp').read() == _stamp(fnam)
+    except (IOError, OSError):
+        return False
+
+
+def _filters_mask(bitmask, filters=None, include=None, reverse=False):
+    """
+    :param bitmask: path to the bitmask written by :func:`filter_reads`
+    :param None filters: list of filters to apply (reads caught by any of them
+       are removed)
+    :param None include: list of filters, only reads caught by one of them are
+       kept
+    :param False reverse: keep only reads caught by filters, instead of
+       removing them
+
+    :returns: a boolean array with, for each read, whether to keep it
+    """
+    flags = np.fromfile(bitmask, dtype=np.uint16)
+    caught = (flags & sum(1 << (k - 1) for k in filters or [])) != 0
+    keep = caught if reverse else ~caught
+    if include:
+        keep &= (flags & sum(1 << (k - 1) for k in include)) != 0
+    return keep
+
+
+def _apply_bitmask(fnam, outfile, bitmask, filters, reverse, include,
+                   verbose):
+    """
+    Same as :func:`apply_filter`, selecting reads to keep with the bitmask
+    written by :func:`filter_reads`
+    """
+    keep = _filters_mask(bitmask, filters, include, reverse)
+    out = magic_write(outfile)
+    fhandler = magic_open(fnam)
+    # get the header
+    crm_lengths = OrderedDict()
+    line = fhandler.readline()
+    while line.startswith('#'):
+        if line.startswith('# CRM '):
+            crm, clen = line[6:].split()
+            crm_lengths[crm] = int(clen)
+        out.write(line)
+        line = fhandler.readline()
+    lines = chain([line] if line else [], fhandler)
+    columns = ReadsCacheWriter(outfile, crm_lengths)
+    cached = load_reads_cache(fnam)
+    if cached is not None and len(cached[1]['pos1']) == len(keep):
+        out.writelines(compress(lines, keep.tolist()))
+        columns.write_columns(dict((col, vals[keep])
+                                   for col, vals in cached[1].iteritems()))
+    else:
+        kept = []
+        for line in compress(lines, keep.tolist()):
+            out.write(line)
+            kept.append(line)
+            if len(kept) >= 1000000:
+                columns.write(kept)
+                kept = []
+        columns.write(kept)
+    fhandler.close()
+    out.close()
+    columns.close()
+    count = int(keep.sum())
+    if verbose:
+        print '    saving to file %d reads %s filters %s.' % (
+            count, 'with' if reverse else 'without',
+            ', '.join(str(k) for k in filters))
+    return count
+
+
 def filter_reads(fnam, output=None, max_molecule_length=500,
                  over_represented=0.005, max_frag_size=100000,
                  min_frag_size=100, re_proximity=5, verbose=True,
-                 savedata=None, min_dist_to_re=750, fast=True):
+                 savedata=None, min_dist_to_re=750, fast=True, ncpus=4):
     """
     Filter mapped pair of reads in order to remove experimental artifacts (e.g.
     dangling-ends, self-circle, PCR artifacts...)
@@ -140,11 +266,21 @@ def filter_reads(fnam, output=None, max_molecule_length=500,
        from a RE site (usually 1.5 times the insert size). Applied in filter 10
     :param None savedata: PATH where to write the number of reads retained by
        each filter
-    :param True fast: parallel version, requires 4 CPUs and more RAM memory
+    :param True fast: parallel version, all filters are computed in a single
+       pass over the input file, split in chunks processed in parallel
+    :param 4 ncpus: number of CPUs used by the parallel version
 
     :return: dicitonary with, as keys, the kind of filter applied, and as values
        a set of read IDs to be removed
 
+    Besides the files with the IDs of the reads caught by each filter, a
+    binary file (output + '_filters.bin', stored under the key 'bitmask' of
+    each filter) contains, for each pair of reads of fnam and in the same
+    order, an unsigned 16 bit integer where the bit k - 1 is set if the
+    pair was caught by filter k. The size and modification time of fnam are
+    stored in output + '_filters.bin_stamp', the bitmask is only used while
+    they match (see :func:`is_bitmask_fresh`).
+
     *Note: Filtering is not exclusive, one read can be filtered several times.*
     """
 
@@ -165,23 +301,11 @@ def filter_reads(fnam, output=None, max_molecule_length=500,
         if verbose:
             print 'filtering over representeds'
         masked.update(_filter_over_represented(fnam, over_represented, output))
+        _bitmask_from_files(fnam, masked, output + '_filters.bin')
     else:
-        pool = mu.Pool(4)
-        a = pool.apply_async(_filter_same_frag,
-                             args=(fnam, max_molecule_length, output))
-        b = pool.apply_async(_filter_from_res,
-                             args=(fnam, max_frag_size, min_dist_to_re,
-                                   re_proximity, min_frag_size, output))
-        c = pool.apply_async(_filter_over_represented,
-                             args=(fnam, over_represented, output))
-        d = pool.apply_async(_filter_duplicates,
-                             args=(fnam,output))
-        pool.close()
-        pool.join()
-        masked, total = d.get()
-        masked.update(b.get())
-        masked.update(c.get())
-        masked.update(a.get())
+        masked, total = _filter_all(fnam, max_molecule_length, max_frag_size,
+                                    min_dist_to_re, re_proximity, min_frag_size,
+                                    over_represented, output, ncpus=ncpus)
 
     # if savedata or verbose:
     #     bads = len(frozenset().union(*[masked[k]['reads'] for k in masked]))
@@ -205,6 +329,288 @@ def filter_reads(fnam, output=None, max_molecule_length=500,
         #         total) * 100)
     return masked
 
+FILTERS = OrderedDict([(1 , 'self-circle'       ),
+                       (2 , 'dangling-end'      ),
+                       (3 , 'error'             ),
+                       (4 , 'extra dangling-end'),
+                       (5 , 'too close from RES'),
+                       (6 , 'too short'         ),
+                       (7 , 'too large'         ),
+                       (8 , 'over-represented'  ),
+                       (9 , 'duplicated'        ),
+                       (10, 'random breaks'     )])
+
+
+def _bitmask_from_files(fnam, masked, bitmask):
+    """
+    Writes the bitmask of the filters catching each read (see
+    :func:`filter_reads`) from the files with the IDs of the reads caught by
+    each filter.
+    """
+    flags = array('H')
+    filter_handlers = {}
+    for k in masked:
+        fh = open(masked[k]['fnam'])
+        filter_handlers[k] = [fh.readline().strip(), fh]
+    fhandler = magic_open(fnam)
+    for line in fhandler:
+        if line.startswith('#'):
+            continue
+        read = line.split('\t', 1)[0]
+        flag = 0
+        for k in filter_handlers:
+            if filter_handlers[k][0] == read:
+                flag |= 1 << (k - 1)
+                filter_handlers[k][0] = filter_handlers[k][1].readline().strip()
+        flags.append(flag)
+    fhandler.close()
+    for k in filter_handlers:
+        filter_handlers[k][1].close()
+    out = open(bitmask, 'wb')
+    flags.tofile(out)
+    out.close()
+    _write_bitmask_stamp(fnam, bitmask)
+    for k in masked:
+        masked[k]['bitmask'] = bitmask
+
+
+def _line_chunks(fnam, nchunks):
+    """
+    Splits a file of pairs of reads into byte ranges starting at the beginning
+    of a line (the header is skipped). Compressed files are not split.
+
+    :returns: a list of (start, end) byte positions, end being None for
+       compressed files
+    """
+    if is_compressed(fnam):
+        return [(0, None)]
+    fhandler = open(fnam)
+    beg = 0
+    for line in iter(fhandler.readline, ''):
+        if not line.startswith('#'):
+            break
+        beg += len(line)
+    end = os.path.getsize(fnam)
+    bounds = [beg]
+    for i in xrange(1, nchunks):
+        pos = beg + (end - beg) * i / nchunks
+        if pos <= bounds[-1]:
+            continue
+        fhandler.seek(pos - 1)
+        pos += len(fhandler.readline()) - 1  # go to the start of next line
+        if bounds[-1] < pos < end:
+            bounds.append(pos)
+    fhandler.close()
+    bounds.append(end)
+    return zip(bounds[:-1], bounds[1:])
+
+
+def _chunk_lines(fnam, beg, end):
+    """
+    iterates over the lines of a file between two byte positions (or over all
+    the lines after the header if end is None)
+    """
+    if end is None:
+        fhandler = magic_open(fnam)
+        line = fhandler.readline()
+        while line.startswith('#'):
+            line = fhandler.readline()
+        if line:
+            yield line
+        for line in fhandler:
+            yield line
+        fhandler.close()
+        return
+    fhandler = open(fnam)
+    fhandler.seek(beg)
+    for line in iter(fhandler.readline, ''):
+        if beg >= end:
+            break
+        beg += len(line)
+        yield line
+    fhandler.close()
+
+
+def _count_frags_chunk(fnam, beg, end):
+    """
+    counts the number of reads per RE fragment, as
+    :func:`pytadbit.mapping.restriction_enzymes.count_re_fragments`, in a
+    chunk of a file
+    """
+    frag_count = {}
+    for line in _chunk_lines(fnam, beg, end):
+        _, cr1, _, _, _, rs1, _, cr2, _, _, _, rs2, _ = line.split('\t')
+        frag_count[(cr1, rs1)] = frag_count.get((cr1, rs1), 0) + 1
+        frag_count[(cr2, rs2)] = frag_count.get((cr2, rs2), 0) + 1
+    return frag_count
+
+
+def _filter_chunk(fnam, beg, end, max_molecule_length, max_frag_size,
+                  min_dist_to_re, re_proximity, min_frag_size, bad_frags,
+                  output):
+    """
+    Applies all filters to a chunk of a file of pairs of reads, writing the
+    IDs of the filtered reads in temporary files (one per filter), and the
+    bitmask of the filters catching each read (see :func:`filter_reads`).
+
+    :returns: the number of reads caught by each filter, the total number of
+       reads, and the ID and coordinates of the first and of the last pair of
+       reads of the chunk (to find duplicates between consecutive chunks)
+    """
+    counts = dict((k, 0) for k in FILTERS)
+    outfil = dict((k, open('%s_%s.tsv_%d' % (
+        output, FILTERS[k].replace(' ', '_'), beg), 'w')) for k in FILTERS)
+    flags = array('H')
+    total = 0
+    first = None
+    prev_elts = None
+    for line in _chunk_lines(fnam, beg, end):
+        (read,
+         cr1, pos1, sd1, _, rs1, re1,
+         cr2, pos2, sd2, _, rs2, re2) = line.split('\t')
+        re2 = re2.rstrip()
+        total += 1
+        flag = 0
+        # duplicates (reads are sorted by coordinates)
+        new_elts = cr1, pos1, cr2, pos2, sd1, sd2
+        if first is None:
+            first = read, new_elts
+        elif prev_elts == new_elts:
+            flag |= 1 << 8
+        prev_elts = new_elts
+        # over-represented
+        if (cr1, rs1) in bad_frags or (cr2, rs2) in bad_frags:
+            flag |= 1 << 7
+        ps1, ps2, sd1, sd2 = int(pos1), int(pos2), int(sd1), int(sd2)
+        # same fragment
+        if cr1 == cr2:
+            if re1 == re2:
+                if sd1 != sd2:
+                    if (ps2 > ps1) == sd2:
+                        # ----<===---===>---                   self-circles
+                        flag |= 1 << 0
+                    else:
+                        # ----===>---<===---                   dangling-ends
+                        flag |= 1 << 1
+                else:
+                    # --===>--===>-- or --<===--<===-- or same errors
+                    flag |= 1 << 2
+            elif (abs(ps1 - ps2) < max_molecule_length
+                  and sd2 != sd1
+                  and (ps2 > ps1) != sd2):
+                # different fragments but facing and very close
+                flag |= 1 << 3
+        # distance to RE sites
+        re1, rs1, re2, rs2 = int(re1), int(rs1), int(re2), int(rs2)
+        diff11 = re1 - ps1
+        diff12 = ps1 - rs1
+        diff21 = re2 - ps2
+        diff22 = ps2 - rs2
+        if ((diff11 < re_proximity) or
+            (diff12 < re_proximity) or
+            (diff21 < re_proximity) or
+            (diff22 < re_proximity)):
+            # multicontacts excluded if fragment is internal (not the first)
+            if not '~' in read:
+                flag |= 1 << 4
+        if (((diff11 > min_dist_to_re) and
+             (diff12 > min_dist_to_re)) or
+            ((diff21 > min_dist_to_re) and
+             (diff22 > min_dist_to_re))):
+            flag |= 1 << 9
+        dif1 = re1 - rs1
+        dif2 = re2 - rs2
+        if (dif1 < min_frag_size) or (dif2 < min_frag_size):
+            flag |= 1 << 5
+        if (dif1 > max_frag_size) or (dif2 > max_frag_size):
+            flag |= 1 << 6
+        flags.append(flag)
+        if flag:
+            for k in FILTERS:
+                if flag & (1 << (k - 1)):
+                    counts[k] += 1
+                    outfil[k].write(read + '\n')
+    for k in outfil:
+        outfil[k].close()
+    out = open('%s_filters.bin_%d' % (output, beg), 'wb')
+    flags.tofile(out)
+    out.close()
+    return counts, total, first, prev_elts
+
+
+def _filter_all(fnam, max_molecule_length, max_frag_size, min_dist_to_re,
+                re_proximity, min_frag_size, over_represented, output,
+                ncpus=4):
+    """
+    Computes all filters in a single pass over the file of pairs of reads
+    (plus a first one to count reads per RE fragment). The file is split into
+    chunks processed in parallel.
+
+    :returns: the same dictionary as :func:`filter_reads`, and the total
+       number of pairs of reads
+    """
+    chunks = _line_chunks(fnam, ncpus * 4)
+    pool = mu.Pool(ncpus)
+    # count reads per RE fragment, to find over-represented ones
+    jobs = [pool.apply_async(_count_frags_chunk, args=(fnam, beg, end))
+            for beg, end in chunks]
+    frag_count = {}
+    for job in jobs:
+        for frag, count in job.get().iteritems():
+            frag_count[frag] = frag_count.get(frag, 0) + count
+    num_frags = len(frag_count)
+    cut = int((1 - over_represented) * num_frags + 0.5)
+    # use cut-1 because it represents the length of the list
+    cut = sorted(frag_count.values())[cut - 1]
+    bad_frags = set(frag for frag, count in frag_count.iteritems()
+                    if count > cut)
+    del frag_count
+    # apply all other filters
+    jobs = [pool.apply_async(_filter_chunk, args=(
+        fnam, beg, end, max_molecule_length, max_frag_size, min_dist_to_re,
+        re_proximity, min_frag_size, bad_frags, output))
+            for beg, end in chunks]
+    pool.close()
+    masked = dict((k, {'name': FILTERS[k], 'reads': 0,
+                       'fnam': '%s_%s.tsv' % (
+                           output, FILTERS[k].replace(' ', '_'))})
+                  for k in FILTERS)
+    outfil = dict((k, open(masked[k]['fnam'], 'w')) for k in FILTERS)
+    bitmask = open(output + '_filters.bin', 'wb')
+    total = 0
+    last = None
+    for (beg, _), job in zip(chunks, jobs):
+        counts, chunk_total, first, chunk_last = job.get()
+        total += chunk_total
+        flags = np.fromfile('%s_filters.bin_%d' % (output, beg),
+                            dtype=np.uint16)
+        os.remove('%s_filters.bin_%d' % (output, beg))
+        # duplicate between the last read of previous chunk and the first of
+        # this one
+        if first and last is not None and first[1] == last:
+            counts[9] += 1
+            outfil[9].write(first[0] + '\n')
+            flags[0] |= 1 << 8
+        flags.tofile(bitmask)
+        last = chunk_last if chunk_total else last
+        for k in FILTERS:
+            masked[k]['reads'] += counts[k]
+            tmp_name = '%s_%s.tsv_%d' % (output, FILTERS[k].replace(' ', '_'),
+                                         beg)
+            tmp_fh = open(tmp_name)
+            copyfileobj(tmp_fh, outfil[k])
+            tmp_fh.close()
+            os.remove(tmp_name)
+    pool.join()
+    for k in outfil:
+        outfil[k].close()
+    bitmask.close()
+    _write_bitmask_stamp(fnam, output + '_filters.bin')
+    for k in masked:
+        masked[k]['bitmask'] = output + '_filters.bin'
+    return masked, total
+
+
 def _filter_same_frag(fnam, max_molecule_length, output):
     # t0 = time()
     masked = {1 : {'name': 'self-circle'       , 'reads': 0}, 
@@ -215,7 +621,7 @@ def _filter_same_frag(fnam, max_molecule_length, output):
     for k in masked:
         masked[k]['fnam'] = output + '_' + masked[k]['name'].replace(' ', '_') + '.tsv'
         outfil[k] = open(masked[k]['fnam'], 'w')
-    fhandler = open(fnam)
+    fhandler = magic_open(fnam)
     line = fhandler.next()
     while line.startswith('#'):
         line = fhandler.next()
@@ -262,7 +668,7 @@ def _filter_duplicates(fnam, output):
     for k in masked:
         masked[k]['fnam'] = output + '_' + masked[k]['name'].replace(' ', '_') + '.tsv'
         outfil[k] = open(masked[k]['fnam'], 'w')
-    fhandler = open(fnam)
+    fhandler = magic_open(fnam)
     line = fhandler.next()
     while line.startswith('#'):
         line = fhandler.next()
@@ -270,6 +676,7 @@ def _filter_duplicates(fnam, output):
      cr1, pos1, sd1, _ , _, _,
      cr2, pos2, sd2, _ , _, _) = line.split('\t')
     prev_elts = cr1, pos1, cr2, pos2, sd1, sd2
+    total += 1
     for line in fhandler:
         (read,
          cr1, pos1, sd1, _ , _, _,
@@ -297,7 +704,7 @@ def _filter_from_res(fnam, max_frag_size, min_dist_to_re,
     for k in masked:
         masked[k]['fnam'] = output + '_' + masked[k]['name'].replace(' ', '_') + '.tsv'
         outfil[k] = open(masked[k]['fnam'], 'w')
-    fhandler = open(fnam)
+    fhandler = magic_open(fnam)
     line = fhandler.next()
     while line.startswith('#'):
         line = fhandler.next()
@@ -354,7 +761,7 @@ def _filter_over_represented(fnam, over_represented, output):
     for k in masked:
         masked[k]['fnam'] = output + '_' + masked[k]['name'].replace(' ', '_') + '.tsv'
         outfil[k] = open(masked[k]['fnam'], 'w')
-    fhandler = open(fnam)
+    fhandler = magic_open(fnam)
     line = fhandler.next()
     while line.startswith('#'):
         line = fhandler.next()
@@ -391,7 +798,7 @@ def _filter_yannick(fnam, maxlen, de_left, de_right, output):
     for k in masked:
         masked[k]['fnam'] = output + '_' + masked[k]['name'].replace(' ', '_') + '.tsv'
         outfil[k] = open(masked[k]['fnam'], 'w')
-    fhandler = open(fnam)
+    fhandler = magic_open(fnam)
     line = fhandler.next()
     while line.startswith('#'):
         line = fhandler.next()
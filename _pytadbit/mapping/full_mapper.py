@@ -7,133 +7,49 @@ import os
 from pytadbit.utils.file_handling import mkdir, which
 from warnings import warn
 from pytadbit.utils.file_handling import magic_open, get_free_space_mb
-from pytadbit.mapping.restriction_enzymes import RESTRICTION_ENZYMES, religated
-from tempfile import gettempdir, mkstemp
+from pytadbit.mapping.restriction_enzymes import RESTRICTION_ENZYMES, religateds
+from tempfile import gettempdir, mkstemp, TemporaryFile
 from subprocess import CalledProcessError, PIPE, Popen
+from collections import deque
+from itertools import islice, izip
+from re import compile
+from threading import Thread
+import multiprocessing as mu
 
 def transform_fastq(fastq_path, out_fastq, trim=None, r_enz=None, add_site=True,
                     min_seq_len=15, fastq=True, verbose=True,
-                    light_storage=False, **kwargs):
+                    light_storage=False, ncpus=1, reads_per_block=100000,
+                    **kwargs):
     """
     Given a FASTQ file it can split it into chunks of a given number of reads,
     trim each read according to a start/end positions or split them into
     restriction enzyme fragments
 
+    :param None r_enz: name of the restriction enzyme used in the experiment,
+       or list of names in the case of multiple digestions (ligation sites
+       are then searched for all the combinations of enzymes)
     :param True add_site: when splitting the sequence by ligated sites found,
        removes the ligation site, and put back the original RE site.
+    :param 1 ncpus: number of processes used to transform the reads. Blocks of
+       reads are transformed in parallel and written in the original order
+    :param 100000 reads_per_block: number of reads sent at a time to each
+       process
 
     """
     skip = kwargs.get('skip', False)
-    ## define local functions to process reads and sequences
-    def _get_fastq_read_heavy(rlines):
-        """
-        returns header and sequence of 1 FASTQ entry
-        Note: header also contains the sequence
-        """
-        rlines = rlines.rstrip('\n').split()[0][1:]
-        seq = fhandler.next()
-        _   = fhandler.next()  # lose qualities header but not needed
-        qal = fhandler.next()  # lose qualities but not needed
-        # header now also contains original read
-        return (rlines + ' ' + seq.strip() + ' ' + qal.strip(),
-                seq.strip(), qal.strip())
-
-    def _get_fastq_read_light(rlines):
-        """
-        returns header and sequence of 1 FASTQ entry
-        Note: header also contains the sequence
-        """
-        rlines = rlines.rstrip('\n').split()[0][1:]
-        seq = fhandler.next()
-        _   = fhandler.next()  # lose qualities header but not needed
-        qal = fhandler.next()  # lose qualities but not needed
-        return (rlines, seq.strip(), qal.strip())
-
-    def _get_map_read_heavy(line):
-        header = line.split('\t', 1)[0]
-        seq, qal    = header.rsplit(' ', 2)[-2:]
-        return header, seq, qal
-
-    def _get_map_read_light(line):
-        header, seq, qal, _ = line.split('\t', 3)
-        return header, seq, qal
 
-    def _split_read_re(seq, qal, pattern, max_seq_len=None, site='', cnt=0):
-        """
-        Recursive generator that splits reads according to the
-        predefined restriction enzyme.
-        RE fragments yielded are followed and preceded by the RE site if a
-        ligation site was found after the fragment.
-
-        EXAMPLE:
-
-           seq = '-------oGATCo========oGATCGATCo_____________oGATCGATCo~~~~~~~~~~~~'
-           qal = 'xxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxx'
-
-        should yield these fragments:
-
-            -------oGATCo========oGATC
-            xxxxxxxxxxxxxxxxxxxxxxHHHH
-
-            GATCo_____________oGATC
-            HHHHxxxxxxxxxxxxxxxHHHH
-
-            GATCo~~~~~~~~~~~~
-            HHHHxxxxxxxxxxxxx
-
-        """
-        cnt += 1
-        try:
-            pos = seq.index(pattern)
-        except ValueError:
-            if len(seq) == max_seq_len:
-                raise ValueError
-            if len(seq) > min_seq_len:
-                yield seq, qal, cnt
-            return
-        xqal = ('H' * len(site))
-        if pos < min_seq_len:
-            split_read(site + seq[pos + len_relg:],
-                       xqal + qal[pos + len_relg:],
-                       pattern, max_seq_len, cnt=cnt)
-        else:
-            yield seq[:pos] + site, qal[:pos] + xqal, cnt
-        new_pos = pos + len_relg
-        for sseq, sqal, cnt in split_read(site + seq[new_pos:],
-                                          xqal + qal[new_pos:], pattern,
-                                          max_seq_len, site=site, cnt=cnt):
-            yield sseq, sqal, cnt
-
-    # Define function for stripping lines according to focus
-    if isinstance(trim, tuple):
-        beg, end = trim
-        beg -= 1
-        strip_line = lambda x: x[beg:end]
-    else:
-        strip_line = lambda x: x
-
-    # define function to split reads according to restriction enzyme sites
-    if isinstance(r_enz, str):
-        enzyme = RESTRICTION_ENZYMES[r_enz].replace('|', '')
-        enz_pattern = religated(r_enz)
-        sub_enz_pattern = enz_pattern[:len(enz_pattern) / 2]
-        len_relg = len(enz_pattern)
+    # define how to split reads according to restriction enzyme sites
+    if r_enz:
+        r_enzs = [r_enz] if isinstance(r_enz, str) else list(r_enz)
+        splitter = _ligation_patterns(r_enzs, add_site)
         print '  - splitting into restriction enzyme (RE) fragments using ligation sites'
         print '  - ligation sites are replaced by RE sites to match the reference genome'
-        print '    * enzyme: %s, ligation site: %s, RE site: %s' % (r_enz, enz_pattern, enzyme)
-        split_read = _split_read_re
+        for (enz1, enz2), lig in sorted(religateds(r_enzs).iteritems()):
+            print '    * enzymes: %s-%s, ligation site: %s, RE sites: %s, %s' % (
+                enz1, enz2, lig, RESTRICTION_ENZYMES[enz1].replace('|', ''),
+                RESTRICTION_ENZYMES[enz2].replace('|', ''))
     else:
-        enzyme = ''
-        enz_pattern = ''
-        split_read = lambda x, y, z, after_z, after_after_z: (yield x, y , 1)
-
-    # function to yield reads from input file
-    if light_storage:
-        get_seq = _get_fastq_read_light if fastq else _get_map_read_light
-        insert_mark = insert_mark_light
-    else:
-        get_seq = _get_fastq_read_heavy if fastq else _get_map_read_heavy
-        insert_mark = insert_mark_heavy
+        splitter = None
 
     ## Start processing the input file
     if verbose:
@@ -156,43 +72,211 @@ def transform_fastq(fastq_path, out_fastq, trim=None, r_enz=None, add_site=True,
     # create output file
     out_name = out_fastq
     out = open(out_fastq, 'w')
-    # iterate over reads and strip them
-    site = enzyme if add_site else ''
-    for header in fhandler:
-        header, seq, qal = get_seq(header)
-        counter += 1
-        # trim on wanted region of the read
-        seq = strip_line(seq)
-        qal = strip_line(qal)
-        # get the generator of restriction enzyme fragments
-        iter_frags = split_read(seq, qal, enz_pattern, len(seq), site)
-        # the first fragment should not be preceded by the RE site
-        try:
-            seq, qal, cnt = iter_frags.next()
-        except StopIteration:
-            # read full of ligation events, fragments not reaching minimum
-            continue
-        except ValueError:
-            # or not ligation site found, in which case we try with half
-            # ligation site in case there was a sequencing error (half ligation
-            # site is a RE site or nearly, and thus should not be found anyway)
-            iter_frags = split_read(seq, qal, sub_enz_pattern, len(seq), '')
-            try:
-                seq, qal, cnt = iter_frags.next()
-            except ValueError:
-                continue
-            except StopIteration:
-                continue
-        out.write(_map2fastq('\t'.join((insert_mark(header, cnt),
-                                        seq, qal, '0', '-\n'))))
-        # the next fragments should be preceded by the RE site
-        # continue
-        for seq, qal, cnt in  iter_frags:
-            out.write(_map2fastq('\t'.join((insert_mark(header, cnt),
-                                            seq, qal, '0', '-\n'))))
+    # iterate over blocks of reads and transform them
+    args = (fastq, light_storage, trim, splitter, min_seq_len)
+    pool = mu.Pool(ncpus) if ncpus > 1 else None
+    for nreads, text in _transformed_blocks(fhandler, args, reads_per_block,
+                                            pool, ncpus):
+        counter += nreads
+        out.write(text)
+    if pool is not None:
+        pool.close()
+        pool.join()
+    fhandler.close()
     out.close()
     return out_name, counter
 
+def _transformed_blocks(fhandler, args, reads_per_block=100000, pool=None,
+                        ncpus=1):
+    """
+    Transforms the reads of an opened FASTQ or MAP file by blocks, using the
+    processes of pool if given.
+
+    :param args: arguments passed to :func:`_transform_reads` after the lines
+
+    :yields: the number of reads in each block and the resulting reads, in
+       FASTQ format, in the order of the input file
+    """
+    fastq = args[0]
+    nlines = reads_per_block * (4 if fastq else 1)
+    jobs = deque()
+    while True:
+        lines = list(islice(fhandler, nlines))
+        if not lines:
+            break
+        nreads = len(lines) / (4 if fastq else 1)
+        if pool is None:
+            yield nreads, _transform_reads(lines, *args)
+            continue
+        jobs.append((nreads,
+                     pool.apply_async(_transform_reads, args=(lines, ) + args)))
+        # keep a bounded number of blocks in memory
+        if len(jobs) > 2 * ncpus:
+            nreads, job = jobs.popleft()
+            yield nreads, job.get()
+    while jobs:
+        nreads, job = jobs.popleft()
+        yield nreads, job.get()
+
+def _ligation_patterns(r_enzs, add_site=True):
+    """
+    Regular expressions used to split reads according to the ligation sites
+    of one or several restriction enzymes.
+
+    If no ligation site is found in a read, the first half of the ligation
+    sites are searched instead, in case there was a sequencing error (half
+    ligation site is a RE site or nearly, and thus should not be found
+    anyway). As the end of the ligation site is then unknown, a half site
+    shared by several ligation sites (e.g. 'GATC' in a double digestion with
+    DpnII and HindIII) is replaced by the shortest of them.
+
+    :returns: a regular expression matching the first ligation site, or the
+       first half ligation site if the read contains no complete ligation
+       site (the group matched being 'lig' or 'half'), a dictionary with the
+       regular expressions used to find the next sites of each kind, and a
+       dictionary with, for each site, the number of nucleotides it occupies
+       in the read, and the RE sites to be added at the end of the preceding
+       fragment and at the beginning of the next one
+    """
+    sites = {}
+    halves = {}
+    for (enz1, enz2), lig in religateds(r_enzs).iteritems():
+        site1 = RESTRICTION_ENZYMES[enz1].replace('|', '') if add_site else ''
+        site2 = RESTRICTION_ENZYMES[enz2].replace('|', '') if add_site else ''
+        sites[lig] = (len(lig), site1, site2)
+        # with half ligation sites, nothing is put back
+        half = lig[:len(lig) / 2]
+        halves[half] = (min(len(lig), halves.get(half, (len(lig), ))[0]),
+                        '', '')
+    sites.update(halves)
+    # longest sites first, as the first alternative matching is used
+    ligs  = '|'.join(sorted(set(sites) - set(halves), key=len, reverse=True))
+    halfs = '|'.join(sorted(halves, key=len, reverse=True))
+    first = '(?P<lig>%s)|(?=%s)(?!.*?(?:%s))(?P<half>%s)' % (
+        ligs, halfs, ligs, halfs)
+    return first, {'lig': ligs, 'half': halfs}, sites
+
+def _split_read_re(seq, qal, splitter, min_seq_len):
+    """
+    Splits reads according to the predefined restriction enzyme(s).
+    RE fragments returned are followed and preceded by the RE site if a
+    ligation site was found after the fragment.
+
+    EXAMPLE:
+
+       seq = '-------oGATCo========oGATCGATCo_____________oGATCGATCo~~~~~~~~~~~~'
+       qal = 'xxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxx'
+
+    should return these fragments:
+
+        -------oGATCo========oGATC
+        xxxxxxxxxxxxxxxxxxxxxxHHHH
+
+        GATCo_____________oGATC
+        HHHHxxxxxxxxxxxxxxxHHHH
+
+        GATCo~~~~~~~~~~~~
+        HHHHxxxxxxxxxxxxx
+
+    :param splitter: compiled regular expressions and sites, as returned by
+       :func:`_ligation_patterns`
+
+    :returns: a list of tuples with the sequence, the quality and the index
+       of each fragment, or None if no ligation site (not even half) was
+       found in the read
+    """
+    first, patterns, sites = splitter
+    match = first.search(seq)
+    if not match:
+        return None
+    pattern = patterns[match.lastgroup]
+    frags = []
+    cnt = 0
+    while True:
+        cnt += 1
+        if not match:
+            if len(seq) > min_seq_len:
+                frags.append((seq, qal, cnt))
+            return frags
+        pos = match.start()
+        len_relg, site1, site2 = sites[match.group()]
+        # fragments too short before the ligation site are skipped
+        if pos >= min_seq_len:
+            frags.append((seq[:pos] + site1, qal[:pos] + 'H' * len(site1), cnt))
+        new_pos = pos + len_relg
+        seq = site2 + seq[new_pos:]
+        qal = 'H' * len(site2) + qal[new_pos:]
+        match = pattern.search(seq)
+
+def _fastq_reads_heavy(lines):
+    """
+    yields header and sequence of each FASTQ entry
+    Note: header also contains the sequence
+    """
+    for rlines, seq, qal in izip(lines[0::4], lines[1::4], lines[3::4]):
+        seq = seq.strip()
+        qal = qal.strip()
+        # header now also contains original read
+        yield rlines.rstrip('\n').split()[0][1:] + ' ' + seq + ' ' + qal, seq, qal
+
+def _fastq_reads_light(lines):
+    """
+    yields header and sequence of each FASTQ entry
+    """
+    for rlines, seq, qal in izip(lines[0::4], lines[1::4], lines[3::4]):
+        yield rlines.rstrip('\n').split()[0][1:], seq.strip(), qal.strip()
+
+def _map_reads_heavy(lines):
+    for line in lines:
+        header = line.split('\t', 1)[0]
+        seq, qal = header.rsplit(' ', 2)[-2:]
+        yield header, seq, qal
+
+def _map_reads_light(lines):
+    for line in lines:
+        header, seq, qal, _ = line.split('\t', 3)
+        yield header, seq, qal
+
+def _transform_reads(lines, fastq, light_storage, trim, splitter, min_seq_len):
+    """
+    Trims and splits a block of reads, read from a FASTQ or a MAP file.
+
+    :returns: the resulting reads, in FASTQ format
+    """
+    if light_storage:
+        get_seqs = _fastq_reads_light if fastq else _map_reads_light
+        insert_mark = insert_mark_light
+    else:
+        get_seqs = _fastq_reads_heavy if fastq else _map_reads_heavy
+        insert_mark = insert_mark_heavy
+    if isinstance(trim, tuple):
+        beg, end = trim
+        beg -= 1
+    else:
+        beg, end = None, None
+    if splitter is not None:
+        first, patterns, sites = splitter
+        splitter = (compile(first),
+                    dict((k, compile(v)) for k, v in patterns.iteritems()),
+                    sites)
+    out = []
+    for header, seq, qal in get_seqs(lines):
+        # trim on wanted region of the read
+        seq = seq[beg:end]
+        qal = qal[beg:end]
+        if splitter is None:
+            out.append('@%s\n%s\n+\n%s\n' % (header, seq, qal))
+            continue
+        frags = _split_read_re(seq, qal, splitter, min_seq_len)
+        # no ligation site found, or read full of ligation events with
+        # fragments not reaching minimum size
+        if not frags:
+            continue
+        for seq, qal, cnt in frags:
+            out.append('@%s\n%s\n+\n%s\n' % (insert_mark(header, cnt),
+                                               seq, qal))
+    return ''.join(out)
+
 def insert_mark_heavy(header, num):
     if num == 1 :
         return header
@@ -204,9 +288,6 @@ def insert_mark_light(header, num):
         return header
     return '%s~%d~' % (header, num)
 
-def _map2fastq(read):
-    return '@{0}\n{1}\n+\n{2}\n'.format(*read.split('\t', 3)[:-1])
-
 def _gem_filter(fnam, unmap_out, map_out):
     """
     Divides reads in a map file in two categories: uniquely mapped, and not.
@@ -217,8 +298,8 @@ def _gem_filter(fnam, unmap_out, map_out):
        - not feasible with gt.filter
     """
     fhandler = magic_open(fnam) if isinstance(fnam, str) else fnam
-    unmap_out = open(unmap_out, 'w')
-    map_out   = open(map_out  , 'w')
+    unmap_out = open(unmap_out, 'w') if isinstance(unmap_out, str) else unmap_out
+    map_out   = open(map_out  , 'w') if isinstance(map_out  , str) else map_out
     def _strip_read_name(line):
         """
         remove original sequence from read name when read is mapped uniquely
@@ -243,6 +324,7 @@ def _gem_filter(fnam, unmap_out, map_out):
         if not bad:
             map_out.write(_strip_read_name(line))
     unmap_out.close()
+    map_out.close()
 
 def _gem_mapping(gem_index_path, fastq_path, out_map_path,
                 gem_binary='gem-mapper', **kwargs):
@@ -252,9 +334,29 @@ def _gem_mapping(gem_index_path, fastq_path, out_map_path,
        uses the full sequence.
     :param 33 quality: set it to 'ignore' in order to speed-up the mapping
     """
+    gem_cmd = _gem_command(gem_index_path, fastq_path, out_map_path,
+                           gem_binary=gem_binary, **kwargs)
+    print 'TO GEM', fastq_path
+    print ' '.join(gem_cmd)
+    try:
+        # check_call(gem_cmd, stdout=PIPE, stderr=PIPE)
+        out, err = Popen(gem_cmd, stdout=PIPE, stderr=PIPE).communicate()
+    except CalledProcessError as e:
+        print out
+        print err
+        raise Exception(e.output)
+
+def _gem_command(gem_index_path, fastq_path=None, out_map_path=None,
+                 gem_binary='gem-mapper', **kwargs):
+    """
+    :param None fastq_path: input FASTQ file, if None GEM reads from the
+       standard input
+    :param None out_map_path: output MAP file, if None GEM writes to the
+       standard output
+
+    :returns: the GEM command line, as a list
+    """
     gem_index_path    = os.path.abspath(os.path.expanduser(gem_index_path))
-    fastq_path        = os.path.abspath(os.path.expanduser(fastq_path))
-    out_map_path      = os.path.abspath(os.path.expanduser(out_map_path))
     nthreads          = kwargs.get('nthreads'            , 8)
     max_edit_distance = kwargs.get('max_edit_distance'   , 0.04)
     mismatches        = kwargs.get('mismatches'          , 0.04)
@@ -273,7 +375,6 @@ def _gem_mapping(gem_index_path, fastq_path, out_map_path,
                         'not provide any binary for MAC-OS.')
 
     # mapping
-    print 'TO GEM', fastq_path
     kgt = kwargs.get
     gem_cmd = [
         gem_binary, '-I', gem_index_path,
@@ -294,9 +395,12 @@ def _gem_mapping(gem_index_path, fastq_path, out_map_path,
         '--max-extendable-matches'  , kgt('max-extendable-matches', '20'      ),
         '--max-extensions-per-match', kgt('max-extensions-per-match', '1'     ),
         '-e'                        , kgt('e', str(mismatches)                ),
-        '-T'                        , str(nthreads),
-        '-i'                        , fastq_path,
-        '-o', out_map_path.replace('.map', '')]
+        '-T'                        , str(nthreads)]
+    if fastq_path:
+        gem_cmd += ['-i', os.path.abspath(os.path.expanduser(fastq_path))]
+    if out_map_path:
+        gem_cmd += ['-o', os.path.abspath(os.path.expanduser(
+            out_map_path)).replace('.map', '')]
 
     if 'paired-end-alignment' in kwargs or 'p' in kwargs:
         gem_cmd.append('--paired-end-alignment')
@@ -324,19 +428,11 @@ def _gem_mapping(gem_index_path, fastq_path, out_map_path,
                       'p', 'map-both-ends', 'fast-mapping', 'unique-mapping',
                       'unique-pairing', 'suffix']:
             warn('WARNING: %s not in usual keywords, misspelled?' % kw)
-
-    print ' '.join(gem_cmd)
-    try:
-        # check_call(gem_cmd, stdout=PIPE, stderr=PIPE)
-        out, err = Popen(gem_cmd, stdout=PIPE, stderr=PIPE).communicate()
-    except CalledProcessError as e:
-        print out
-        print err
-        raise Exception(e.output)
+    return gem_cmd
 
 def full_mapping(gem_index_path, fastq_path, out_map_dir, r_enz=None, frag_map=True,
                  min_seq_len=15, windows=None, add_site=True, clean=False,
-                 get_nread=False, **kwargs):
+                 get_nread=False, streaming=False, **kwargs):
     """
     Maps FASTQ reads to an indexed reference genome. Mapping can be done either
     without knowledge of the restriction enzyme used, or for experiments
@@ -349,7 +445,8 @@ def full_mapping(gem_index_path, fastq_path, out_map_dir, r_enz=None, frag_map=T
     :param out_map_dir: path to a directory where to store mapped reads in MAP
        format .
     :param None r_enz: name of the restriction enzyme used in the experiment e.g.
-       HindIII. This is optional if frag_map option is False
+       HindIII, or list of names for multiple digestions. This is optional if
+       frag_map option is False
     :param True frag_map: two step mapper, first full length is mapped, then
        remaining, unmapped reads, are divided into restriction-enzyme fragments
        andeach is mapped.
@@ -362,7 +459,8 @@ def full_mapping(gem_index_path, fastq_path, out_map_dir, r_enz=None, frag_map=T
        A unique window can also be passed, for trimming, like this:
          windows=((1,101),)
     :param False clean: remove intermediate files created in temp_dir
-    :param 4 nthreads: number of threads to use for mapping (number of CPUs)
+    :param 4 nthreads: number of threads to use for mapping (number of CPUs),
+       also used to prepare the reads before each mapping
     :param 0.04 max_edit_distance: The maximum number of edit operations allowed
        while verifying candidate matches by dynamic programming.
     :param 0.04 mismatches: The maximum number of nucleotide substitutions
@@ -373,6 +471,11 @@ def full_mapping(gem_index_path, fastq_path, out_map_dir, r_enz=None, frag_map=T
        written there.
     :param False get_nreads: returns a list of lists where each element contains
        a path and the number of reads processed
+    :param False streaming: run all the mapping steps at the same time,
+       connected through pipes. The reads not mapped in one window are
+       transformed and mapped in the next one while GEM is still running on
+       the previous window. Intermediate files are only written if clean is
+       False
 
     :returns: a list of paths to generated outfiles. To be passed to
        :func:`pytadbit.parsers.map_parser.parse_map`
@@ -412,6 +515,16 @@ def full_mapping(gem_index_path, fastq_path, out_map_dir, r_enz=None, frag_map=T
         # in this case we will need to keep the information about original
         # sequence at any point, light storage is thus not possible.
         light_storage = False
+    if streaming and not skip:
+        if frag_map and not r_enz:
+            raise Exception('ERROR: need enzyme name to fragment.')
+        outfiles = _streaming_mapping(
+            gem_index_path, fastq_path, out_map_dir, base_name, windows,
+            r_enz if frag_map else None, min_seq_len, add_site, clean,
+            light_storage, temp_dir, suffix, nthreads, kwargs)
+        if get_nread:
+            return outfiles
+        return [out for out, _ in outfiles]
     for win in windows:
         # Prepare the FASTQ file and iterate over them
         curr_map, counter = transform_fastq(
@@ -421,7 +534,7 @@ def full_mapping(gem_index_path, fastq_path, out_map_dir, r_enz=None, frag_map=T
                    or input_reads.endswith('.fq.gz'   )
                    or input_reads.endswith('.dsrc'    )),
             min_seq_len=min_seq_len, trim=win, skip=skip, nthreads=nthreads,
-            light_storage=light_storage)
+            ncpus=nthreads, light_storage=light_storage)
         # clean
         if input_reads != fastq_path and clean:
             print '   x removing original input %s' % input_reads
@@ -467,7 +580,7 @@ def full_mapping(gem_index_path, fastq_path, out_map_dir, r_enz=None, frag_map=T
         frag_map, counter = transform_fastq(
             input_reads, mkstemp(prefix=base_name + '_', dir=temp_dir)[1],
             min_seq_len=min_seq_len, trim=win, fastq=False, r_enz=r_enz,
-            add_site=add_site, skip=skip, nthreads=nthreads,
+            add_site=add_site, skip=skip, nthreads=nthreads, ncpus=nthreads,
             light_storage=light_storage)
         # clean
         if clean:
@@ -499,3 +612,177 @@ def full_mapping(gem_index_path, fastq_path, out_map_dir, r_enz=None, frag_map=T
     if get_nread:
         return outfiles
     return [out for out, _ in outfiles]
+
+
+def _streaming_mapping(gem_index_path, fastq_path, out_map_dir, base_name,
+                       windows, r_enz, min_seq_len, add_site, clean,
+                       light_storage, temp_dir, suffix, nthreads, gem_kwargs):
+    """
+    Iterative mapping where all the steps run at the same time. The reads of
+    each window are transformed while GEM maps them, and the reads not
+    uniquely mapped are passed, through a pipe, to the transformation of the
+    next window (or of the fragment-based mapping if r_enz is given) as soon
+    as GEM outputs them.
+
+    Parameters are the same as in :func:`full_mapping`, gem_kwargs being the
+    extra keyword arguments passed to it.
+
+    :returns: a list of tuples with the path to each generated MAP file and
+       the number of reads processed
+    """
+    stages = [('full', win) for win in windows]
+    if r_enz:
+        stages.append(('frag', windows[-1]))
+    fastq = (   fastq_path.endswith('.fastq'   )
+             or fastq_path.endswith('.fastq.gz')
+             or fastq_path.endswith('.fq.gz'   )
+             or fastq_path.endswith('.dsrc'    ))
+    # pool and input are opened before any pipe, as they may start new
+    # processes that would otherwise keep the pipes open
+    pool = mu.Pool(nthreads) if nthreads > 1 else None
+    in_handler = magic_open(fastq_path, cpus=nthreads)
+    counters = [0] * len(stages)
+    errors   = []
+    threads  = []
+    procs    = []
+    outfiles = []
+    curr_map = prev_map = None
+    for num, (kind, win) in enumerate(stages):
+        if not win:
+            beg, end = 1, 'end'
+        else:
+            beg, end = win
+        if kind == 'full':
+            print 'Mapping reads in window %s-%s%s...' % (beg, end, suffix)
+            splitter = None
+        else:
+            print 'Mapping fragments of remaining reads...'
+            splitter = _ligation_patterns(
+                [r_enz] if isinstance(r_enz, str) else list(r_enz), add_site)
+        out_map = os.path.join(out_map_dir, base_name + '_%s_%s-%s%s.map' % (
+            kind, beg, end, suffix))
+        args = (fastq and not num, light_storage, win, splitter, min_seq_len)
+        # GEM reads from its standard input and writes to its standard output
+        gem_cmd = _gem_command(gem_index_path, **gem_kwargs)
+        print ' '.join(gem_cmd)
+        gem_err = TemporaryFile(dir=temp_dir)
+        gem = Popen(gem_cmd, stdin=PIPE, stdout=PIPE, stderr=gem_err,
+                    close_fds=True)
+        procs.append((gem, gem_err))
+        # intermediate files
+        if clean:
+            gem_in_copy = None
+            gem_out = gem.stdout
+            unmap_copy = (open(os.devnull, 'w')
+                          if num == len(stages) - 1 else None)
+        else:
+            prev_map = curr_map
+            fd, curr_map = mkstemp(prefix=base_name + '_', dir=temp_dir)
+            os.close(fd)
+            gem_in_copy = open(curr_map, 'w')
+            gem_out = _copy_lines(gem.stdout, open(
+                curr_map + '_%s_%s-%s%s.map' % (kind, beg, end, suffix), 'w'))
+            if kind == 'full':
+                unmap_copy = open(curr_map + '_filt_%s-%s%s.map' % (
+                    beg, end, suffix), 'w')
+            else:
+                unmap_copy = open(prev_map + '_fail%s.map' % (suffix), 'w')
+        # unmapped reads go to the next step through a pipe
+        if num < len(stages) - 1:
+            pipe_out, pipe_in = os.pipe()
+            unmap_out = os.fdopen(pipe_in, 'w')
+            if unmap_copy:
+                unmap_out = _Tee(unmap_out, unmap_copy)
+            next_handler = os.fdopen(pipe_out)
+        else:
+            unmap_out = unmap_copy
+        threads.append(Thread(target=_catch_errors, args=(
+            errors, _feed_gem, in_handler, gem.stdin, args, pool, nthreads,
+            counters, num, gem_in_copy)))
+        threads.append(Thread(target=_catch_errors, args=(
+            errors, _filter_gem, gem_out, gem.stdout, unmap_out, out_map)))
+        outfiles.append(out_map)
+        if num < len(stages) - 1:
+            in_handler = next_handler
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if pool is not None:
+        pool.close()
+        pool.join()
+    # a failing GEM is the most likely cause of errors in the other steps
+    gem_errors = []
+    for gem, gem_err in procs:
+        if gem.wait():
+            gem_err.seek(0)
+            gem_errors.append(Exception('ERROR: GEM failed:\n' +
+                                        gem_err.read()))
+        gem_err.close()
+    errors = gem_errors + errors
+    if errors:
+        raise errors[0]
+    return zip(outfiles, counters)
+
+def _feed_gem(fhandler, gem_in, args, pool, ncpus, counters, num, copy=None):
+    """
+    Transforms reads and writes them to the input of GEM (and to copy if
+    given)
+    """
+    try:
+        for nreads, text in _transformed_blocks(fhandler, args, pool=pool,
+                                                ncpus=ncpus):
+            counters[num] += nreads
+            gem_in.write(text)
+            if copy:
+                copy.write(text)
+    finally:
+        # closing everything lets the other steps stop if something fails
+        gem_in.close()
+        fhandler.close()
+        if copy:
+            copy.close()
+
+def _filter_gem(gem_out, gem_stdout, unmap_out, map_out):
+    """
+    Separates uniquely mapped reads from the output of GEM
+    """
+    try:
+        _gem_filter(gem_out, unmap_out, map_out)
+    finally:
+        unmap_out.close()
+        gem_stdout.close()
+
+def _catch_errors(errors, func, *args):
+    """
+    runs func in a thread, keeping its exceptions in errors
+    """
+    try:
+        func(*args)
+    except Exception as e:
+        errors.append(e)
+
+def _copy_lines(fhandler, out):
+    """
+    yields the lines of fhandler, writing them to out
+    """
+    for line in fhandler:
+        out.write(line)
+        yield line
+    out.close()
+
+
+class _Tee(object):
+    """
+    file-like object writing to several files at once
+    """
+    def __init__(self, *handlers):
+        self.handlers = handlers
+
+    def write(self, text):
+        for fhandler in self.handlers:
+            fhandler.write(text)
+
+    def close(self):
+        for fhandler in self.handlers:
+            fhandler.close()
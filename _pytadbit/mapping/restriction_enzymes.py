@@ -5,11 +5,14 @@ Definition and mapping of restriction enymes
 """
 
 from re import compile
+import numpy as np
+
+from pytadbit.utils.file_handling import magic_open
 
 
 def count_re_fragments(fnam):
     frag_count = {}
-    fhandler = open(fnam)
+    fhandler = magic_open(fnam)
     line = fhandler.next()
     while line.startswith('#'):
         line = fhandler.next()
@@ -72,6 +75,56 @@ def map_re_sites_nochunk(enzyme_name, genome_seq, verbose=False):
         print 'Found %d RE sites' % count
     return frags
 
+def index_re_sites(enzyme_name, genome_seq, verbose=False):
+    """
+    map all restriction enzyme (RE) sites of a given enzyme in a genome, as
+    :func:`map_re_sites_nochunk` does, but storing the RE sites of each
+    chromosome in a sorted array, to be used with :func:`re_fragment_bounds`.
+
+    :param enzyme_name: name of the enzyme to map (upper/lower case are
+       important)
+    :param genome_seq: a dictionary containing the genomic sequence by
+       chromosome, or a :class:`pytadbit.parsers.genome_parser.GenomeCache`
+       (in which case RE sites are searched only once, and stored with it)
+
+    :returns: a dictionary with, for each chromosome, an array starting with 1,
+       followed by the position of each RE site, and ending with the length of
+       the chromosome
+    """
+    if hasattr(genome_seq, 're_sites'):
+        return genome_seq.re_sites(enzyme_name, verbose=verbose)
+    frags = map_re_sites_nochunk(enzyme_name, genome_seq, verbose=verbose)
+    return dict((crm, np.array(frags[crm], dtype=np.int64)) for crm in frags)
+
+
+def re_fragment_bounds(sites, positions, read_lengths):
+    """
+    Finds the RE sites around a batch of reads mapped on a same chromosome.
+
+    Reads mapped partly outside the chromosome are moved to its last
+    nucleotide.
+
+    :param sites: sorted array of RE sites of one chromosome, as returned by
+       :func:`index_re_sites`
+    :param positions: array of positions of the reads
+    :param read_lengths: array of lengths of the mapped reads
+
+    :returns: the position of the reads (corrected if mapped outside the
+       chromosome), the position of the closest upstream RE site and the
+       position of the closest downstream RE site
+    """
+    positions = np.array(positions, dtype=np.int64)
+    outside = positions >= sites[-1]
+    if outside.any():
+        shift = positions[outside] - sites[-1] + 1
+        if (shift >= np.asarray(read_lengths)[outside]).any():
+            raise Exception('Read mapped mostly outside ' +
+                            'chromosome\n')
+        positions[outside] = sites[-1] - 1
+    idx = np.searchsorted(sites, positions, side='right')
+    return positions, sites[np.maximum(idx - 1, 0)], sites[idx]
+
+
 def map_re_sites(enzyme_name, genome_seq, frag_chunk=100000, verbose=False):
     """
     map all restriction enzyme (RE) sites of a given enzyme in a genome.
@@ -165,6 +218,28 @@ def religated(r_enz):
     site = site.replace('|', '')
     return beg + site[min(len(beg), len(end)) : max(len(beg), len(end))] + end
 
+def religateds(r_enzs):
+    """
+    returns the resulting sequences after religation of two digested and
+    repaired ends, for all the combinations of the given restriction enzymes
+    (e.g. in a double digestion).
+
+    :param r_enzs: list of restriction enzyme names
+
+    :returns: a dictionary with, as keys, the pair of enzymes that produced
+       the left and the right end, and as values the ligation sites. With a
+       single enzyme, the only value is equal to :func:`religated`
+    """
+    ends = {}
+    for r_enz in r_enzs:
+        site = RESTRICTION_ENZYMES[r_enz]
+        beg, end = site.split('|')
+        site = site.replace('|', '')
+        ends[r_enz] = (site[:max(len(beg), len(end))],
+                       site[min(len(beg), len(end)):])
+    return dict(((r_enz1, r_enz2), ends[r_enz1][0] + ends[r_enz2][1])
+                for r_enz1 in r_enzs for r_enz2 in r_enzs)
+
 
 class RE_dict(dict):
     def __getitem__(self, i):
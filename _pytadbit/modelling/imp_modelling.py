@@ -6,6 +6,7 @@
 from pytadbit.modelling.IMP_CONFIG           import CONFIG, NROUNDS, STEPS, LSTEPS
 from pytadbit.modelling.structuralmodels import StructuralModels
 from pytadbit.modelling.impmodel         import IMPmodel
+from pytadbit.utils.tadmaths             import zscores_to_dict
 from scipy                         import polyfit
 from math                          import fabs, pow as power
 from cPickle                       import load, dump
@@ -35,7 +36,9 @@ def generate_3d_models(zscores, resolution, nloci, start=1, n_models=5000,
     The final analysis will be performed on the n_keep top models.
     
     :param zscores: the dictionary of the Z-score values calculated from the 
-       Hi-C pairwise interactions
+       Hi-C pairwise interactions. Alternatively a tuple of three arrays with
+       the rows, columns and Z-score values (see
+       :func:`pytadbit.Experiment._sub_experiment_zscore`)
     :param resolution:  number of nucleotides per Hi-C bin. This will be the 
        number of nucleotides in each model's particle
     :param nloci: number of particles to model (may not all be present in
@@ -148,6 +151,10 @@ def generate_3d_models(zscores, resolution, nloci, start=1, n_models=5000,
              '   -> resolution times scale -- %s*%s)') % (
                 CONFIG['lowrdist'], resolution, CONFIG['scale']))
 
+    # restraints are looked up by particle names
+    if not isinstance(zscores, dict):
+        zscores = zscores_to_dict(*zscores)
+
     # get SLOPE and regression for all particles of the z-score data
     global SLOPE, INTERCEPT
     zsc_vals = [zscores[i][j] for i in zscores for j in zscores[i]
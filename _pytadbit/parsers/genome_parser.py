@@ -5,8 +5,13 @@ convert a bunch of fasta files, or a single multi fasta file, into a dictionary
 """
 
 from collections import OrderedDict
+from hashlib import md5
 from pytadbit.utils.file_handling import magic_open
+from pytadbit.mapping.restriction_enzymes import map_re_sites_nochunk
+import errno
+import os
 import re
+import numpy as np
 
 def parse_fasta(f_names, chr_names=None, chr_filter=None, chr_regexp=None,
                 verbose=True):
@@ -89,3 +94,148 @@ def parse_fasta(f_names, chr_names=None, chr_filter=None, chr_regexp=None,
         if 'UNWANTED' in genome_seq:
             del(genome_seq['UNWANTED'])
     return genome_seq
+
+
+def _checksum(f_names, *extra):
+    """
+    md5 checksum of the content of a list of files, and of some extra
+    parameters
+    """
+    md5sum = md5()
+    for fnam in f_names:
+        fhandler = open(fnam, 'rb')
+        for block in iter(lambda: fhandler.read(1 << 20), ''):
+            md5sum.update(block)
+        fhandler.close()
+    md5sum.update(repr(extra))
+    return md5sum.hexdigest()
+
+
+class GenomeCache(object):
+    """
+    Genomic sequence stored on disk as an array of bytes (one per nucleotide),
+    with the positions of the restriction enzyme sites found in it.
+
+    Behaves as the dictionary returned by :func:`parse_fasta`, except that
+    sequences are memory-mapped arrays of bytes (use :func:`sequence` to get
+    them as strings).
+
+    :param dirname: path to the directory with the cached genome, as
+       generated by :func:`load_genome`
+    """
+    def __init__(self, dirname):
+        self.dirname = dirname
+        self.offsets = OrderedDict()
+        for line in open(os.path.join(dirname, 'chromosomes.tsv')):
+            crm, beg, end = line.split()
+            self.offsets[crm] = int(beg), int(end)
+        self._seq = None
+
+    def _sequence(self):
+        if self._seq is None:
+            self._seq = np.memmap(os.path.join(self.dirname, 'sequence.bin'),
+                                  dtype=np.uint8, mode='r')
+        return self._seq
+
+    def __getitem__(self, crm):
+        beg, end = self.offsets[crm]
+        return self._sequence()[beg:end]
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __iter__(self):
+        return iter(self.offsets)
+
+    def __contains__(self, crm):
+        return crm in self.offsets
+
+    def keys(self):
+        return self.offsets.keys()
+
+    def sequence(self, crm):
+        """
+        :returns: the sequence of a chromosome, as a string
+        """
+        return self[crm].tostring()
+
+    def re_sites(self, enzyme_name, verbose=False):
+        """
+        Positions of the restriction enzyme sites in each chromosome, as
+        returned by
+        :func:`pytadbit.mapping.restriction_enzymes.index_re_sites`.
+        Sites are searched only the first time, and stored with the genome.
+
+        :param enzyme_name: name of the enzyme to map (upper/lower case are
+           important)
+        """
+        fname = os.path.join(self.dirname, 're_sites_%s.npy' % enzyme_name)
+        if not os.path.exists(fname):
+            sites  = []
+            counts = []
+            for crm in self.offsets:
+                sites.append(np.array(map_re_sites_nochunk(
+                    enzyme_name, {crm: self.sequence(crm)})[crm],
+                                      dtype=np.int64))
+                counts.append(len(sites[-1]))
+            if verbose:
+                print 'Found %d RE sites' % (sum(counts) - 2 * len(counts))
+            np.save(fname + '_tmp.npy', np.concatenate(sites))
+            np.save(fname[:-4] + '_counts.npy', np.array(counts, dtype=np.int64))
+            os.rename(fname + '_tmp.npy', fname)
+        sites  = np.load(fname, mmap_mode='r')
+        counts = np.load(fname[:-4] + '_counts.npy')
+        begs   = np.concatenate(([0], np.cumsum(counts)))
+        return dict((crm, sites[begs[i]:begs[i + 1]])
+                    for i, crm in enumerate(self.offsets))
+
+
+def load_genome(f_names, chr_filter=None, chr_regexp=None, cache_dir=None,
+                verbose=True):
+    """
+    Parse a list of fasta files, or just one fasta, only the first time. The
+    genomic sequence is stored in a cache directory (see :class:`GenomeCache`),
+    keyed by the checksum of the fasta files and the chromosome filters, so
+    that next calls have direct access to it.
+
+    :param f_names: list of pathes to files, or just a single path
+    :param None chr_filter: use only chromosome in the input list
+    :param None chr_regexp: use only chromosome matching
+    :param None cache_dir: directory where to store cached genomes (defaults
+       to ~/.pytadbit/genomes)
+
+    :returns: a :class:`GenomeCache`
+    """
+    if isinstance(f_names, str):
+        f_names = [f_names]
+    cache_dir = cache_dir or os.path.join(os.path.expanduser('~'),
+                                          '.pytadbit', 'genomes')
+    dirname = os.path.join(cache_dir, _checksum(
+        f_names, sorted(chr_filter or []), chr_regexp))
+    if os.path.exists(os.path.join(dirname, 'chromosomes.tsv')):
+        if verbose:
+            print 'Using cached genome in %s' % (dirname)
+        return GenomeCache(dirname)
+    # parent directories may not exist yet (e.g. first use of ~/.pytadbit)
+    try:
+        os.makedirs(dirname)
+    except OSError as exc:
+        if exc.errno != errno.EEXIST:
+            raise
+    genome_seq = parse_fasta(f_names, chr_filter=chr_filter,
+                             chr_regexp=chr_regexp, verbose=verbose)
+    out = open(os.path.join(dirname, 'sequence.bin'), 'wb')
+    offsets = []
+    beg = 0
+    for crm in genome_seq:
+        out.write(genome_seq[crm])
+        offsets.append('%s\t%d\t%d\n' % (crm, beg, beg + len(genome_seq[crm])))
+        beg += len(genome_seq[crm])
+    out.close()
+    # written last, as it marks the cache as complete
+    out = open(os.path.join(dirname, 'chromosomes_tmp.tsv'), 'w')
+    out.write(''.join(offsets))
+    out.close()
+    os.rename(os.path.join(dirname, 'chromosomes_tmp.tsv'),
+              os.path.join(dirname, 'chromosomes.tsv'))
+    return GenomeCache(dirname)
@@ -0,0 +1,486 @@
+"""
+Binary storage of Hi-C interaction matrices.
+
+The interaction matrix is stored, together with its biases, filtered columns
+and expected counts, in a single binary file that is memory-mapped when
+loaded. The upper triangle of the matrix is split in blocks, one per pair of
+chromosomes, each block being stored in compressed sparse row format. Loading
+one chromosome (or a set of chromosomes, or a genomic window) only reads the
+corresponding blocks from disk.
+
+A file may store the same matrix at several resolutions (levels of a
+multi-resolution pyramid).
+
+File layout:
+
+ - 8 bytes magic string ('TADBITHB')
+ - 8 bytes with the length of the header (little-endian unsigned integer)
+ - header in JSON format, with, for each level, the offsets of each array
+   (relative to the beginning of the data section)
+ - padding to align the data section on 8 bytes
+ - data section with the arrays (little-endian)
+"""
+
+from collections import OrderedDict
+from struct      import pack, unpack
+import json
+import numpy as np
+
+from pytadbit.hic_data           import SparseHiC_data
+from pytadbit.parsers.hic_parser import load_hic_data_from_reads
+from pytadbit.parsers.hic_parser import bin_reads_in_chunks
+
+MAGIC   = 'TADBITHB'
+VERSION = 1
+
+# records of the contact store (position in the matrix and number of reads)
+STORE_DTYPE = np.dtype([('key', '<i8'), ('count', '<i4')])
+
+
+def is_hic_binary(fnam):
+    """
+    :param fnam: path to a file
+
+    :returns: True if the file is a TADbit binary Hi-C matrix
+    """
+    try:
+        fhandler = open(fnam, 'rb')
+    except IOError:
+        return False
+    magic = fhandler.read(len(MAGIC))
+    fhandler.close()
+    return magic == MAGIC
+
+
+def write_hic_binary(hic_data, fnam):
+    """
+    Writes a Hi-C data object into a binary file, that can be loaded (entirely
+    or chromosome by chromosome) with :func:`load_hic_binary`.
+
+    Biases, filtered columns (bads) and expected counts are stored with the
+    interaction matrix.
+
+    :param hic_data: HiC_data (or SparseHiC_data) object, or list of HiC_data
+       objects of the same genome at different resolutions (a multi-resolution
+       pyramid, see :func:`build_hic_pyramid`)
+    :param fnam: path to the output file
+    """
+    if not isinstance(hic_data, (list, tuple)):
+        hic_data = [hic_data]
+    arrays = []
+    offset = [0]
+
+    def _add(arr):
+        arr = np.ascontiguousarray(arr)
+        arrays.append(arr)
+        beg = offset[0]
+        # keep all arrays aligned on 8 bytes
+        offset[0] += (arr.nbytes + 7) / 8 * 8
+        return {'offset': beg, 'length': len(arr), 'dtype': arr.dtype.str}
+
+    levels = [_write_level(hic, _add) for hic in
+              sorted(hic_data, key=lambda x: x.resolution)]
+    if len(set(l['resolution'] for l in levels)) != len(levels):
+        raise Exception('ERROR: each level should be at a different '
+                        'resolution')
+    header = json.dumps({'version': VERSION, 'levels': levels})
+    start = (len(MAGIC) + 8 + len(header) + 7) / 8 * 8
+    out = open(fnam, 'wb')
+    out.write(MAGIC)
+    out.write(pack('<Q', len(header)))
+    out.write(header)
+    out.write('\0' * (start - len(MAGIC) - 8 - len(header)))
+    for arr in arrays:
+        out.write(arr.tostring())
+        out.write('\0' * ((arr.nbytes + 7) / 8 * 8 - arr.nbytes))
+    out.close()
+
+
+def _write_level(hic_data, _add):
+    """
+    splits the upper triangle of the matrix in blocks, one per pair of
+    chromosomes, and registers their arrays with the _add function
+
+    :returns: the header of the level
+    """
+    size = len(hic_data)
+    if hic_data.chromosomes:
+        chromosomes = [(crm, int(hic_data.chromosomes[crm]))
+                       for crm in hic_data.chromosomes]
+    else:
+        chromosomes = [(None, size)]
+    starts = np.cumsum([0] + [n for _, n in chromosomes])
+    rows, cols, vals = hic_data.get_upper_triangle()
+    dtype = ('<i4' if vals.dtype.kind in 'iub' or not np.any(np.mod(vals, 1))
+             else '<f4')
+    # chromosome pair of each cell (rows and columns are sorted, and the
+    # stable sort keeps them sorted inside each block)
+    crm1 = starts.searchsorted(rows, side='right') - 1
+    crm2 = starts.searchsorted(cols, side='right') - 1
+    pairs = crm1 * len(chromosomes) + crm2
+    order = pairs.argsort(kind='mergesort')
+    rows, cols, vals, pairs = rows[order], cols[order], vals[order], pairs[order]
+    bounds = np.concatenate(([0], np.cumsum(np.bincount(
+        pairs, minlength=len(chromosomes)**2))))
+
+    blocks = []
+    for i in xrange(len(chromosomes)):
+        for j in xrange(i, len(chromosomes)):
+            beg, end = bounds[i * len(chromosomes) + j], bounds[i * len(chromosomes) + j + 1]
+            if beg == end:
+                continue
+            nrows = chromosomes[i][1]
+            brows = rows[beg:end] - starts[i]
+            indptr = np.zeros(nrows + 1, dtype='<i8')
+            np.cumsum(np.bincount(brows, minlength=nrows), out=indptr[1:])
+            blocks.append({'crm1'   : i, 'crm2': j, 'nnz': int(end - beg),
+                           'indptr' : _add(indptr),
+                           'indices': _add((cols[beg:end] - starts[j]).astype('<i4')),
+                           'values' : _add(vals[beg:end].astype(dtype))})
+
+    level = {'size'         : size,
+             'resolution'   : hic_data.resolution,
+             'chromosomes'  : chromosomes if hic_data.chromosomes else None,
+             'symmetricized': bool(hic_data.symmetricized),
+             'dtype'        : dtype,
+             'blocks'       : blocks}
+    if hic_data.bias:
+        bias = np.empty(size, dtype='<f8')
+        bias.fill(np.nan)
+        keys = [k for k in hic_data.bias if k < size]
+        bias[keys] = [hic_data.bias[k] for k in keys]
+        level['bias'] = _add(bias)
+    if hic_data.bads:
+        level['bads'] = _add(np.array(sorted(hic_data.bads), dtype='<i8'))
+    if hic_data.expected:
+        expc = np.array([hic_data.expected.get(d, np.nan)
+                         for d in xrange(max(hic_data.expected) + 1)],
+                        dtype='<f8')
+        level['expected'] = _add(expc)
+    return level
+
+
+def build_hic_pyramid(fnam, resolutions, outfile):
+    """
+    Bins reads once, at the finest resolution, and derives all coarser
+    resolutions by summing adjacent bins. All resolutions are stored in a
+    single binary file, from which any of them can be loaded with
+    :func:`load_hic_binary`.
+
+    :param fnam: tsv file with reads1 and reads2
+    :param resolutions: list of resolutions (in bases), each of them should be
+       a multiple of the finest one
+    :param outfile: path to the output file
+    """
+    resolutions = sorted(set(resolutions))
+    for reso in resolutions[1:]:
+        if reso % resolutions[0]:
+            raise Exception('ERROR: resolution %d is not a multiple of %d' % (
+                reso, resolutions[0]))
+    levels = [load_hic_data_from_reads(fnam, resolutions[0], sparse=True)]
+    for reso in resolutions[1:]:
+        # sum the closest level from which this resolution can be derived
+        prev = [hic for hic in levels if not reso % hic.resolution][-1]
+        levels.append(prev.rebin(reso))
+    write_hic_binary(levels, outfile)
+
+
+def read_hic_binary_header(fnam):
+    """
+    :param fnam: path to a TADbit binary Hi-C matrix
+
+    :returns: the header of the file as a dictionary. Its 'levels' entry holds,
+       for each resolution stored (from the finest one), the size of the
+       matrix, its resolution, the chromosomes (name and number of bins) and
+       the position of each array in the file
+    """
+    fhandler = open(fnam, 'rb')
+    if fhandler.read(len(MAGIC)) != MAGIC:
+        fhandler.close()
+        raise Exception('ERROR: %s is not a TADbit binary Hi-C matrix' % fnam)
+    hlen = unpack('<Q', fhandler.read(8))[0]
+    header = json.loads(fhandler.read(hlen))
+    fhandler.close()
+    for level in header['levels']:
+        if level['chromosomes']:
+            level['chromosomes'] = [(str(crm), nbins)
+                                    for crm, nbins in level['chromosomes']]
+    header['start'] = (len(MAGIC) + 8 + hlen + 7) / 8 * 8
+    return header
+
+
+def _get_level(header, resolution, fnam):
+    """
+    :returns: the header of the level at a given resolution (by default the
+       finest one)
+    """
+    if resolution is None:
+        return header['levels'][0]
+    levels = dict((l['resolution'], l) for l in header['levels'])
+    try:
+        return levels[resolution]
+    except KeyError:
+        raise Exception('ERROR: resolution %s not found in %s (%s)' % (
+            resolution, fnam, ', '.join(str(r) for r in sorted(levels))))
+
+
+def _get_array(mmap, header, info):
+    """
+    :returns: a view of an array stored in the memory-mapped file
+    """
+    beg = header['start'] + info['offset']
+    dtype = np.dtype(str(info['dtype']))
+    return np.asarray(mmap[beg:beg + info['length'] * dtype.itemsize].view(dtype))
+
+
+def _focus_segments(focus, chromosomes, resolution, fnam):
+    """
+    converts a focus (chromosome names or genomic window) into a list of
+    chromosome indexes, with the first and last bins to load
+    """
+    if focus is None:
+        return [(i, 0, n) for i, (_, n) in enumerate(chromosomes)]
+    names = [crm for crm, _ in chromosomes]
+    if isinstance(focus, basestring) and ':' in focus:
+        crm, pos = focus.rsplit(':', 1)
+        beg, end = pos.replace(',', '').split('-')
+        focus = (crm, int(beg), int(end))
+    if isinstance(focus, basestring):
+        focus = [focus]
+    elif len(focus) == 3 and isinstance(focus[1], (int, long)):
+        # genomic window
+        crm, beg, end = focus
+        if not crm in names:
+            raise Exception('ERROR: chromosome %s not found in %s' % (crm, fnam))
+        i = names.index(crm)
+        beg = max(beg / resolution, 0)
+        end = min(end / resolution + 1, chromosomes[i][1])
+        if beg >= end:
+            raise Exception('ERROR: empty region %s:%d-%d' % focus)
+        return [(i, beg, end)]
+    if any(crm not in names for crm in focus):
+        raise Exception('ERROR: chromosome(s) %s not found in %s' % (
+            ', '.join(str(crm) for crm in focus if not crm in names), fnam))
+    return [(i, 0, chromosomes[i][1])
+            for i in sorted(set(names.index(crm) for crm in focus))]
+
+
+def load_hic_binary(fnam, focus=None, resolution=None):
+    """
+    Loads a Hi-C data object from a binary file written with
+    :func:`write_hic_binary` (or :func:`build_hic_pyramid`). The file is
+    memory-mapped, only the blocks of the matrix corresponding to the requested
+    region are read.
+
+    :param fnam: path to a TADbit binary Hi-C matrix
+    :param None focus: name of a chromosome, or list of chromosome names, to
+       be loaded. Also a genomic window, as a string like 'chr1:1000000-3000000'
+       or a tuple like ('chr1', 1000000, 3000000). By default the whole genome
+       is loaded. Bins are re-indexed from the first selected bin (in the order
+       of the file).
+    :param None resolution: resolution to be loaded, if the file stores several
+       of them. By default the finest one.
+
+    :returns: a SparseHiC_data object, with its biases, bad columns and
+       expected counts
+    """
+    header = read_hic_binary_header(fnam)
+    level = _get_level(header, resolution, fnam)
+    mmap = np.memmap(fnam, dtype=np.uint8, mode='r')
+    _get = lambda info: _get_array(mmap, header, info)
+
+    chromosomes = level['chromosomes'] or [(None, level['size'])]
+    segments = _focus_segments(focus, chromosomes, level['resolution'], fnam)
+    # bin offsets in the file and in the loaded matrix
+    starts = np.cumsum([0] + [n for _, n in chromosomes])
+    new_starts = []
+    size = 0
+    for _, beg, end in segments:
+        new_starts.append(size)
+        size += end - beg
+
+    dtype = np.dtype(str(level['dtype']))
+    blocks = dict(((b['crm1'], b['crm2']), b) for b in level['blocks'])
+    genome_seq = None
+    dict_sec = {}
+    if level['chromosomes']:
+        genome_seq = OrderedDict((chromosomes[i][0], end - beg)
+                                 for i, beg, end in segments)
+        for (i, beg, end), new in zip(segments, new_starts):
+            crm = chromosomes[i][0]
+            dict_sec.update(((crm, b), new + b - beg) for b in xrange(beg, end))
+    hic_data = SparseHiC_data((), size, genome_seq, dict_sec,
+                              resolution=level['resolution'],
+                              symmetricized=level['symmetricized'],
+                              dtype=dtype)
+    i, beg, end = segments[0]
+    if len(segments) == 1 and beg == 0 and end == chromosomes[i][1]:
+        # a single intra-chromosomal block, arrays are used as they are
+        block = blocks.get((i, i))
+        if block:
+            hic_data._indptr  = _get(block['indptr'])
+            hic_data._indices = _get(block['indices'])
+            hic_data._values  = _get(block['values'])
+    else:
+        # the matrix is built row segment by row segment, each being merged
+        # from the blocks of its chromosome with the following ones
+        indptr  = [np.zeros(1, dtype=np.int64)]
+        indices = []
+        values  = []
+        for k1, (i, beg1, end1) in enumerate(segments):
+            parts = []
+            for k2 in xrange(k1, len(segments)):
+                j, beg2, end2 = segments[k2]
+                if (i, j) in blocks:
+                    parts.append(_read_block(_get, blocks[(i, j)], beg1, end1,
+                                             beg2, end2, new_starts[k2]))
+            seg_indptr, seg_indices, seg_values = _merge_row_blocks(
+                parts, end1 - beg1, dtype)
+            indptr.append(seg_indptr[1:] + indptr[-1][-1])
+            indices.append(seg_indices)
+            values.append(seg_values)
+        hic_data._indptr  = np.concatenate(indptr)
+        hic_data._indices = np.concatenate(indices)
+        hic_data._values  = np.concatenate(values)
+
+    # biases, bad columns and expected counts, re-indexed
+    old_bins = np.concatenate([np.arange(starts[i] + beg, starts[i] + end)
+                               for i, beg, end in segments])
+    if 'bias' in level:
+        bias = _get(level['bias'])[old_bins]
+        hic_data.bias = dict((k, v) for k, v in enumerate(bias.tolist())
+                             if v == v)
+    if 'bads' in level:
+        bads = _get(level['bads'])
+        new_bins = np.empty(starts[-1], dtype=np.int64)
+        new_bins.fill(-1)
+        new_bins[old_bins] = np.arange(size)
+        bads = new_bins[bads[bads < starts[-1]]]
+        hic_data.bads = dict((k, True) for k in bads[bads >= 0].tolist())
+    if 'expected' in level:
+        hic_data.expected = dict(enumerate(_get(level['expected']).tolist()))
+        # stored expected counts (default parameters) are only valid for the
+        # whole matrix
+        if focus is None:
+            hic_data._expected_cache[hic_data._expected_key()] = (
+                hic_data.expected)
+    return hic_data
+
+
+def _read_block(_get, block, beg1, end1, beg2, end2, new_beg2):
+    """
+    reads the cells of a block in rows beg1 to end1 and columns beg2 to end2
+
+    :returns: rows (relative to beg1), columns (relative to new_beg2) and
+       values of the cells, sorted by row and column
+    """
+    # only rows of the selected bins are read
+    indptr = _get(block['indptr'])[beg1:end1 + 1]
+    lo, hi = indptr[0], indptr[-1]
+    rows = np.repeat(np.arange(end1 - beg1, dtype=np.int64), np.diff(indptr))
+    cols = _get(block['indices'])[lo:hi]
+    keep = (cols >= beg2) & (cols < end2)
+    return (rows[keep], (cols[keep] - beg2 + new_beg2).astype(np.int32),
+            _get(block['values'])[lo:hi][keep])
+
+
+def _merge_row_blocks(parts, nrows, dtype):
+    """
+    merges the cells of blocks sharing the same rows, the columns of each
+    block being after those of the previous one
+
+    :returns: compressed sparse row arrays (indptr, indices and values)
+    """
+    counts = [np.bincount(rows, minlength=nrows) for rows, _, _ in parts]
+    indptr = np.zeros(nrows + 1, dtype=np.int64)
+    np.cumsum(sum(counts, np.zeros(nrows, dtype=np.int64)), out=indptr[1:])
+    indices = np.empty(indptr[-1], dtype=np.int32)
+    values  = np.empty(indptr[-1], dtype=dtype)
+    # in each row, cells of a block go after those of the previous blocks
+    prior = indptr[:-1].copy()
+    for (rows, cols, vals), count in zip(parts, counts):
+        first = np.zeros(nrows, dtype=np.int64)
+        np.cumsum(count[:-1], out=first[1:])
+        pos = prior[rows] + np.arange(len(rows)) - first[rows]
+        indices[pos] = cols
+        values[pos]  = vals
+        prior += count
+    return indptr, indices, values
+
+
+def iter_hic_binary(fnam, resolution=None, chunk=10000000):
+    """
+    Iterates over the cells of the upper triangle of a matrix stored in a
+    binary file, chunk by chunk, without loading the whole matrix.
+
+    :param fnam: path to a TADbit binary Hi-C matrix
+    :param None resolution: resolution to be read, if the file stores several
+       of them. By default the finest one.
+    :param 10000000 chunk: number of cells in each chunk
+
+    :yields: three numpy arrays with rows, columns and values of the cells of
+       each chunk
+    """
+    header = read_hic_binary_header(fnam)
+    level = _get_level(header, resolution, fnam)
+    mmap = np.memmap(fnam, dtype=np.uint8, mode='r')
+    chromosomes = level['chromosomes'] or [(None, level['size'])]
+    starts = np.cumsum([0] + [n for _, n in chromosomes])
+    for block in level['blocks']:
+        indptr  = _get_array(mmap, header, block['indptr'])
+        indices = _get_array(mmap, header, block['indices'])
+        values  = _get_array(mmap, header, block['values'])
+        for beg in xrange(0, block['nnz'], chunk):
+            end = min(beg + chunk, block['nnz'])
+            rows = indptr.searchsorted(np.arange(beg, end), side='right') - 1
+            yield (rows + starts[block['crm1']],
+                   indices[beg:end].astype(np.int64) + starts[block['crm2']],
+                   values[beg:end])
+
+
+def write_contact_store(fnam, resolution, outfile, chunk=10000000):
+    """
+    Bins reads, chunk by chunk, into a binary file of records with the
+    position of a cell in the upper triangle of the matrix (row * size +
+    column) and its number of reads. A same cell may be found in several
+    records.
+
+    :param fnam: tsv file with reads1 and reads2
+    :param resolution: the resolution of the experiment (size of a bin in
+       bases)
+    :param outfile: path to the output file
+    :param 10000000 chunk: number of reads binned at a time
+
+    :returns: the size of the matrix
+    """
+    size, binned = bin_reads_in_chunks(fnam, resolution, chunk=chunk)
+    out = open(outfile, 'wb')
+    for keys in binned:
+        keys, counts = np.unique(keys, return_counts=True)
+        records = np.empty(len(keys), dtype=STORE_DTYPE)
+        records['key'] = keys
+        records['count'] = counts
+        out.write(records.tostring())
+    out.close()
+    return size
+
+
+def iter_contact_store(fnam, size, chunk=10000000):
+    """
+    Iterates over the records of a file written by
+    :func:`write_contact_store`, chunk by chunk.
+
+    :param fnam: path to the contact store
+    :param size: size of the matrix
+    :param 10000000 chunk: number of records in each chunk
+
+    :yields: three numpy arrays with rows, columns and number of reads
+    """
+    try:
+        mmap = np.memmap(fnam, dtype=STORE_DTYPE, mode='r')
+    except ValueError: # empty file
+        return
+    for beg in xrange(0, len(mmap), chunk):
+        records = mmap[beg:beg + chunk]
+        rows, cols = np.divmod(np.asarray(records['key']), size)
+        yield rows, cols, np.asarray(records['count'])
@@ -6,10 +6,15 @@ November 7, 2013.
 from warnings                import warn
 from math                    import sqrt, isnan
 from pytadbit.parsers.gzopen import gzopen
+from pytadbit.parsers.reads_cache import load_reads_cache
+from pytadbit.utils.file_handling import magic_open
 from collections             import OrderedDict
-from pytadbit                import HiC_data
-
-HIC_DATA = True
+from itertools               import chain, izip
+from functools               import partial
+import multiprocessing as mu
+import os
+from pytadbit                import HiC_data, SparseHiC_data
+import numpy as np
 
 
 class AutoReadFail(Exception):
@@ -76,80 +81,131 @@ def symmetrize(matrix):
 def optimal_reader(f, normalized=False, resolution=1):
     """
     Reads a matrix generated by TADbit.
-    Can be slower than autoreader, but uses almost a third of the memory
+    Uses much less memory than autoreader (see :func:`bulk_reader`).
 
     :param f: an iterable (typically an open file).
     :param False normalized: if the matrix is normalized
     :param 1 resolution: resolution of the matrix
 
+    """
+    return bulk_reader(f, normalized=normalized, resolution=resolution)
+
+
+def bulk_reader(f, normalized=False, resolution=1, sparse=False, chunk=1000):
+    """
+    Reads a matrix by blocks of rows, values being parsed with NumPy. The
+    interaction matrix is built directly from the arrays of non-zero cells.
+
+    Rows may start with row names (e.g. 'chr1\t0-10000' in TADbit matrices),
+    but column names are not supported.
+
+    :param f: an iterable (typically an open file).
+    :param False normalized: if the matrix is normalized
+    :param 1 resolution: resolution of the matrix
+    :param False sparse: returns a :class:`pytadbit.hic_data.SparseHiC_data`
+       object
+    :param 1000 chunk: number of rows parsed at once
+
+    :raises AutoReadFail: if the format of the matrix is not recognized
+
+    :returns: a HiC_data object
     """
     # get masked bins
     masked = {}
-    pos = 0
-    for line in f:
+    lines = iter(f)
+    for line in lines:
         if line[0] != '#':
             break
-        pos += len(line)
         if line.startswith('# MASKED'):
             masked = dict([(int(n), True) for n in line.split()[2:]])
-    f.seek(pos)
-
-    # super fast
-    header = [tuple(line.split(None, 2)[:2]) for line in f]
-
-    f.seek(pos)
-
-    ncol = len(header)
-    
-    # Get the numeric values and remove extra columns
-    num = float if normalized else int
-    chromosomes, sections, resolution = _header_to_section(header, resolution)
-
-    #############################################################
-    # monkey patch HiC_data to make it faster
-    def fast_setitem(self, key, val):
-        "Use directly dict setitem"
-        super(HiC_data, self).__setitem__(key, val)
-
-    def fast_getitem(self, key):
-        "Use directly dict setitem"
+    else:
+        raise AutoReadFail('ERROR: empty matrix')
+    # number of row names, from the first row
+    trim = 0
+    for item in line.split():
+        try:
+            float(item)
+            break
+        except ValueError:
+            trim += 1
+    ncol = len(line.split()) - trim
+    if not ncol:
+        raise AutoReadFail('ERROR: non numeric values')
+
+    header = []
+    keys = []
+    vals = []
+    block = []
+    def parse_block():
+        "non-zero cells of the block of rows"
         try:
-            return super(HiC_data, self).__getitem__(key)
-        except KeyError:
-            return 0
-
-    original_setitem = HiC_data.__setitem__
-    original_getitem = HiC_data.__getitem__
-    # apply_async the patch
-    HiC_data.__setitem__ = fast_setitem
-    HiC_data.__getitem__ = fast_getitem
-
-    hic = HiC_data(((j, num(v))
-                    for i, line in enumerate(f)
-                    for j, v in enumerate(line.split()[2:], i * ncol)
-                    if num(v)), size=ncol, masked=masked,
-                   dict_sec=sections, chromosomes=chromosomes,
-                   resolution=resolution, symmetricized=False)
+            values = np.array(' '.join(block).split(), dtype=float)
+        except ValueError:
+            raise AutoReadFail('ERROR: non numeric values')
+        if values.size != len(block) * ncol:
+            raise AutoReadFail('ERROR: unequal column number')
+        if not normalized:
+            # interaction counts, NaNs are set to zero
+            values[np.isnan(values)] = 0
+            values = np.floor(values + .5).astype(np.int64)
+        nonzero = np.flatnonzero(values)
+        keys.append(nonzero + (len(header) - len(block)) * ncol)
+        vals.append(values[nonzero])
+        del block[:]
+
+    for line in chain([line], lines):
+        if not line.strip():
+            continue
+        items = line.split(None, trim)
+        header.append(tuple(items[:trim]))
+        block.append(items[trim] if trim else line)
+        if len(block) == chunk:
+            parse_block()
+    if block:
+        parse_block()
+    size = len(header)
+    if size != ncol:
+        raise AutoReadFail('ERROR: non square matrix')
+    if not trim:
+        header = range(1, size + 1)
+    keys = np.concatenate(keys)
+    vals = np.concatenate(vals)
 
     # make it symmetric
-    if is_asymmetric_dico(hic):
-        hic.symmetricized = True
-        symmetrize_dico(hic)
-
-    # undo patching
-    HiC_data.__setitem__ = original_setitem
-    HiC_data.__getitem__ = original_getitem
-    hic.__setitem__ = original_setitem
-    hic.__getitem__ = original_getitem
-    #############################################################
-    return hic
-
+    rows, cols = np.divmod(keys, size)
+    tkeys = cols * size + rows
+    order = tkeys.argsort()
+    symmetricized = not (np.array_equal(keys, tkeys[order]) and
+                         np.all((vals == vals[order]) |
+                                (np.isnan(vals) & np.isnan(vals[order]))))
+    if symmetricized:
+        warn('WARNING: matrix not symmetric: summing cell_ij with cell_ji')
+        keys, inverse = np.unique(np.concatenate((keys, tkeys)),
+                                  return_inverse=True)
+        vals = np.bincount(inverse, weights=np.concatenate((vals, vals)))
+        if not normalized:
+            vals = vals.astype(np.int64)
+        rows, cols = np.divmod(keys, size)
 
-def autoreader(f):
+    chromosomes, sections, resolution = _header_to_section(header, resolution)
+    if sparse:
+        upper = rows <= cols
+        return SparseHiC_data((), size, dict_sec=sections,
+                              chromosomes=chromosomes, masked=masked,
+                              resolution=resolution,
+                              symmetricized=symmetricized,
+                              coo=(rows[upper], cols[upper], vals[upper]))
+    return HiC_data(izip(keys.tolist(), vals.tolist()), size,
+                    dict_sec=sections, chromosomes=chromosomes, masked=masked,
+                    resolution=resolution, symmetricized=symmetricized)
+
+
+def autoreader(f, hic=True):
     """
     Auto-detect matrix format of HiC data file.
     
     :param f: an iterable (typically an open file).
+    :param True hic: if False, values are parsed as normalized data (floats)
     
     :returns: A tuple with integer values and the dimension of
        the matrix.
@@ -216,11 +272,11 @@ def autoreader(f):
         nrow -= 1
         header = [tuple([a for a in line[:trim]]) for line in items]
     # Get the numeric values and remove extra columns
-    num = int if HIC_DATA else float
+    num = int if hic else float
     try:
         items = [[num(a) for a in line[trim:]] for line in items]
     except ValueError:
-        if not HIC_DATA:
+        if not hic:
             raise AutoReadFail('ERROR: non numeric values')
         try:
             # Dekker data 2009, uses integer but puts a comma... 
@@ -282,6 +338,24 @@ def _header_to_section(header, resolution):
             chromosomes[h[0]] += 1
     return chromosomes, sections, resolution
 
+def _bulk_read(thing, hic, resolution, sparse=False):
+    """
+    reads a matrix file with bulk_reader
+
+    :returns: a HiC_data object, or None if the format of the matrix is not
+       recognized
+    """
+    try:
+        if isinstance(thing, str):
+            with gzopen(thing) as fhandler:
+                return bulk_reader(fhandler, normalized=not hic,
+                                   resolution=resolution, sparse=sparse)
+        return bulk_reader(thing, normalized=not hic, resolution=resolution,
+                           sparse=sparse)
+    except AutoReadFail:
+        return None
+
+
 def read_matrix(things, parser=None, hic=True, resolution=1, **kwargs):
     """
     Read and checks a matrix from a file (using
@@ -304,24 +378,60 @@ def read_matrix(things, parser=None, hic=True, resolution=1, **kwargs):
        ``([629, 86, 159, 100, 164, 612, 216, 111, 88, 175, 437, 146, 105, 110,
        105, 278])``
 
+       If no parser is given, files are first read with
+       :func:`bulk_reader`, and with :func:`autoreader` if their format is not
+       recognized.
     :param 1 resolution: resolution of the matrix
     :param True hic: if False, TADbit assumes that files contains normalized
        data
+    :param 1 ncpus: number of processes used to read several files in parallel
+    :param False sparse: returns :class:`pytadbit.hic_data.SparseHiC_data`
+       objects (built directly from the parsed arrays when files are read in
+       bulk)
     :returns: the corresponding matrix concatenated into a huge list, also
        returns number or rows
 
     """
     one = kwargs.get('one', True)
-    global HIC_DATA
-    HIC_DATA = hic
-    parser = parser or autoreader
+    ncpus = kwargs.get('ncpus', 1)
+    sparse = kwargs.get('sparse', False)
     if not isinstance(things, list):
         things = [things]
+    # files are read in bulk, in parallel if there are several
+    bulk = [None] * len(things)
+    if not parser:
+        paths = [i for i, thing in enumerate(things)
+                 if isinstance(thing, str) and os.path.isfile(thing)]
+        if ncpus > 1 and len(paths) > 1:
+            pool = mu.Pool(min(ncpus, len(paths)))
+            procs = [(i, pool.apply_async(_bulk_read,
+                                          args=(things[i], hic, resolution,
+                                                sparse)))
+                     for i in paths]
+            pool.close()
+            pool.join()
+            for i, proc in procs:
+                bulk[i] = proc.get()
+        else:
+            for i in paths:
+                bulk[i] = _bulk_read(things[i], hic, resolution, sparse)
+    auto = parser in (None, autoreader)
+    if auto:
+        parser = partial(autoreader, hic=hic)
     matrices = []
-    for thing in things:
-        if isinstance(thing, HiC_data):
+    for thing, matrix in zip(things, bulk):
+        if matrix is not None:
+            matrices.append(matrix)
+        elif isinstance(thing, HiC_data):
             matrices.append(thing)
         elif isinstance(thing, file):
+            if auto:
+                matrix = _bulk_read(thing, hic, resolution, sparse)
+                if matrix is not None:
+                    thing.close()
+                    matrices.append(matrix)
+                    continue
+                thing.seek(0)
             matrix, size, header, masked, sym = parser(thing)
             thing.close()
             chromosomes, sections, resolution = _header_to_section(header,
@@ -377,6 +487,9 @@ def read_matrix(things, parser=None, hic=True, resolution=1, **kwargs):
                                       if matrix[i]], size))
         else:
             raise Exception('Unable to read this file or whatever it is :)')
+    if sparse:
+        matrices = [m if isinstance(m, SparseHiC_data) else m.to_sparse()
+                    for m in matrices]
     if one:
         return matrices[0]
     else:
@@ -386,45 +499,245 @@ def load_hic_data_from_reads(fnam, resolution, **kwargs):
     """
     :param fnam: tsv file with reads1 and reads2
     :param resolution: the resolution of the experiment (size of a bin in
-       bases)
+       bases). A list of resolutions can also be given, in which case the
+       reads are read only once, and one matrix per resolution is returned
     :param genome_seq: a dictionary containing the genomic sequence by
        chromosome
     :param False get_sections: for very very high resolution, when the column
        index does not fit in memory
+    :param False sparse: store the interaction matrix in NumPy arrays (see
+       :class:`pytadbit.hic_data.SparseHiC_data`), uses much less memory
+    :param 1000000 chunk: number of reads binned at a time
+
+    :returns: a HiC_data object, or a list of them if several resolutions were
+       given
     """
-    sections = []
-    genome_seq = OrderedDict()
-    fhandler = open(fnam)
+    resolutions = resolution if isinstance(resolution, list) else [resolution]
+    get_sections = kwargs.get('get_sections', True)
+    crm_lengths, pairs = _pairs_from_file(fnam,
+                                          chunk=kwargs.get('chunk', 1000000))
+    headers = [_reads_header(crm_lengths, reso, get_sections)
+               for reso in resolutions]
+    counts = [(np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64))
+              for _ in resolutions]
+    for bufs in _binned_reads(pairs, crm_lengths, resolutions, get_sections):
+        counts = [_add_counts(keys, vals, buf)
+                  for (keys, vals), buf in zip(counts, bufs)]
+    matrices = []
+    for reso, (size, genome_seq, dict_sec), (keys, vals) in zip(
+        resolutions, headers, counts):
+        rows, cols = np.divmod(keys, size)
+        if kwargs.get('sparse', False):
+            matrices.append(SparseHiC_data(
+                (), size, genome_seq, dict_sec, resolution=reso,
+                symmetricized=True, coo=(rows, cols, vals)))
+            continue
+        # both halves of the matrix
+        lower = rows != cols
+        keys = np.concatenate((keys, cols[lower] * size + rows[lower]))
+        vals = np.concatenate((vals, vals[lower]))
+        matrices.append(HiC_data(izip(keys.tolist(), vals.tolist()), size,
+                                 genome_seq, dict_sec, resolution=reso,
+                                 symmetricized=True))
+    if isinstance(resolution, list):
+        return matrices
+    return matrices[0]
+
+
+def _read_crm_lengths(fhandler):
+    """
+    Reads the header of a file with reads1 and reads2 (chromosome sizes)
+
+    :returns: the first line after the header, and the length of each
+       chromosome
+    """
+    crm_lengths = OrderedDict()
     line = fhandler.next()
-    size = 0
     while line.startswith('#'):
         if line.startswith('# CRM '):
             crm, clen = line[6:].split()
-            genome_seq[crm] = int(clen) / resolution + 1
-            size += genome_seq[crm]
+            crm_lengths[crm] = int(clen)
         line = fhandler.next()
-    section_sizes = {}
-    if kwargs.get('get_sections', True):
+    return line, crm_lengths
+
+
+def _reads_header(crm_lengths, resolution, get_sections=True):
+    """
+    :returns: the size of the matrix, the number of bins per chromosome and
+       the index of each bin, at a given resolution
+    """
+    genome_seq = OrderedDict((crm, crm_lengths[crm] / resolution + 1)
+                             for crm in crm_lengths)
+    size = sum(genome_seq.values())
+    sections = []
+    if get_sections:
         for crm in genome_seq:
-            len_crm = genome_seq[crm]
-            section_sizes[(crm,)] = len_crm
-            sections.extend([(crm, i) for i in xrange(len_crm)])
+            sections.extend([(crm, i) for i in xrange(genome_seq[crm])])
     dict_sec = dict([(j, i) for i, j in enumerate(sections)])
-    imx = HiC_data((), size, genome_seq, dict_sec, resolution=resolution)
-    try:
-        while True:
-            _, cr1, ps1, _, _, _, _, cr2, ps2, _ = line.split('\t', 9)
-            try:
-                ps1 = dict_sec[(cr1, int(ps1) / resolution)]
-                ps2 = dict_sec[(cr2, int(ps2) / resolution)]
-            except KeyError:
-                ps1 = int(ps1) / resolution
-                ps2 = int(ps2) / resolution
-            imx[ps1, ps2] += 1
-            imx[ps2, ps1] += 1
-            line = fhandler.next()
-    except StopIteration:
-        pass
-    imx.symmetricized = True
-    return imx
+    return size, genome_seq, dict_sec
+
+
+def _read_reads_header(fhandler, resolution, get_sections=True):
+    """
+    Reads the header of a file with reads1 and reads2 (chromosome sizes)
+
+    :returns: the first line after the header, the size of the matrix, the
+       number of bins per chromosome and the index of each bin
+    """
+    line, crm_lengths = _read_crm_lengths(fhandler)
+    size, genome_seq, dict_sec = _reads_header(crm_lengths, resolution,
+                                               get_sections)
+    return line, size, genome_seq, dict_sec
+
+
+def _read_pairs(fhandler, line, crm_ids, chunk=1000000):
+    """
+    Reads the chromosome and the position of both reads of each pair, chunk
+    by chunk. Chromosome names are converted to their index in crm_ids (-1 if
+    not there).
+
+    :yields: four arrays with the chromosomes and positions of the first
+       reads, and the chromosomes and positions of the second reads
+    """
+    lines = [line]
+    for line in fhandler:
+        lines.append(line)
+        if len(lines) >= chunk:
+            yield _pairs_to_arrays(lines, crm_ids)
+            lines = []
+    fhandler.close()
+    if lines:
+        yield _pairs_to_arrays(lines, crm_ids)
+
+
+def _read_cached_pairs(columns, chunk=1000000):
+    """
+    Same as :func:`_read_pairs`, from the binary columns written by
+    :class:`pytadbit.parsers.reads_cache.ReadsCacheWriter`
+    """
+    for beg in xrange(0, len(columns['pos1']), chunk):
+        yield tuple(np.array(columns[col][beg:beg + chunk], dtype=np.int64)
+                    for col in ('crm1', 'pos1', 'crm2', 'pos2'))
+
+
+def _pairs_from_file(fnam, chunk=1000000):
+    """
+    Uses the binary columns of fnam if they are up to date, and parses the
+    text file otherwise.
+
+    :returns: the length of each chromosome, and an iterator over chunks of
+       pairs of reads (see :func:`_read_pairs`)
+    """
+    cached = load_reads_cache(fnam)
+    if cached is not None:
+        crm_lengths, columns = cached
+        return crm_lengths, _read_cached_pairs(columns, chunk=chunk)
+    fhandler = magic_open(fnam)
+    line, crm_lengths = _read_crm_lengths(fhandler)
+    crm_ids = dict((crm, i) for i, crm in enumerate(crm_lengths))
+    return crm_lengths, _read_pairs(fhandler, line, crm_ids, chunk=chunk)
+
 
+def _pairs_to_arrays(lines, crm_ids):
+    _, cr1, ps1, _, _, _, _, cr2, ps2, _ = zip(*[line.split('\t', 9)
+                                                 for line in lines])
+    return (_crm_indexes(cr1, crm_ids), np.array(ps1).astype(np.int64),
+            _crm_indexes(cr2, crm_ids), np.array(ps2).astype(np.int64))
+
+
+def _crm_indexes(crms, crm_ids):
+    """
+    converts chromosome names into indexes, looking up each name only once
+    """
+    names, inverse = np.unique(np.array(crms), return_inverse=True)
+    return np.array([crm_ids.get(n, -1) for n in names.tolist()],
+                    dtype=np.int64)[inverse]
+
+
+def _to_bins(crms, poss, nbins, offsets, resolution):
+    """
+    :returns: the bin of each read in the matrix, and whether the read falls
+       in one of the chromosomes listed in the header
+    """
+    bins = poss / resolution
+    known = np.zeros(len(bins), dtype=bool)
+    if len(nbins):
+        idx = np.flatnonzero(crms >= 0)
+        known[idx[bins[idx] < nbins[crms[idx]]]] = True
+        bins[known] += offsets[crms[known]]
+    return bins, known
+
+
+def _binned_reads(pairs, crm_lengths, resolutions, get_sections=True):
+    """
+    Bins reads, chunk by chunk, at one or several resolutions.
+
+    :param pairs: iterator over chunks of pairs of reads (see
+       :func:`_read_pairs`)
+
+    :yields: for each resolution, an array with the positions
+       (row * size + column) in the upper triangle of the matrix of a chunk
+       of reads. Positions in the diagonal are repeated, as diagonal cells are
+       counted twice in HiC_data
+    """
+    levels = []
+    for reso in resolutions:
+        if get_sections:
+            nbins = np.array([crm_lengths[crm] / reso + 1
+                              for crm in crm_lengths], dtype=np.int64)
+        else:
+            nbins = np.zeros(0, dtype=np.int64)
+        offsets = np.concatenate(([0], np.cumsum(nbins)[:-1])).astype(np.int64)
+        size = sum(crm_lengths[crm] / reso + 1 for crm in crm_lengths)
+        levels.append((reso, nbins, offsets, size))
+    for cr1, ps1, cr2, ps2 in pairs:
+        bufs = []
+        for reso, nbins, offsets, size in levels:
+            bins1, known1 = _to_bins(cr1, ps1, nbins, offsets, reso)
+            bins2, known2 = _to_bins(cr2, ps2, nbins, offsets, reso)
+            # pairs out of the chromosomes listed in the header are binned
+            # as if the genome had a single chromosome
+            unknown = ~(known1 & known2)
+            bins1[unknown] = ps1[unknown] / reso
+            bins2[unknown] = ps2[unknown] / reso
+            keys = np.minimum(bins1, bins2) * size + np.maximum(bins1, bins2)
+            # diagonal cells are counted twice in HiC_data
+            bufs.append(np.concatenate((keys, keys[bins1 == bins2])))
+        yield bufs
+
+
+def _add_counts(keys, vals, buf):
+    """
+    adds the counts of the positions in buf to the counts (vals) of the
+    sorted positions in keys
+
+    :returns: the new sorted positions and their counts
+    """
+    new_keys, counts = np.unique(buf, return_counts=True)
+    # merge both sorted runs: positions already counted are incremented, and
+    # the others inserted in place
+    idx = np.searchsorted(keys, new_keys)
+    found = idx < len(keys)
+    found[found] = keys[idx[found]] == new_keys[found]
+    vals[idx[found]] += counts[found]
+    return (np.insert(keys, idx[~found], new_keys[~found]),
+            np.insert(vals, idx[~found], counts[~found]))
+
+
+def bin_reads_in_chunks(fnam, resolution, chunk=10000000):
+    """
+    Bins reads chunk by chunk, without building the interaction matrix.
+
+    :param fnam: tsv file with reads1 and reads2
+    :param resolution: the resolution of the experiment (size of a bin in
+       bases)
+    :param 10000000 chunk: number of reads binned at a time
+
+    :returns: the size of the matrix, and an iterator over arrays with the
+       position (row * size + column) of each read in the upper triangle of
+       the matrix (reads in the diagonal are repeated)
+    """
+    crm_lengths, pairs = _pairs_from_file(fnam, chunk=chunk)
+    size, _, _ = _reads_header(crm_lengths, resolution, get_sections=False)
+    return size, (bufs[0] for bufs in _binned_reads(pairs, crm_lengths,
+                                                    [resolution]))
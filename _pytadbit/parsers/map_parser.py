@@ -2,13 +2,15 @@
 22 may 2015
 """
 
-from pytadbit.utils.file_handling         import magic_open
-from bisect                               import bisect_right as bisect
-from pytadbit.mapping.restriction_enzymes import map_re_sites
+from pytadbit.utils.file_handling         import magic_open, magic_write
+from pytadbit.mapping.restriction_enzymes import index_re_sites
+from pytadbit.mapping.restriction_enzymes import re_fragment_bounds
 from warnings                             import warn
-from sys                                  import stdout
 from subprocess                           import Popen
+from heapq                                import merge
+import multiprocessing as mu
 import os
+import numpy as np
 
 def parse_map(f_names1, f_names2=None, out_file1=None, out_file2=None,
               genome_seq=None, re_name=None, verbose=False, clean=True,
@@ -31,7 +33,8 @@ def parse_map(f_names1, f_names2=None, out_file1=None, out_file2=None,
     :param out_file1: path to outfile tab separated format containing mapped
        read1 information
     :param out_file2: path to outfile tab separated format containing mapped
-       read2 information
+       read2 information. Outfiles with names ending in '.gz' are compressed
+       (see :func:`pytadbit.utils.file_handling.magic_write`)
     :param genome_seq: a dictionary generated by :func:`pyatdbit.parser.genome_parser.parse_fasta`.
        containing the genomic sequence
     :param re_name: name of the restriction enzyme used
@@ -39,6 +42,11 @@ def parse_map(f_names1, f_names2=None, out_file1=None, out_file2=None,
        multiple-contacts
     :param False compress: compress (gzip) input map files. This is done in the
        background while next MAP files are parsed, or while files are sorted.
+    :param 1 ncpus: number of MAP files to be parsed (and sorted) in parallel.
+       Sorted chunks are then merged all at once.
+    :param False read_ids: replace read names by integer IDs, common to both
+       read ends (see :func:`merge_parsed_read_ids`). Original names are kept
+       in a separate file, next to out_file1.
     """
     # not nice, dirty fix in order to allow this function to only parse
     # one SAM file
@@ -50,12 +58,13 @@ def parse_map(f_names1, f_names2=None, out_file1=None, out_file2=None,
         raise Exception('ERROR: genome_seq should be given\n')
     if (f_names2 and not out_file2) or (not f_names2 and out_file2):
         raise Exception('ERROR: out_file2 AND f_names2 needed\n')
+    read_ids = kwargs.get('read_ids', False)
+    if read_ids and not f_names2:
+        raise Exception('ERROR: read_ids needs both read ends to be parsed\n')
 
-    frag_chunk = kwargs.get('frag_chunk', 100000)
     if verbose:
         print 'Searching and mapping RE sites to the reference genome'
-    frags = map_re_sites(re_name, genome_seq, frag_chunk=frag_chunk,
-                         verbose=verbose)
+    frags = index_re_sites(re_name, genome_seq, verbose=verbose)
 
     if isinstance(f_names1, str):
         f_names1 = [f_names1]
@@ -70,126 +79,154 @@ def parse_map(f_names1, f_names2=None, out_file1=None, out_file2=None,
 
     # max number of reads per intermediate files for sorting
     max_size = 1000000
-    
-    windows = {}
-    multis  = {}
-    procs   = []
+
+    ncpus = kwargs.get('ncpus', 1)
+    pool = mu.Pool(ncpus) if ncpus > 1 else None
+
+    windows   = {}
+    multis    = {}
+    procs     = []
+    tmp_files = {}
+
+    def _collect(read, fnam, num, result):
+        if result is None:
+            warn('WARNING: file "%s" not found\n' % fnam)
+            return
+        read_count, files = result
+        windows[read][num] = read_count
+        tmp_files[read].extend(files)
+        if kwargs.get('compress', False) and fnam.endswith('.map'):
+            print 'compressing input MAP file'
+            procs.append(Popen(['gzip', fnam]))
+
+    # each MAP file is parsed independently (in parallel if ncpus > 1), its
+    # reads being written into sorted temporary files
+    jobs = {}
     for read in range(len(fnames)):
         if verbose:
             print 'Loading read' + str(read + 1)
-        windows[read] = {}
+        windows[read]   = {}
+        tmp_files[read] = []
+        jobs[read]      = []
         num = 0
-        # iteration over reads
-        nfile = 0
-        tmp_files = []
-        reads     = []
-        for fnam in fnames[read]:
-            try:
-                fhandler = magic_open(fnam)
-            except IOError:
-                warn('WARNING: file "%s" not found\n' % fnam)
-                continue
+        for ifile, fnam in enumerate(fnames[read]):
             # get the iteration number of the iterative mapping
             try:
                 num = int(fnam.split('.')[-1].split(':')[0])
             except:
                 num += 1
-            # set read counter
             if verbose:
                 print 'loading file: %s' % (fnam)
-            # start parsing
-            read_count = 0
-            try:
-                while not False:
-                    for _ in xrange(max_size):
-                        try:
-                            reads.append(read_read(fhandler.next(), frags,
-                                                   frag_chunk))
-                        except KeyError:
-                            # Chromosome not in hash
-                            continue
-                        read_count += 1
-                    nfile += 1
-                    write_reads_to_file(reads, outfiles[read], tmp_files, nfile)
-            except StopIteration:
-                fhandler.close()
-                nfile += 1
-                write_reads_to_file(reads, outfiles[read], tmp_files, nfile)
-            windows[read][num] = read_count
-            if kwargs.get('compress', False) and fnam.endswith('.map'):
-                print 'compressing input MAP file'
-                procs.append(Popen(['gzip', fnam]))
-        nfile += 1
-        write_reads_to_file(reads, outfiles[read], tmp_files, nfile)
-
-        # we have now sorted temporary files
-        # we do merge sort for eah pair
+            args = (fnam, frags, outfiles[read], '%03d' % ifile, max_size)
+            if pool:
+                jobs[read].append((fnam, num,
+                                   pool.apply_async(_parse_map_file, args)))
+            else:
+                _collect(read, fnam, num, _parse_map_file(*args))
+    if pool:
+        pool.close()
+        for read in jobs:
+            for fnam, num, job in jobs[read]:
+                _collect(read, fnam, num, job.get())
+        pool.join()
+
+    # we have now sorted temporary files, that are merged all at once
+    if read_ids:
         if verbose:
-            stdout.write('Merge sort')
-            stdout.flush()
-        while len(tmp_files) > 1:
-            file1 = tmp_files.pop(0)
-            try:
-                file2 = tmp_files.pop(0)
-            except IndexError:
-                break
+            print 'Merging sorted reads, getting multiple contacts and read IDs'
+        multis = merge_parsed_read_ids(tmp_files, outfiles, genome_seq,
+                                       windows, clean=clean)
+    else:
+        for read in range(len(fnames)):
             if verbose:
-                stdout.write('.')
-            stdout.flush()
-            nfile += 1
-            tmp_files.append(merge_sort(file1, file2, outfiles[read], nfile))
-        if verbose:
-            stdout.write('\n')
-        tmp_name = tmp_files[0]
-        
-        if verbose:
-            print 'Getting Multiple contacts'
-        reads_fh = open(outfiles[read], 'w')
-        ## Also pipe file header
-        # chromosome sizes (in order)
-        reads_fh.write('# Chromosome lengths (order matters):\n')
-        for crm in genome_seq:
-            reads_fh.write('# CRM %s\t%d\n' % (crm, len(genome_seq[crm])))
-        reads_fh.write('# Mapped\treads count by iteration\n')
-        for size in windows[read]:
-            reads_fh.write('# MAPPED %d %d\n' % (size, windows[read][size]))
-
-        ## Multicontacts
-        tmp_reads_fh = open(tmp_name)
-        try:
-            read_line = tmp_reads_fh.next()
-        except StopIteration:
-            raise StopIteration('ERROR!\n Nothing parsed, check input files and'
-                                ' chromosome names (in genome.fasta and SAM/MAP'
-                                ' files).')
-        prev_head = read_line.split('\t', 1)[0]
-        prev_head = prev_head.split('~' , 1)[0]
-        prev_read = read_line
-        multis[read] = 0
-        for read_line in tmp_reads_fh:
-            head = read_line.split('\t', 1)[0]
-            head = head.split('~' , 1)[0]
-            if head == prev_head:
-                multis[read] += 1
-                prev_read =  prev_read.strip() + '|||' + read_line
-            else:
-                reads_fh.write(prev_read)
-                prev_read = read_line
-            prev_head = head
-        reads_fh.write(prev_read)
-        reads_fh.close()
-        if clean:
-            os.system('rm -rf ' + tmp_name)
+                print 'Merging sorted reads and getting multiple contacts'
+            multis[read] = merge_parsed_reads(tmp_files[read], outfiles[read],
+                                              genome_seq, windows[read],
+                                              clean=clean)
     # wait for compression to finish
     for p in procs:
         p.communicate()
     return windows, multis
 
+
+def _parse_map_file(fnam, frags, outfile, label, max_size=1000000):
+    """
+    Parses one MAP file, writing its reads into sorted temporary files of
+    max_size reads.
+
+    :returns: the number of reads parsed and the list of temporary files, or
+       None if the file was not found
+    """
+    try:
+        fhandler = magic_open(fnam)
+    except IOError:
+        return None
+    tmp_files  = []
+    reads      = []
+    read_count = 0
+    nfile      = 0
+    for line in fhandler:
+        try:
+            reads.append(read_read(line))
+        except KeyError:
+            continue
+        if len(reads) >= max_size:
+            nfile += 1
+            lines = reads_to_lines(reads, frags)
+            read_count += len(lines)
+            write_reads_to_file(lines, outfile, tmp_files,
+                                '%s_%03d' % (label, nfile))
+            reads = []
+    fhandler.close()
+    nfile += 1
+    lines = reads_to_lines(reads, frags)
+    read_count += len(lines)
+    write_reads_to_file(lines, outfile, tmp_files, '%s_%03d' % (label, nfile))
+    return read_count, tmp_files
+
+
+def reads_to_lines(reads, frags):
+    """
+    Finds the RE fragment of a batch of reads, and formats them as lines of
+    the output of :func:`parse_map`.
+
+    :param reads: list of tuples with the name, chromosome, position, strand
+       (1 for positive) and mapped length of each read
+    :param frags: dictionary generated by
+       :func:`pytadbit.mapping.restriction_enzymes.index_re_sites`
+
+    :returns: a list of lines, reads on chromosomes not in frags being
+       dropped
+    """
+    if not reads:
+        return []
+    names, crms, poss, strands, lens = zip(*reads)
+    crms = np.array(crms)
+    poss = np.array(poss, dtype=np.int64)
+    lens = np.array(lens, dtype=np.int64)
+    prev_re = np.zeros(len(poss), dtype=np.int64)
+    next_re = np.zeros(len(poss), dtype=np.int64)
+    known   = np.zeros(len(poss), dtype=bool)
+    for crm in np.unique(crms).tolist():
+        if crm not in frags:
+            # Chromosome not in hash
+            continue
+        idx = np.flatnonzero(crms == crm)
+        poss[idx], prev_re[idx], next_re[idx] = re_fragment_bounds(
+            frags[crm], poss[idx], lens[idx])
+        known[idx] = True
+    return ['%s\t%s\t%d\t%d\t%d\t%d\t%d\n' % read for read, ok in zip(
+        zip(names, crms.tolist(), poss.tolist(), strands, lens.tolist(),
+            prev_re.tolist(), next_re.tolist()), known.tolist()) if ok]
+
+
 def write_reads_to_file(reads, outfiles, tmp_files, nfile):
     if not reads: # can be...
         return
+    if isinstance(nfile, int):
+        nfile = '%03d' % nfile
     tmp_name = os.path.join(*outfiles.split('/')[:-1] +
-                            [('tmp_%03d_' % nfile) + outfiles.split('/')[-1]])
+                            [('tmp_%s_' % nfile) + outfiles.split('/')[-1]])
     tmp_name = ('/' * outfiles.startswith('/')) + tmp_name
     tmp_files.append(tmp_name)
     out = open(tmp_name, 'w')
@@ -197,43 +234,161 @@ def write_reads_to_file(reads, outfiles, tmp_files, nfile):
     out.close()
     del(reads[:]) # empty list
 
-def merge_sort(file1, file2, outfiles, nfile):
-    tmp_name = os.path.join(*outfiles.split('/')[:-1] +
-                            [('tmp_merged_%03d_' % nfile) + outfiles.split('/')[-1]])
-    tmp_name = ('/' * outfiles.startswith('/')) + tmp_name
-    tmp_file = open(tmp_name, 'w')
-    fh1 = open(file1)
-    fh2 = open(file2)
-    greater = lambda x, y: x.split('\t', 1)[0].split('~')[0] > y.split('\t', 1)[0].split('~')[0]
-    read1 = fh1.next()
-    read2 = fh2.next()
-    while True:
-        if greater(read2, read1):
-            tmp_file.write(read1)
-            try:
-                read1 = fh1.next()
-            except StopIteration:
-                tmp_file.write(read2)
-                break
+
+def _sorted_reads(fname, idx):
+    """
+    iterates over a sorted temporary file, yielding the read ID (used to sort),
+    the index of the file (to keep the merge stable) and the line
+    """
+    fhandler = open(fname)
+    for line in fhandler:
+        yield line.split('\t', 1)[0].split('~', 1)[0], idx, line
+    fhandler.close()
+
+
+def _write_header(reads_fh, genome_seq, windows, names_path=None):
+    """
+    writes the header of the output of :func:`parse_map`
+    """
+    # chromosome sizes (in order)
+    reads_fh.write('# Chromosome lengths (order matters):\n')
+    for crm in genome_seq:
+        reads_fh.write('# CRM %s\t%d\n' % (crm, len(genome_seq[crm])))
+    if names_path:
+        reads_fh.write('# READ IDS\t%s\n' % names_path)
+    reads_fh.write('# Mapped\treads count by iteration\n')
+    for size in windows:
+        reads_fh.write('# MAPPED %d %d\n' % (size, windows[size]))
+
+
+def merge_parsed_reads(tmp_files, outfile, genome_seq, windows, clean=True):
+    """
+    Merges, in a single pass, all the sorted temporary files of one read end
+    into the final output file. Reads found several times (multiple contacts)
+    are joined with '|||' while merging.
+
+    :param tmp_files: list of paths to sorted temporary files
+    :param outfile: path to the output file
+    :param genome_seq: dictionary with the genomic sequence (only used to
+       write the header)
+    :param windows: dictionary with the number of reads mapped by iteration
+    :param True clean: remove temporary files
+
+    :returns: the number of multiple contacts found
+    """
+    reads_fh = magic_write(outfile)
+    ## Also pipe file header
+    _write_header(reads_fh, genome_seq, windows)
+
+    ## Multicontacts
+    multis    = 0
+    prev_head = None
+    prev_read = None
+    for head, _, read_line in merge(*[_sorted_reads(fname, i)
+                                      for i, fname in enumerate(tmp_files)]):
+        if head == prev_head:
+            multis += 1
+            prev_read =  prev_read.strip() + '|||' + read_line
         else:
-            tmp_file.write(read2)
-            try:
-                read2 = fh2.next()
-            except StopIteration:
-                tmp_file.write(read1)
-                break
-    for read in fh1:
-        tmp_file.write(read)
-    for read in fh2:
-        tmp_file.write(read)
-    fh1.close()
-    fh2.close()
-    tmp_file.close()
-    os.system('rm -f ' + file1)
-    os.system('rm -f ' + file2)
-    return tmp_name
-
-def read_read(r, frags, frag_chunk):
+            if prev_read is not None:
+                reads_fh.write(prev_read)
+            prev_read = read_line
+        prev_head = head
+    if prev_read is None:
+        reads_fh.close()
+        raise StopIteration('ERROR!\n Nothing parsed, check input files and'
+                            ' chromosome names (in genome.fasta and SAM/MAP'
+                            ' files).')
+    reads_fh.write(prev_read)
+    reads_fh.close()
+    if clean:
+        for fname in tmp_files:
+            os.remove(fname)
+    return multis
+
+
+def read_names_path(fnam):
+    """
+    :returns: the path to the file with the original read names of a file
+       parsed with integer read IDs (one name per line, line N corresponding
+       to the read ID N)
+    """
+    return fnam + '_read_names.txt'
+
+
+def merge_parsed_read_ids(tmp_files, outfiles, genome_seq, windows,
+                          clean=True):
+    """
+    Merges, in a single pass, the sorted temporary files of both read ends
+    into their final output files, replacing read names by integer IDs.
+
+    IDs are given by order of read name, counting from 0, and are common to
+    both ends. The suffix of multiple contacts ('~N~') is kept after the ID.
+    The original names are written to the file returned by
+    :func:`read_names_path` for the output file of the first read end.
+
+    :param tmp_files: dictionary with the list of paths to sorted temporary
+       files of each read end
+    :param outfiles: paths to the output files of each read end
+    :param genome_seq: dictionary with the genomic sequence (only used to
+       write the header)
+    :param windows: dictionary with the number of reads mapped by iteration
+       for each read end
+    :param True clean: remove temporary files
+
+    :returns: a dictionary with the number of multiple contacts found for each
+       read end
+    """
+    names_path = read_names_path(outfiles[0])
+    names_fh   = magic_write(names_path)
+    reads_fhs  = []
+    for read, outfile in enumerate(outfiles):
+        reads_fhs.append(magic_write(outfile))
+        _write_header(reads_fhs[read], genome_seq, windows[read], names_path)
+
+    multis    = dict((read, 0) for read in tmp_files)
+    prev_head = [None] * len(outfiles)
+    prev_read = [None] * len(outfiles)
+    last_name = None
+    read_id   = -1
+    for head, (read, _), read_line in merge(*[
+        _sorted_reads(fname, (read, i)) for read in tmp_files
+        for i, fname in enumerate(tmp_files[read])]):
+        if head != last_name:
+            read_id += 1
+            names_fh.write(head + '\n')
+            last_name = head
+        read_line = '%d%s' % (read_id, read_line[len(head):])
+        if head == prev_head[read]:
+            multis[read] += 1
+            prev_read[read] = prev_read[read].strip() + '|||' + read_line
+        else:
+            if prev_read[read] is not None:
+                reads_fhs[read].write(prev_read[read])
+            prev_read[read] = read_line
+        prev_head[read] = head
+    names_fh.close()
+    for read, reads_fh in enumerate(reads_fhs):
+        if prev_read[read] is None:
+            for fh in reads_fhs:
+                fh.close()
+            raise StopIteration('ERROR!\n Nothing parsed, check input files'
+                                ' and chromosome names (in genome.fasta and'
+                                ' SAM/MAP files).')
+        reads_fh.write(prev_read[read])
+        reads_fh.close()
+    if clean:
+        for read in tmp_files:
+            for fname in tmp_files[read]:
+                os.remove(fname)
+    return multis
+
+
+def read_read(r):
+    """
+    :returns: the name, chromosome, position, strand (1 for positive) and
+       mapped length of a read from a line of a MAP file
+    """
     name, seq, _, _, ali = r.split('\t')[:5]
     try:
         crm, strand, pos = ali.split(':')[:3]
@@ -245,22 +400,4 @@ def read_read(r, frags, frag_chunk):
         pos = int(pos)
     else:
         pos = int(pos) + len_seq - 1 # remove 1 because all inclusive
-    frag_piece = frags[crm][pos / frag_chunk]
-    idx = bisect(frag_piece, pos)
-    try:
-        next_re = frag_piece[idx]
-    except IndexError:
-        # case where part of the read is mapped outside chromosome
-        count = 0
-        while idx >= len(frag_piece) and count < len_seq:
-            pos -= 1
-            count += 1
-            frag_piece = frags[crm][pos / frag_chunk]
-            idx = bisect(frag_piece, pos)
-        if count >= len_seq:
-            raise Exception('Read mapped mostly outside ' +
-                            'chromosome\n')
-        next_re = frag_piece[idx]
-    prev_re = frag_piece[idx - 1 if idx else 0]
-    return ('%s\t%s\t%d\t%d\t%d\t%d\t%d\n' % (
-        name, crm, pos, positive, len_seq, prev_re, next_re))
+    return name, crm, pos, positive, len_seq
@@ -0,0 +1,179 @@
+"""
+Columnar binary copy of the files with pairs of reads generated by
+:func:`pytadbit.mapping.get_intersection` and
+:func:`pytadbit.mapping.filter.apply_filter`.
+
+Each column of the file (chromosome, position, strand, number of nucleotides
+mapped, and start and end of the RE fragment of each of the two reads) is
+stored as a raw array of fixed width in a directory next to the original
+file, so that it can be loaded with :func:`numpy.memmap` instead of being
+parsed again.
+"""
+
+from collections import OrderedDict
+from os          import path, stat
+import os
+
+import numpy as np
+
+from pytadbit.utils.file_handling import magic_open
+
+COLUMNS = (('crm'   , np.int32),
+           ('pos'   , np.int64),
+           ('strand', np.int8 ),
+           ('nts'   , np.int32),
+           ('beg'   , np.int64),
+           ('end'   , np.int64))
+
+
+def cache_path(fnam):
+    """
+    :returns: the path to the directory with the binary columns of fnam
+    """
+    return fnam + '_columns'
+
+
+def _stamp(fnam):
+    """
+    size, modification time (with sub-second precision) and inode of a file,
+    to check that the binary columns correspond to its current content
+    """
+    st = stat(fnam)
+    return '%d\t%r\t%d\n' % (st.st_size, st.st_mtime, st.st_ino)
+
+
+class ReadsCacheWriter(object):
+    """
+    Writes the binary columns of a file with pairs of reads, chunk by chunk,
+    while the text file is being written.
+
+    :param fnam: path to the text file with pairs of reads
+    :param crm_lengths: dictionary with the length of each chromosome, in the
+       order of the header of the text file
+
+    Once the text file is closed, :func:`close` has to be called in order to
+    mark the binary columns as up to date.
+    """
+    def __init__(self, fnam, crm_lengths):
+        self.fnam = fnam
+        self.dirname = cache_path(fnam)
+        if not path.exists(self.dirname):
+            os.mkdir(self.dirname)
+        stamp = path.join(self.dirname, 'stamp')
+        if path.exists(stamp):
+            os.remove(stamp)
+        self.crm_ids = dict((crm, i) for i, crm in enumerate(crm_lengths))
+        out = open(path.join(self.dirname, 'chromosomes.tsv'), 'w')
+        out.write(''.join('%s\t%d\n' % (crm, crm_lengths[crm])
+                          for crm in crm_lengths))
+        out.close()
+        self.handlers = dict(
+            ('%s%d' % (col, side), open(path.join(
+                self.dirname, '%s%d.bin' % (col, side)), 'wb'))
+            for side in (1, 2) for col, _ in COLUMNS)
+
+    def write(self, lines):
+        """
+        :param lines: list of lines of the text file (without header)
+        """
+        if not lines:
+            return
+        cols = zip(*[line.split('\t', 13)[1:13] for line in lines])
+        for side in (0, 1):
+            for i, (col, dtype) in enumerate(COLUMNS):
+                vals = cols[side * len(COLUMNS) + i]
+                if col == 'crm':
+                    names, inverse = np.unique(np.array(vals),
+                                               return_inverse=True)
+                    vals = np.array([self.crm_ids.get(n, -1)
+                                     for n in names.tolist()],
+                                    dtype=dtype)[inverse]
+                else:
+                    vals = np.array(vals).astype(dtype)
+                vals.tofile(self.handlers['%s%d' % (col, side + 1)])
+
+    def write_columns(self, columns):
+        """
+        :param columns: dictionary of arrays, with the same keys and types as
+           returned by :func:`load_reads_cache`
+        """
+        for name in self.handlers:
+            np.asarray(columns[name]).tofile(self.handlers[name])
+
+    def close(self):
+        for fh in self.handlers.values():
+            fh.close()
+        out = open(path.join(self.dirname, 'stamp'), 'w')
+        out.write(_stamp(self.fnam))
+        out.close()
+
+
+def write_reads_cache(fnam, chunk=1000000):
+    """
+    Writes the binary columns of an existing file with pairs of reads.
+
+    :param fnam: path to the text file with pairs of reads
+    :param 1000000 chunk: number of reads converted at a time
+    """
+    fhandler = magic_open(fnam)
+    crm_lengths = OrderedDict()
+    line = ''
+    for line in fhandler:
+        if not line.startswith('#'):
+            break
+        if line.startswith('# CRM '):
+            crm, clen = line[6:].split()
+            crm_lengths[crm] = int(clen)
+    writer = ReadsCacheWriter(fnam, crm_lengths)
+    lines = [line] if line and not line.startswith('#') else []
+    for line in fhandler:
+        lines.append(line)
+        if len(lines) >= chunk:
+            writer.write(lines)
+            lines = []
+    writer.write(lines)
+    fhandler.close()
+    writer.close()
+
+
+def is_cache_fresh(fnam):
+    """
+    :returns: True if the binary columns of fnam exist, and were written
+       after its last modification
+    """
+    stamp = path.join(cache_path(fnam), 'stamp')
+    try:
+        return open(stamp).read() == _stamp(fnam)
+    except (IOError, OSError):
+        return False
+
+
+def load_reads_cache(fnam):
+    """
+    Loads the binary columns of a file with pairs of reads, if they are up to
+    date.
+
+    :param fnam: path to the text file with pairs of reads
+
+    :returns: None if there is no up to date binary copy of fnam, otherwise
+       a dictionary with the length of each chromosome (in the order used to
+       number them), and a dictionary of memory-mapped arrays, with keys like
+       'crm1', 'pos1', 'strand1', 'nts1', 'beg1', 'end1', 'crm2'...
+    """
+    if not is_cache_fresh(fnam):
+        return None
+    dirname = cache_path(fnam)
+    crm_lengths = OrderedDict()
+    for line in open(path.join(dirname, 'chromosomes.tsv')):
+        crm, clen = line.split()
+        crm_lengths[crm] = int(clen)
+    columns = {}
+    for side in (1, 2):
+        for col, dtype in COLUMNS:
+            fname = path.join(dirname, '%s%d.bin' % (col, side))
+            if not path.getsize(fname):  # memmap fails on empty files
+                columns['%s%d' % (col, side)] = np.zeros(0, dtype=dtype)
+                continue
+            columns['%s%d' % (col, side)] = np.memmap(fname, dtype=dtype,
+                                                      mode='r')
+    return crm_lengths, columns
@@ -2,12 +2,13 @@
 17 nov. 2014
 """
 
-from bisect import bisect_right as bisect
 from pysam import Samfile
-from pytadbit.mapping.restriction_enzymes import map_re_sites
+from pytadbit.mapping.restriction_enzymes import index_re_sites
+from pytadbit.parsers.map_parser import write_reads_to_file, merge_parsed_reads
+from pytadbit.parsers.map_parser import merge_parsed_read_ids
+from pytadbit.parsers.map_parser import reads_to_lines
 from warnings import warn
-import os
-from sys import stdout
+import multiprocessing as mu
 
 def parse_sam(f_names1, f_names2=None, out_file1=None, out_file2=None,
               genome_seq=None, re_name=None, verbose=False, clean=True,
@@ -27,12 +28,19 @@ def parse_sam(f_names1, f_names2=None, out_file1=None, out_file2=None,
     :param out_file1: path to outfile tab separated format containing mapped
        read1 information
     :param out_file1: path to outfile tab separated format containing mapped
-       read2 information
+       read2 information. Outfiles with names ending in '.gz' are compressed
+       (see :func:`pytadbit.utils.file_handling.magic_write`)
     :param genome_seq: a dictionary generated by :func:`pyatdbit.parser.genome_parser.parse_fasta`.
        containing the genomic sequence
     :param re_name: name of the restriction enzyme used
     :param None mapper: software used to map (supported are GEM and BOWTIE2).
        Guessed from file by default.
+    :param 1 ncpus: number of SAM/BAM files to be parsed (and sorted) in
+       parallel. Sorted chunks are then merged all at once.
+    :param False read_ids: replace read names by integer IDs, common to both
+       read ends (see
+       :func:`pytadbit.parsers.map_parser.merge_parsed_read_ids`). Original
+       names are kept in a separate file, next to out_file1.
     """
     # not nice, dirty fix in order to allow this function to only parse
     # one SAM file
@@ -44,12 +52,13 @@ def parse_sam(f_names1, f_names2=None, out_file1=None, out_file2=None,
         raise Exception('ERROR: genome_seq should be given\n')
     if (f_names2 and not out_file2) or (not f_names2 and out_file2):
         raise Exception('ERROR: out_file2 AND f_names2 needed\n')
+    read_ids = kwargs.get('read_ids', False)
+    if read_ids and not f_names2:
+        raise Exception('ERROR: read_ids needs both read ends to be parsed\n')
 
-    frag_chunk = kwargs.get('frag_chunk', 100000)
     if verbose:
         print 'Searching and mapping RE sites to the reference genome'
-    frags = map_re_sites(re_name, genome_seq, frag_chunk=frag_chunk,
-                         verbose=verbose)
+    frags = index_re_sites(re_name, genome_seq, verbose=verbose)
 
     if isinstance(f_names1, str):
         f_names1 = [f_names1]
@@ -65,211 +74,135 @@ def parse_sam(f_names1, f_names2=None, out_file1=None, out_file2=None,
     # max number of reads per intermediate files for sorting
     max_size = 1000000
 
-    windows = {}
-    multis  = {}
-    procs   = []
+    ncpus = kwargs.get('ncpus', 1)
+    pool = mu.Pool(ncpus) if ncpus > 1 else None
+
+    windows   = {}
+    multis    = {}
+    tmp_files = {}
+
+    def _collect(read, fnam, num, result):
+        if result is None:
+            print 'WARNING: file "%s" not found' % fnam
+            return None
+        read_count, files, used_mapper = result
+        windows[read].setdefault(num, 0)
+        windows[read][num] += read_count
+        tmp_files[read].extend(files)
+        return used_mapper
+
+    # each SAM/BAM file is parsed independently (in parallel if ncpus > 1),
+    # its reads being written into sorted temporary files
+    jobs = {}
     for read in range(len(fnames)):
         if verbose:
             print 'Loading read' + str(read + 1)
-        windows[read] = {}
+        windows[read]   = {}
+        tmp_files[read] = []
+        jobs[read]      = []
         num = 0
-        # iteration over reads
-        nfile = 0
-        tmp_files = []
-        reads     = []
-        for fnam in fnames[read]:
-            try:
-                fhandler = Samfile(fnam)
-            except IOError:
-                print 'WARNING: file "%s" not found' % fnam
-                continue
-            except ValueError:
-                raise Exception('ERROR: not a SAM/BAM file\n%s' % fnam)
+        for ifile, fnam in enumerate(fnames[read]):
             # get the iteration number of the iterative mapping
             try:
                 num = int(fnam.split('.')[-1].split(':')[0])
             except:
                 num += 1
-            # set read counter
-            windows[read].setdefault(num, 0)
-            # guess mapper used
-            if not mapper:
-                mapper = fhandler.header['PG'][0]['ID']
-            if mapper.lower()=='gem':
-                condition = lambda x: x[1][0][0] != 'N'
-            elif mapper.lower() in ['bowtie', 'bowtie2']:
-                condition = lambda x: 'XS' in dict(x)
+            args = (fnam, frags, outfiles[read], '%03d' % ifile, mapper,
+                    verbose, max_size)
+            if pool:
+                jobs[read].append((fnam, num,
+                                   pool.apply_async(_parse_sam_file, args)))
             else:
-                warn('WARNING: unrecognized mapper used to generate file\n')
-                condition = lambda x: x[1][1] != 1
-            if verbose:
-                print 'loading SAM file from %s: %s' % (mapper, fnam)
-            # getrname chromosome names
-            i = 0
-            crm_dict = {}
-            while True:
-                try:
-                    crm_dict[i] = fhandler.getrname(i)
-                    i += 1
-                except ValueError:
-                    break
-            # iteration over reads
-            sub_count = 0  # to empty read buffer
-            for r in fhandler:
-                if r.is_unmapped:
-                    continue
-                if condition(r.tags):
-                    continue
-                positive = not r.is_reverse
-                crm      = crm_dict[r.tid]
-                len_seq  = len(r.seq)
-                if positive:
-                    pos = r.pos + 1
-                else:
-                    pos = r.pos + len_seq
-                try:
-                    frag_piece = frags[crm][pos / frag_chunk]
-                except KeyError:
-                    # Chromosome not in hash
-                    continue
-                idx = bisect(frag_piece, pos)
-                try:
-                    next_re = frag_piece[idx]
-                except IndexError:
-                    # case where part of the read is mapped outside chromosome
-                    count = 0
-                    while idx >= len(frag_piece) and count < len_seq:
-                        pos -= 1
-                        count += 1
-                        frag_piece = frags[crm][pos / frag_chunk]
-                        idx = bisect(frag_piece, pos)
-                    if count >= len_seq:
-                        raise Exception('Read mapped mostly outside ' +
-                                        'chromosome\n')
-                    next_re    = frag_piece[idx]
-                prev_re    = frag_piece[idx - 1 if idx else 0]
-                name       = r.qname
-                reads.append('%s\t%s\t%d\t%d\t%d\t%d\t%d\n' % (
-                    name, crm, pos, positive, len_seq, prev_re, next_re))
-                windows[read][num] += 1
-                sub_count += 1
-                if sub_count >= max_size:
-                    sub_count = 0
-                    nfile += 1
-                    write_reads_to_file(reads, outfiles[read], tmp_files, nfile)
-            nfile += 1
-            write_reads_to_file(reads, outfiles[read], tmp_files, nfile)
+                # mapper guessed from the first file is used for the next ones
+                mapper = _collect(read, fnam, num,
+                                  _parse_sam_file(*args)) or mapper
+    if pool:
+        pool.close()
+        for read in jobs:
+            for fnam, num, job in jobs[read]:
+                _collect(read, fnam, num, job.get())
+        pool.join()
 
-
-        # we have now sorted temporary files
-        # we do merge sort for eah pair
+    # we have now sorted temporary files, that are merged all at once
+    if read_ids:
         if verbose:
-            stdout.write('Merge sort')
-            stdout.flush()
-        while len(tmp_files) > 1:
-            file1 = tmp_files.pop(0)
-            try:
-                file2 = tmp_files.pop(0)
-            except IndexError:
-                break
+            print 'Merging sorted reads, getting multiple contacts and read IDs'
+        multis = merge_parsed_read_ids(tmp_files, outfiles, genome_seq,
+                                       windows, clean=clean)
+    else:
+        for read in range(len(fnames)):
             if verbose:
-                stdout.write('.')
-            stdout.flush()
-            nfile += 1
-            tmp_files.append(merge_sort(file1, file2, outfiles[read], nfile))
-        if verbose:
-            stdout.write('\n')
-        tmp_name = tmp_files[0]
-        
-        if verbose:
-            print 'Getting Multiple contacts'
-        reads_fh = open(outfiles[read], 'w')
-        ## Also pipe file header
-        # chromosome sizes (in order)
-        reads_fh.write('# Chromosome lengths (order matters):\n')
-        for crm in genome_seq:
-            reads_fh.write('# CRM %s\t%d\n' % (crm, len(genome_seq[crm])))
-        reads_fh.write('# Mapped\treads count by iteration\n')
-        for size in windows[read]:
-            reads_fh.write('# MAPPED %d %d\n' % (size, windows[read][size]))
-
-        ## Multicontacts
-        tmp_reads_fh = open(tmp_name)
-        try:
-            read_line = tmp_reads_fh.next()
-        except StopIteration:
-            raise StopIteration('ERROR!\n Nothing parsed, check input files and'
-                                ' chromosome names (in genome.fasta and SAM/MAP'
-                                ' files).')
-        prev_head = read_line.split('\t', 1)[0]
-        prev_head = prev_head.split('~' , 1)[0]
-        prev_read = read_line
-        multis[read] = 0
-        for read_line in tmp_reads_fh:
-            head = read_line.split('\t', 1)[0]
-            head = head.split('~' , 1)[0]
-            if head == prev_head:
-                multis[read] += 1
-                prev_read =  prev_read.strip() + '|||' + read_line
-            else:
-                reads_fh.write(prev_read)
-                prev_read = read_line
-            prev_head = head
-        reads_fh.write(prev_read)
-        reads_fh.close()
-        if clean:
-            os.system('rm -rf ' + tmp_name)
-    # wait for compression to finish
-    for p in procs:
-        p.communicate()
+                print 'Merging sorted reads and getting multiple contacts'
+            multis[read] = merge_parsed_reads(tmp_files[read], outfiles[read],
+                                              genome_seq, windows[read],
+                                              clean=clean)
     return windows, multis
 
 
-def write_reads_to_file(reads, outfiles, tmp_files, nfile):
-    if not reads: # can be...
-        return
-    tmp_name = os.path.join(*outfiles.split('/')[:-1] +
-                            [('tmp_%03d_' % nfile) + outfiles.split('/')[-1]])
-    tmp_name = ('/' * outfiles.startswith('/')) + tmp_name
-    tmp_files.append(tmp_name)
-    out = open(tmp_name, 'w')
-    out.write(''.join(sorted(reads, key=lambda x: x.split('\t', 1)[0].split('~')[0])))
-    out.close()
-    del(reads[:]) # empty list
-
+def _parse_sam_file(fnam, frags, outfile, label, mapper=None, verbose=False,
+                    max_size=1000000):
+    """
+    Parses one SAM/BAM file, writing its reads into sorted temporary files of
+    max_size reads.
 
-def merge_sort(file1, file2, outfiles, nfile):
-    tmp_name = os.path.join(*outfiles.split('/')[:-1] +
-                            [('tmp_merged_%03d_' % nfile) + outfiles.split('/')[-1]])
-    tmp_name = ('/' * outfiles.startswith('/')) + tmp_name
-    tmp_file = open(tmp_name, 'w')
-    fh1 = open(file1)
-    fh2 = open(file2)
-    greater = lambda x, y: x.split('\t', 1)[0].split('~')[0] > y.split('\t', 1)[0].split('~')[0]
-    read1 = fh1.next()
-    read2 = fh2.next()
+    :returns: the number of reads parsed, the list of temporary files and the
+       mapper used, or None if the file was not found
+    """
+    try:
+        fhandler = Samfile(fnam)
+    except IOError:
+        return None
+    except ValueError:
+        raise Exception('ERROR: not a SAM/BAM file\n%s' % fnam)
+    # guess mapper used
+    if not mapper:
+        mapper = fhandler.header['PG'][0]['ID']
+    if mapper.lower()=='gem':
+        condition = lambda x: x[1][0][0] != 'N'
+    elif mapper.lower() in ['bowtie', 'bowtie2']:
+        condition = lambda x: 'XS' in dict(x)
+    else:
+        warn('WARNING: unrecognized mapper used to generate file\n')
+        condition = lambda x: x[1][1] != 1
+    if verbose:
+        print 'loading SAM file from %s: %s' % (mapper, fnam)
+    # getrname chromosome names
+    i = 0
+    crm_dict = {}
     while True:
-        if greater(read2, read1):
-            tmp_file.write(read1)
-            try:
-                read1 = fh1.next()
-            except StopIteration:
-                tmp_file.write(read2)
-                break
+        try:
+            crm_dict[i] = fhandler.getrname(i)
+            i += 1
+        except ValueError:
+            break
+    # iteration over reads
+    tmp_files  = []
+    reads      = []
+    read_count = 0
+    nfile      = 0
+    for r in fhandler:
+        if r.is_unmapped:
+            continue
+        if condition(r.tags):
+            continue
+        positive = not r.is_reverse
+        crm      = crm_dict[r.tid]
+        len_seq  = len(r.seq)
+        if positive:
+            pos = r.pos + 1
         else:
-            tmp_file.write(read2)
-            try:
-                read2 = fh2.next()
-            except StopIteration:
-                tmp_file.write(read1)
-                break
-    for read in fh1:
-        tmp_file.write(read)
-    for read in fh2:
-        tmp_file.write(read)
-    fh1.close()
-    fh2.close()
-    tmp_file.close()
-    os.system('rm -f ' + file1)
-    os.system('rm -f ' + file2)
-    return tmp_name
+            pos = r.pos + len_seq
+        reads.append((r.qname, crm, pos, positive, len_seq))
+        if len(reads) >= max_size:
+            nfile += 1
+            lines = reads_to_lines(reads, frags)
+            read_count += len(lines)
+            write_reads_to_file(lines, outfile, tmp_files,
+                                '%s_%03d' % (label, nfile))
+            reads = []
+    fhandler.close()
+    nfile += 1
+    lines = reads_to_lines(reads, frags)
+    read_count += len(lines)
+    write_reads_to_file(lines, outfile, tmp_files, '%s_%03d' % (label, nfile))
+    return read_count, tmp_files, mapper
@@ -14,6 +14,7 @@ from pytadbit.utils.sqlite_utils  import already_run, digest_parameters
 from pytadbit.utils.sqlite_utils  import add_path, get_jobid, print_db
 from pytadbit.utils.sqlite_utils  import get_path_id
 from pytadbit.utils.file_handling import mkdir
+from pytadbit.parsers.hic_binary_parser import load_hic_binary
 from os                           import path, remove
 from string                       import ascii_letters
 from random                       import random
@@ -32,12 +33,13 @@ def run(opts):
     param_hash = digest_parameters(opts)
 
     reso1 = reso2 = None
+    hic_bin1 = hic_bin2 = None
     if opts.bed1:
         mreads1 = path.realpath(opts.bed1)
         bad_co1 = opts.bad_co1
         biases1 = opts.biases1
     else:
-        bad_co1, biases1, mreads1, reso1 = load_parameters_fromdb(
+        bad_co1, biases1, mreads1, reso1, hic_bin1 = load_parameters_fromdb(
                 opts.workdir1, opts.jobid1, opts, opts.tmpdb1)
         mreads1 = path.join(opts.workdir1, mreads1)
 
@@ -46,7 +48,7 @@ def run(opts):
         bad_co2 = opts.bad_co2
         biases2 = opts.biases2
     else:
-        bad_co2, biases2, mreads2, reso2 = load_parameters_fromdb(
+        bad_co2, biases2, mreads2, reso2, hic_bin2 = load_parameters_fromdb(
                 opts.workdir2, opts.jobid2, opts, opts.tmpdb2)
         mreads2 = path.join(opts.workdir2, mreads2)
 
@@ -59,13 +61,27 @@ def run(opts):
 
     if not opts.skip_comparison:
         print 'Comparison'
-        print ' - loading first sample', mreads1
-        hic_data1 = load_hic_data_from_reads(mreads1, opts.reso)
+        # binary matrices from tadbit normalize already hold biases and
+        # filtered columns
+        if hic_bin1:
+            hic_bin1 = path.join(opts.workdir1, hic_bin1)
+            print ' - loading first sample', hic_bin1
+            hic_data1 = load_hic_binary(hic_bin1)
+        else:
+            print ' - loading first sample', mreads1
+            hic_data1 = load_hic_data_from_reads(mreads1, opts.reso, sparse=True)
 
-        print ' - loading second sample', mreads2
-        hic_data2 = load_hic_data_from_reads(mreads2, opts.reso)
+        if hic_bin2:
+            hic_bin2 = path.join(opts.workdir2, hic_bin2)
+            print ' - loading second sample', hic_bin2
+            hic_data2 = load_hic_binary(hic_bin2)
+        else:
+            print ' - loading second sample', mreads2
+            hic_data2 = load_hic_data_from_reads(mreads2, opts.reso, sparse=True)
 
-        if opts.norm and biases1:
+        if hic_bin1:
+            pass
+        elif opts.norm and biases1:
             bad_co1 = path.join(opts.workdir1, bad_co1)
             print ' - loading bad columns from first sample', bad_co1
             hic_data1.bads = dict((int(l.strip()), True) for l in open(bad_co1))
@@ -75,7 +91,9 @@ def run(opts):
                                   for l in open(biases1))
         elif opts.norm:
             raise Exception('ERROR: biases or filtered-columns not found')
-        if opts.norm and biases2:
+        if hic_bin2:
+            pass
+        elif opts.norm and biases2:
             bad_co2 = path.join(opts.workdir2, bad_co2)
             print ' - loading bad columns from second sample', bad_co2
             hic_data2.bads = dict((int(l.strip()), True) for l in open(bad_co2))
@@ -403,7 +421,7 @@ def load_parameters_fromdb(workdir, jobid, opts, tmpdb):
             parse_jobid = jobid
         # fetch path to parsed BED files
         # try:
-        bad_co = biases = mreads = reso = None
+        bad_co = biases = mreads = reso = hic_bin = None
         if opts.norm:
             try:
                 cur.execute("""
@@ -433,6 +451,17 @@ def load_parameters_fromdb(workdir, jobid, opts, tmpdb):
                 if reso != opts.reso:
                     warn('WARNING: input resolution does not match '
                          'the one of the precomputed normalization')
+                else:
+                    cur.execute("""
+                    select distinct Path from PATHs
+                    where paths.jobid = %s and paths.Type = 'HIC_DATA'
+                    """ % parse_jobid)
+                    try:
+                        hic_bin = cur.fetchall()[0][0]
+                        if not path.exists(path.join(workdir, hic_bin)):
+                            hic_bin = None
+                    except IndexError:
+                        pass
             except IndexError:
                 warn('WARNING: normalization not found')
                 cur.execute("""
@@ -448,7 +477,7 @@ def load_parameters_fromdb(workdir, jobid, opts, tmpdb):
             where filter_outputs.name = 'valid-pairs' and paths.jobid = %s
             """ % parse_jobid)
             mreads = cur.fetchall()[0][0]
-        return bad_co, biases, mreads, reso
+        return bad_co, biases, mreads, reso, hic_bin
 
 def populate_args(parser):
     """
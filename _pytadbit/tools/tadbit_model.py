@@ -21,6 +21,7 @@ from pytadbit.utils.sqlite_utils  import digest_parameters
 from pytadbit                     import load_hic_data_from_reads
 from pytadbit                     import get_dependencies_version
 from pytadbit.parsers.hic_parser  import optimal_reader
+from pytadbit.parsers.hic_binary_parser import load_hic_binary, is_hic_binary
 from itertools                    import product
 from warnings                     import warn
 from numpy                        import arange
@@ -259,7 +260,7 @@ def run(opts):
         # FIXME: copied from somewhere else
         (bad_co, bad_co_id, biases, biases_id,
          mreads, mreads_id, reso) = load_parameters_fromdb(opts)
-        hic_data = load_hic_data_from_reads(mreads, reso)
+        hic_data = load_hic_data_from_reads(mreads, reso, sparse=True)
         hic_data.bads = dict((int(l.strip()), True) for l in open(bad_co))
         hic_data.bias = dict((int(l.split()[0]), float(l.split()[1]))
                              for l in open(biases))
@@ -530,7 +531,8 @@ def populate_args(parser):
     glopts.add_argument('--input_matrix', dest='matrix', metavar="PATH",
                         type=str,
                         help='''In case input was not generated with the TADbit
-                        tools''')
+                        tools, or to use the binary matrix generated by tadbit
+                        normalize''')
     glopts.add_argument('--rand', dest='rand', metavar="INT",
                         type=str, default='1', 
                         help='''[%(default)s] random initial number. NOTE:
@@ -752,9 +754,19 @@ def load_hic_data(opts):
     crm = Chromosome(opts. crm)  # Create chromosome object
     print '     o Loading Hi-C matrix'
     try:
-        hic = optimal_reader(open(opts.matrix), normalized=True, resolution=opts.reso)
-        crm.add_experiment('test', exp_type='Hi-C', resolution=opts.reso,
-                           norm_data=hic)
+        if is_hic_binary(opts.matrix):
+            # binary matrix from tadbit normalize, only this chromosome is read
+            hic = load_hic_binary(opts.matrix, focus=opts.crm)
+            crm.add_experiment('test', exp_type='Hi-C', resolution=opts.reso,
+                               norm_data=[hic.get_array(normalized=True).tolist()])
+            if hic.bads:
+                crm.experiments[-1]._zeros = hic.bads
+                crm.experiments[-1]._filtered_cols = True
+        else:
+            hic = optimal_reader(open(opts.matrix), normalized=True,
+                                 resolution=opts.reso)
+            crm.add_experiment('test', exp_type='Hi-C', resolution=opts.reso,
+                               norm_data=hic)
     except Exception, e:
         print str(e)
         warn('WARNING: failed to load data as TADbit standardized matrix\n')
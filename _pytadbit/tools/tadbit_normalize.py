@@ -11,11 +11,11 @@ from pytadbit.utils.sqlite_utils  import already_run, digest_parameters
 from pytadbit.utils.sqlite_utils  import add_path, get_jobid, print_db
 from pytadbit.utils.file_handling import mkdir
 from pytadbit.mapping.analyze     import plot_distance_vs_interactions, hic_map
+from pytadbit.parsers.hic_binary_parser import write_hic_binary
 from os                           import path, remove
 from string                       import ascii_letters
 from random                       import random
 from shutil                       import copyfile
-from cPickle                      import dump
 import sqlite3 as lite
 import time
 
@@ -25,14 +25,15 @@ def run(opts):
     check_options(opts)
     launch_time = time.localtime()
 
-    param_hash = digest_parameters(opts)
+    # the memory used does not change the results
+    param_hash = digest_parameters(opts, extra=['max_memory'])
     if opts.bed:
         mreads = path.realpath(opts.bed)
     else:
         mreads = path.join(opts.workdir, load_parameters_fromdb(opts))
 
     print 'loading', mreads
-    hic_data = load_hic_data_from_reads(mreads, opts.reso)
+    hic_data = load_hic_data_from_reads(mreads, opts.reso, sparse=True)
 
     mkdir(path.join(opts.workdir, '04_normalization'))
 
@@ -56,11 +57,13 @@ def run(opts):
     out_bad.write('\n'.join([str(i) for i in hic_data.bads.keys()]))
     out_bad.close()
 
-    # Identify biases
+    # Identify biases (with max_memory, the interactions of the sparse matrix
+    # already loaded are iterated chunk by chunk)
     if not opts.filter_only:
         print 'Get biases using ICE...'
         hic_data.normalize_hic(silent=False, max_dev=0.1, iterations=0,
-                               factor=opts.factor)
+                               factor=opts.factor, memory=opts.max_memory,
+                               tmp_dir=opts.workdir)
 
     print 'Getting cis/trans...'
     cis_trans_N_D = cis_trans_N_d = float('nan')
@@ -99,13 +102,17 @@ def run(opts):
         out_bias.close()
 
 
-    # pickle the HiC-data object
-    print ' - Saving genomic matrix pickle'
-    pickle_path = path.join(opts.workdir, '04_normalization',
-                            'hic-data_%s_%s.pickle' % (nice(opts.reso), param_hash))
-    out = open(pickle_path, 'w')
-    dump(hic_data, out)
-    out.close()
+    # expected counts are stored with the matrix, to be reused when searching
+    # for compartments
+    print 'Computing expected counts...'
+    hic_data.expected = hic_data.get_expected()
+
+    # store the HiC-data object (with biases, filtered columns and expected
+    # counts)
+    print ' - Saving genomic matrix in binary format'
+    hic_bin_path = path.join(opts.workdir, '04_normalization',
+                             'hic-data_%s_%s.bin' % (nice(opts.reso), param_hash))
+    write_hic_binary(hic_data, hic_bin_path)
 
     # to feed the save_to_db funciton
     intra_dir_nrm_fig = intra_dir_nrm_txt = None
@@ -132,10 +139,12 @@ def run(opts):
         if not opts.filter_only:
             hic_map(hic_data, normalized=True, by_chrom='intra', cmap='jet',
                     name=path.split(opts.workdir)[-1],
-                    savefig=intra_dir_nrm_fig, savedata=intra_dir_nrm_txt)
+                    savefig=intra_dir_nrm_fig, savedata=intra_dir_nrm_txt,
+                    compress=opts.compress_txt)
         hic_map(hic_data, normalized=False, by_chrom='intra', cmap='jet',
                 name=path.split(opts.workdir)[-1],
-                savefig=intra_dir_raw_fig, savedata=intra_dir_raw_txt)
+                savefig=intra_dir_raw_fig, savedata=intra_dir_raw_txt,
+                compress=opts.compress_txt)
 
     if "inter" in opts.keep:
         print "  Saving inter chromosomal raw and normalized matrices..."
@@ -156,10 +165,12 @@ def run(opts):
         if not opts.filter_only:
             hic_map(hic_data, normalized=True, by_chrom='inter', cmap='jet',
                     name=path.split(opts.workdir)[-1],
-                    savefig=inter_dir_nrm_fig, savedata=inter_dir_nrm_txt)
+                    savefig=inter_dir_nrm_fig, savedata=inter_dir_nrm_txt,
+                    compress=opts.compress_txt)
         hic_map(hic_data, normalized=False, by_chrom='inter', cmap='jet',
                 name=path.split(opts.workdir)[-1],
-                savefig=inter_dir_raw_fig, savedata=inter_dir_raw_txt)
+                savefig=inter_dir_raw_fig, savedata=inter_dir_raw_txt,
+                compress=opts.compress_txt)
 
     if "genome" in opts.keep:
         print " - Saving normalized genomic matrix..."
@@ -174,16 +185,22 @@ def run(opts):
                                           'genomic_maps_raw_%s_%s.pdf' % (opts.reso, param_hash))
         if not opts.filter_only:
             genom_map_nrm_txt = path.join(opts.workdir, '04_normalization',
-                                          'genomic_nrm_%s_%s.tsv' % (opts.reso, param_hash))
+                                          'genomic_nrm_%s_%s.tsv%s' % (
+                                              opts.reso, param_hash,
+                                              '.gz' if opts.compress_txt else ''))
         genom_map_raw_txt = path.join(opts.workdir, '04_normalization',
-                                      'genomic_raw_%s_%s.tsv' % (opts.reso, param_hash))
+                                      'genomic_raw_%s_%s.tsv%s' % (
+                                          opts.reso, param_hash,
+                                          '.gz' if opts.compress_txt else ''))
         if not opts.filter_only:
             hic_map(hic_data, normalized=True, cmap='jet',
                     name=path.split(opts.workdir)[-1],
-                savefig=genom_map_nrm_fig, savedata=genom_map_nrm_txt)
+                savefig=genom_map_nrm_fig, savedata=genom_map_nrm_txt,
+                compress=opts.compress_txt)
         hic_map(hic_data, normalized=False, cmap='jet',
                 name=path.split(opts.workdir)[-1],
-                savefig=genom_map_raw_fig, savedata=genom_map_raw_txt)
+                savefig=genom_map_raw_fig, savedata=genom_map_raw_txt,
+                compress=opts.compress_txt)
 
     finish_time = time.localtime()
 
@@ -196,7 +213,7 @@ def run(opts):
                 intra_dir_raw_fig, intra_dir_raw_txt,
                 inter_dir_raw_fig, inter_dir_raw_txt,
                 genom_map_raw_fig, genom_map_raw_txt,
-                pickle_path, launch_time, finish_time)
+                hic_bin_path, launch_time, finish_time)
 
 def save_to_db(opts, cis_trans_N_D, cis_trans_N_d, cis_trans_n_D, cis_trans_n_d,
                a2, bad_columns_file, bias_file, inter_vs_gcoord, mreads,
@@ -207,7 +224,7 @@ def save_to_db(opts, cis_trans_N_D, cis_trans_N_d, cis_trans_n_D, cis_trans_n_d,
                intra_dir_raw_fig, intra_dir_raw_txt,
                inter_dir_raw_fig, inter_dir_raw_txt,
                genom_map_raw_fig, genom_map_raw_txt,
-               pickle_path, launch_time, finish_time):
+               hic_bin_path, launch_time, finish_time):
     if 'tmpdb' in opts and opts.tmpdb:
         # check lock
         while path.exists(path.join(opts.workdir, '__lock_db')):
@@ -245,7 +262,7 @@ def save_to_db(opts, cis_trans_N_D, cis_trans_N_d, cis_trans_n_D, cis_trans_n_d,
                 unique (JOBid))""")
         try:
             parameters = digest_parameters(opts, get_md5=False)
-            param_hash = digest_parameters(opts, get_md5=True )
+            param_hash = digest_parameters(opts, get_md5=True , extra=['max_memory'])
             cur.execute("""
             insert into JOBs
             (Id  , Parameters, Launch_time, Finish_time, Type , Parameters_md5)
@@ -257,7 +274,7 @@ def save_to_db(opts, cis_trans_N_D, cis_trans_N_d, cis_trans_n_D, cis_trans_n_d,
         except lite.IntegrityError:
             pass
         jobid = get_jobid(cur)
-        add_path(cur, pickle_path     , 'PICKLE'     , jobid, opts.workdir)
+        add_path(cur, hic_bin_path    , 'HIC_DATA'   , jobid, opts.workdir)
         add_path(cur, bad_columns_file, 'BAD_COLUMNS', jobid, opts.workdir)
         add_path(cur, bias_file       , 'BIASES'     , jobid, opts.workdir)
         add_path(cur, inter_vs_gcoord , 'FIGURE'     , jobid, opts.workdir)
@@ -407,6 +424,13 @@ def populate_args(parser):
                         normalization (can be used to weight experiments before
                         merging)''')
 
+    glopts.add_argument('--max_memory', dest='max_memory', metavar="INT",
+                        action='store', default=None, type=int,
+                        help='''maximum memory (in Mb) to be used to compute
+                        the biases, besides the matrix itself. If set, the
+                        interactions of the matrix are processed chunk by
+                        chunk, at each iteration of the normalization''')
+
     glopts.add_argument('-j', '--jobid', dest='jobid', metavar="INT",
                         action='store', default=None, type=int,
                         help='''Use as input data generated by a job with a given
@@ -424,6 +448,10 @@ def populate_args(parser):
                       default=False,
                       help='Save only text file for matrices, not images')
 
+    glopts.add_argument('--compress_txt', dest='compress_txt',
+                        action='store_true', default=False,
+                        help='gzip text files of the matrices')
+
     glopts.add_argument('--filter_only', dest='filter_only', action='store_true',
                       default=False,
                       help='skip normalization')
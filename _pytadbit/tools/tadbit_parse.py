@@ -8,13 +8,13 @@ information needed
 
 from argparse                       import HelpFormatter
 from pytadbit                       import get_dependencies_version
-from pytadbit.parsers.genome_parser import parse_fasta
+from pytadbit.parsers.genome_parser import load_genome
 from pytadbit.parsers.map_parser    import parse_map
 from os                             import path, remove
 from string                         import ascii_letters
 from random                         import random
 from shutil                         import copyfile
-from pytadbit.utils.file_handling   import mkdir
+from pytadbit.utils.file_handling   import mkdir, magic_open
 from pytadbit.utils.sqlite_utils    import get_path_id, add_path, print_db, get_jobid
 from pytadbit.utils.sqlite_utils    import already_run, digest_parameters
 import time
@@ -22,6 +22,7 @@ import logging
 from cPickle import load, UnpicklingError
 import sqlite3 as lite
 from warnings import warn
+from multiprocessing import cpu_count
 
 DESC = "Parse mapped Hi-C reads and get the intersection"
 
@@ -59,17 +60,18 @@ def run(opts):
         # allows the use of cPickle genome to make it faster
         genome = load(open(opts.genome[0]))
     except UnpicklingError:
-        genome = parse_fasta(opts.genome, chr_regexp=opts.filter_chrom)
+        genome = load_genome(opts.genome, chr_regexp=opts.filter_chrom)
 
     if not opts.skip:
         logging.info('parsing reads in %s project', name)
         counts, multis = parse_map(f_names1, f_names2, out_file1=out_file1,
                                    out_file2=out_file2, re_name=renz, verbose=True,
-                                   genome_seq=genome, compress=opts.compress_input)
+                                   genome_seq=genome, compress=opts.compress_input,
+                                   ncpus=opts.cpus)
     else:
         counts = {}
         counts[0] = {}
-        fhandler = open(out_file1)
+        fhandler = magic_open(out_file1)
         for line in fhandler:
             if line.startswith('# MAPPED '):
                 _, _, item, value = line.split()
@@ -83,7 +85,7 @@ def run(opts):
                 multis[0] += line.count('|||')
         if out_file2:
             counts[1] = {}
-            fhandler = open(out_file2)
+            fhandler = magic_open(out_file2)
             for line in fhandler:
                 if line.startswith('# MAPPED '):
                     _, _, item, value = line.split()
@@ -308,6 +310,12 @@ def populate_args(parser):
                         done. This is done in background, while next MAP file is
                         processed, or while reads are sorted.''')
 
+    glopts.add_argument("-C", "--cpu", dest="cpus", type=int,
+                        default=0, help='''[%(default)s] Maximum number of CPU
+                        cores  available in the execution host. MAP files are
+                        parsed in parallel (if 0 all available)
+                        cores will be used''')
+
     glopts.add_argument('--tmpdb', dest='tmpdb', action='store', default=None,
                         metavar='PATH', type=str,
                         help='''if provided uses this directory to manipulate the
@@ -347,6 +355,12 @@ def check_options(opts):
     if opts.workdir.endswith('/'):
         opts.workdir = opts.workdir[:-1]
 
+    # number of cpus
+    if opts.cpus == 0:
+        opts.cpus = cpu_count()
+    else:
+        opts.cpus = min(opts.cpus, cpu_count())
+
     # write log
     log_format = '[PARSING]   %(message)s'
 
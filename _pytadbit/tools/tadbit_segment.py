@@ -12,9 +12,11 @@ from pytadbit.utils.sqlite_utils  import already_run, digest_parameters
 from pytadbit.utils.sqlite_utils  import add_path, get_jobid, print_db
 from pytadbit.utils.file_handling import mkdir
 from pytadbit.parsers.tad_parser  import parse_tads
+from pytadbit.parsers.hic_binary_parser import load_hic_binary
 from os                           import path, remove
 from time                         import sleep
 from shutil                       import copyfile
+from multiprocessing              import cpu_count
 from string                       import ascii_letters
 from random                       import random
 import sqlite3 as lite
@@ -32,10 +34,11 @@ def run(opts):
         biases = opts.biases
         mreads = opts.mreads
         reso   = opts.reso
+        hic_bin = None
         inputs = []
     else:
         (bad_co, bad_co_id, biases, biases_id,
-         mreads, mreads_id, reso) = load_parameters_fromdb(opts)
+         mreads, mreads_id, reso, hic_bin) = load_parameters_fromdb(opts)
         # store path ids to be saved in database
         inputs = bad_co_id, biases_id, mreads_id
 
@@ -45,18 +48,29 @@ def run(opts):
 
     mkdir(path.join(opts.workdir, '05_segmentation'))
 
-    print 'loading %s \n    at resolution %s' % (mreads, nice(reso))
-    hic_data = load_hic_data_from_reads(mreads, reso)
-    hic_data.bads = dict((int(l.strip()), True) for l in open(bad_co))
-    print 'loading filtered columns %s' % (bad_co)
-    print '    with %d of %d filtered out columns' % (len(hic_data.bads),
-                                                      len(hic_data))
-    try:
-        hic_data.bias = dict((int(l.split()[0]), float(l.split()[1]))
-                             for l in open(biases))
-    except IOError:
-        if not opts.only_tads:
+    if hic_bin and path.exists(path.join(opts.workdir, hic_bin)):
+        # binary matrix written by tadbit normalize, with biases and filtered
+        # columns, only the requested chromosomes are loaded
+        hic_bin = path.join(opts.workdir, hic_bin)
+        print 'loading %s \n    at resolution %s' % (hic_bin, nice(reso))
+        hic_data = load_hic_binary(hic_bin, focus=opts.crms)
+        print '    with %d of %d filtered out columns' % (len(hic_data.bads),
+                                                          len(hic_data))
+        if not hic_data.bias and not opts.only_tads:
             raise Exception('ERROR: data should be normalized to get compartments')
+    else:
+        print 'loading %s \n    at resolution %s' % (mreads, nice(reso))
+        hic_data = load_hic_data_from_reads(mreads, reso, sparse=True)
+        hic_data.bads = dict((int(l.strip()), True) for l in open(bad_co))
+        print 'loading filtered columns %s' % (bad_co)
+        print '    with %d of %d filtered out columns' % (len(hic_data.bads),
+                                                          len(hic_data))
+        try:
+            hic_data.bias = dict((int(l.split()[0]), float(l.split()[1]))
+                                 for l in open(biases))
+        except IOError:
+            if not opts.only_tads:
+                raise Exception('ERROR: data should be normalized to get compartments')
 
     # compartments
     cmp_result = {}
@@ -69,7 +83,8 @@ def run(opts):
                                             label_compartments='cluster',
                                             savefig=cmprt_dir,
                                             suffix=param_hash, log=cmprt_dir,
-                                            rich_in_A=opts.rich_in_A)
+                                            rich_in_A=opts.rich_in_A,
+                                            ncpus=opts.cpus or cpu_count())
 
         for crm in opts.crms or hic_data.chromosomes:
             if not crm in firsts:
@@ -250,8 +265,16 @@ def load_parameters_fromdb(opts):
         where NORMALIZE_OUTPUTs.JOBid = %d;
         """ % parse_jobid)
         reso = int(cur.fetchall()[0][0])
+        cur.execute("""
+        select distinct Path from PATHs
+        where paths.jobid = %s and paths.Type = 'HIC_DATA'
+        """ % parse_jobid)
+        try:
+            hic_bin = cur.fetchall()[0][0]
+        except IndexError:
+            hic_bin = None
         return (bad_co, bad_co_id, biases, biases_id,
-                mreads, mreads_id, reso)
+                mreads, mreads_id, reso, hic_bin)
 
 def populate_args(parser):
     """
@@ -6,8 +6,13 @@ import ctypes
 import os, errno
 import platform
 import bz2, gzip, zipfile, tarfile
+import zlib
+from struct import pack, unpack
+from collections import deque
+from itertools import islice
 from subprocess import Popen, PIPE
 from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
 
 def check_pik(path):
     with open(path, "r") as f:
@@ -21,7 +26,12 @@ def magic_open(filename, verbose=False, cpus=None):
     """
     To read uncompressed zip gzip bzip2 or tar.xx files
 
+    BGZF files (blocked gzip, as written by :func:`magic_write` or bgzip) are
+    decompressed by blocks in parallel threads, other gzip files with pigz if
+    it is installed.
+
     :param filename: either a path to a file, or a file handler
+    :param None cpus: number of threads used to decompress (all by default)
 
     :returns: opened file ready to be iterated
     """
@@ -46,7 +56,7 @@ def magic_open(filename, verbose=False, cpus=None):
             raise Exception('\n\nERROR: DSRC binary not found, install it from:'
                             '\nhttps://github.com/lrog/dsrc/releases')
         proc = Popen([dsrc_binary, 'd', '-t%d' % (cpus or cpu_count()),
-                      '-s', filename], stdout=PIPE)
+                      '-s', filename], stdout=PIPE, close_fds=True)
         return proc.stdout
     if inputpath:
         start_of_file = fhandler.read(1024)
@@ -64,15 +74,255 @@ def magic_open(filename, verbose=False, cpus=None):
             print 'bz2'
         fhandler.close()
         return bz2.BZ2File(filename)
+    if start_of_file.startswith('\x1f\x8b\x08\x04') and start_of_file[12:14] == 'BC':
+        if verbose:
+            print 'bgzf'
+        return BgzfReader(fhandler, cpus=cpus)
     if start_of_file.startswith('\x1f\x8b\x08'):
         if verbose:
             print 'gz'
+        pigz_binary = which('pigz')
+        if inputpath and pigz_binary:
+            fhandler.close()
+            proc = Popen([pigz_binary, '-dc', '-p', str(cpus or cpu_count()),
+                          filename], stdout=PIPE, close_fds=True)
+            return proc.stdout
         return gzip.GzipFile(fileobj=fhandler)
     if verbose:
         print 'text'
     return fhandler
 
 
+def is_compressed(filename):
+    """
+    :param filename: path to a file
+
+    :returns: True if the file is compressed (or archived) in one of the
+       formats read by :func:`magic_open`, whatever its extension
+    """
+    if filename.endswith('.dsrc') or tarfile.is_tarfile(filename):
+        return True
+    fhandler = open(filename, 'rb')
+    start_of_file = fhandler.read(4)
+    fhandler.close()
+    return start_of_file.startswith(('\x50\x4b\x03\x04', '\x42\x5a\x68',
+                                     '\x1f\x8b\x08'))
+
+
+def magic_write(filename, cpus=None, compresslevel=6):
+    """
+    To write files, compressed in BGZF format (see :class:`BgzfWriter`) if
+    the name ends with '.gz'
+
+    :param filename: path to the output file
+    :param None cpus: number of threads used to compress (all by default)
+    :param 6 compresslevel: gzip compression level
+
+    :returns: opened file ready to be written
+    """
+    if filename.endswith('.gz'):
+        return BgzfWriter(filename, cpus=cpus, compresslevel=compresslevel)
+    return open(filename, 'w')
+
+
+# BGZF: gzip file made of independent members of at most 64 Kb, each with the
+# size of the member in an extra field of its header
+_BGZF_BLOCK = 65280  # maximum uncompressed size per block, as in bgzip
+_BGZF_EOF = ('\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00BC\x02\x00'
+             '\x1b\x00\x03\x00\x00\x00\x00\x00\x00\x00\x00\x00')
+
+
+def _bgzf_deflate(data, compresslevel):
+    """
+    :returns: a BGZF block with the compressed data
+    """
+    zobj = zlib.compressobj(compresslevel, zlib.DEFLATED, -15)
+    cdata = zobj.compress(data) + zobj.flush()
+    return (pack('<4BI2BH2BHH', 31, 139, 8, 4, 0, 0, 255, 6, 66, 67, 2,
+                 len(cdata) + 25) + cdata +
+            pack('<II', zlib.crc32(data) & 0xffffffff, len(data)))
+
+
+def _bgzf_inflate(block):
+    """
+    :returns: the uncompressed data of a BGZF block
+    """
+    xlen = unpack('<H', block[10:12])[0]
+    data = zlib.decompress(block[12 + xlen:-8], -15)
+    if len(data) != unpack('<I', block[-4:])[0]:
+        raise IOError('ERROR: corrupted BGZF block\n')
+    return data
+
+
+class BgzfReader(object):
+    """
+    Reads a BGZF file, decompressing its blocks in parallel threads (zlib
+    releases the GIL).
+
+    :param fhandler: file handler of the compressed file
+    :param None cpus: number of threads used to decompress (all by default)
+    """
+    def __init__(self, fhandler, cpus=None):
+        self._fh = fhandler
+        self.name = getattr(fhandler, 'name', '')
+        self._ncpus = cpus or cpu_count()
+        self._pool = ThreadPool(self._ncpus)
+        self._jobs = deque()
+        self._lines = []
+        self._pos = 0
+        self._rest = ''
+        self._eof = False
+
+    def _read_block(self):
+        """
+        :returns: the next compressed block of the file, or None at its end
+        """
+        header = self._fh.read(12)
+        if len(header) < 12:
+            return None
+        xlen = unpack('<H', header[10:12])[0]
+        extra = self._fh.read(xlen)
+        pos = 0
+        while pos < xlen:
+            slen = unpack('<H', extra[pos + 2:pos + 4])[0]
+            if extra[pos:pos + 2] == 'BC':
+                bsize = unpack('<H', extra[pos + 4:pos + 6])[0]
+                break
+            pos += 4 + slen
+        else:
+            raise IOError('ERROR: %s is not in BGZF format\n' % self.name)
+        return header + extra + self._fh.read(bsize - 11 - xlen)
+
+    def _read_chunk(self):
+        """
+        :returns: the uncompressed data of the next block, or None at the end
+           of the file
+        """
+        while not self._eof and len(self._jobs) < 4 * self._ncpus:
+            block = self._read_block()
+            if block is None:
+                self._eof = True
+                break
+            self._jobs.append(self._pool.apply_async(_bgzf_inflate,
+                                                     args=(block, )))
+        if not self._jobs:
+            return None
+        return self._jobs.popleft().get()
+
+    def _load_lines(self):
+        """
+        reads new lines, raises StopIteration at the end of the file
+        """
+        chunk = ''
+        while not chunk:  # skip empty blocks
+            chunk = self._read_chunk()
+            if chunk is None:
+                if not self._rest:
+                    raise StopIteration
+                self._lines, self._pos, self._rest = [self._rest], 0, ''
+                return
+        lines = (self._rest + chunk).split('\n')
+        self._rest = lines.pop()
+        self._lines = [line + '\n' for line in lines]
+        self._pos = 0
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        while self._pos >= len(self._lines):
+            self._load_lines()
+        self._pos += 1
+        return self._lines[self._pos - 1]
+
+    def readline(self):
+        try:
+            return self.next()
+        except StopIteration:
+            return ''
+
+    def read(self):
+        return ''.join(self)
+
+    def close(self):
+        self._pool.terminate()
+        self._fh.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+
+class BgzfWriter(object):
+    """
+    File to be written with BGZF compression (a gzip file made of independent
+    blocks, that can be read with any gzip tool). Blocks are compressed in
+    parallel threads (zlib releases the GIL), and the file can be read back
+    in parallel with :func:`magic_open`.
+
+    :param fname: path to the output file
+    :param None cpus: number of threads used to compress (all by default)
+    :param 6 compresslevel: gzip compression level
+    """
+    def __init__(self, fname, cpus=None, compresslevel=6):
+        self.name = fname
+        self._fh = open(fname, 'wb')
+        self._ncpus = cpus or cpu_count()
+        self._pool = ThreadPool(self._ncpus)
+        self._jobs = deque()
+        self._level = compresslevel
+        self._buffer = []
+        self._size = 0
+
+    def _flush_jobs(self, max_jobs):
+        while len(self._jobs) > max_jobs:
+            self._fh.write(self._jobs.popleft().get())
+
+    def _compress(self, data):
+        self._jobs.append(self._pool.apply_async(
+            _bgzf_deflate, args=(data, self._level)))
+        self._flush_jobs(4 * self._ncpus)
+
+    def write(self, text):
+        self._buffer.append(text)
+        self._size += len(text)
+        if self._size < _BGZF_BLOCK:
+            return
+        data = ''.join(self._buffer)
+        end = len(data) - len(data) % _BGZF_BLOCK
+        for beg in xrange(0, end, _BGZF_BLOCK):
+            self._compress(data[beg:beg + _BGZF_BLOCK])
+        self._buffer = [data[end:]]
+        self._size = len(data) - end
+
+    def writelines(self, lines):
+        lines = iter(lines)
+        while True:
+            text = ''.join(islice(lines, 10000))
+            if not text:
+                break
+            self.write(text)
+
+    def close(self):
+        if self._size:
+            self._compress(''.join(self._buffer))
+        self._buffer = []
+        self._size = 0
+        self._flush_jobs(0)
+        self._fh.write(_BGZF_EOF)
+        self._fh.close()
+        self._pool.close()
+        self._pool.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+
 def get_free_space_mb(folder, div=2):
     """
     Return folder/drive free space (in bytes)
@@ -1,118 +1,99 @@
 from numpy import log, pi as pi_num, exp
+import numpy as np
 import sys
 
 def best_path(probs, pi, T):
     """
-    Viterbi algorithm with backpointers
-    """
-    n = len(T)
-    m = len(probs[0])
-    log_V     = [[0. for _ in xrange(m)] for _ in xrange(n)]
-    backpt    = [[0  for _ in xrange(m)] for _ in xrange(n)]
-    states    =  [0  for _ in xrange(m)]
-    log_pi    =  [float('-inf') if pi[i] < 0. else log(pi[i]) for i in xrange(len(pi))]
-    log_T     =  [float('-inf') if T [i] < 0. else log(T[i]) for i in xrange(len(T))]
-    log_probs = [[float('-inf') if probs[i][j] < 0. else log(probs[i][j])
-                  for j in xrange(m)]
-                 for i in xrange(n)]
-    for i in xrange(n):
-        log_V[i][0] = log_probs[i][0] + log_pi[i]
+    Viterbi algorithm with backpointers, in log space. Each step computes, for
+    all states at once, the best previous state.
+
+    :returns: the list of states of the most probable path, and its log
+       likelihood
+    """
+    probs = np.asarray(probs, dtype=float)
+    n, m = probs.shape
+    with np.errstate(divide='ignore', invalid='ignore'):
+        log_pi    = log(np.maximum(np.asarray(pi, dtype=float), 0.))
+        log_T     = log(np.maximum(np.asarray(T , dtype=float), 0.))
+        log_probs = log(np.maximum(probs, 0.))
+    backpt = np.zeros((n, m), dtype=int)
+    log_V  = log_probs[:, 0] + log_pi
     for k in xrange(1, m):
-        for stat in xrange(n):
-            log_V[stat][k] = float('-inf')
-            for prev in xrange(n):
-                # original state prob times transition prob
-                prob = log_V[prev][k-1] + log_T[prev][stat]
-                if prob > log_V[stat][k]:
-                    log_V[stat][k] = prob
-                    backpt[stat][k-1] = prev
-            log_V[stat][k] += log_probs[stat][k]
+        # original state prob times transition prob (previous states in rows)
+        prob = log_V[:, None] + log_T
+        backpt[:, k - 1] = prob.argmax(axis=0)
+        log_V = prob[backpt[:, k - 1], np.arange(n)] + log_probs[:, k]
     # get the likelihood of the most probable path
-    prob = log_V[0][-1]
-    for i in xrange(1, n):
-        if log_V[i][-1] > prob:
-            prob = log_V[i][-1]
-            states[-1] = i
+    states = np.zeros(m, dtype=int)
+    states[-1] = log_V.argmax()
+    prob = log_V[states[-1]]
     # Follow the backtrack: get the path which maximize the path prob.
     for i in xrange(m - 2, -1, -1):
-        states[i] = backpt[states[i + 1]][i]
-    return states, prob
+        states[i] = backpt[states[i + 1], i]
+    return states.tolist(), float(prob)
 
 def baum_welch_optimization(xh, T, E, new_pi, new_T, corrector,
                             new_E, etas, gammas):
     """
-    implementation of the baum-welch algorithm
+    implementation of the baum-welch algorithm (new_pi, new_T, corrector and
+    new_E are NumPy arrays updated in place)
     """
-    n = len(T)
-    m = len(gammas[0])
-    for i in xrange(n):
-        for j in xrange(n):
-            new_pi[i] += etas[i][j][0]
-    for i in xrange(n):
-        for j in xrange(n):
-            new_T[i][j] += sum(etas[i][j][k] for k in xrange(m - 1))
-
-    for k in xrange(m):
-        for i in xrange(n):
-            gik = gammas[i][k]
-            corrector[i] += gik
-            new_E[i][0] += gik * xh[k]
-            new_E[i][1] += gik * (xh[k] - E[i][0])**2
+    xh = np.asarray(xh, dtype=float)
+    E = np.asarray(E, dtype=float)
+    new_pi += etas[:, :, 0].sum(axis=1)
+    new_T += etas.sum(axis=2)
+    corrector += gammas.sum(axis=1)
+    new_E[:, 0] += gammas.dot(xh)
+    new_E[:, 1] += (gammas * (xh[None, :] - E[:, 0, None])**2).sum(axis=1)
 
 def update_parameters(corrector, pi, new_pi, T, new_T, E, new_E):
     """
-    final round of the baum-welch
+    final round of the baum-welch (pi, T and E are NumPy arrays updated in
+    place)
     """
     ### update initial probabilities
-    n = len(T)
-    total = 0.
-    delta = 0.
-    for i in xrange(n):
-        total += new_pi[i]
-    for i in xrange(n):
-        new_pi[i] /= total
-        delta = max(delta, abs(new_pi[i] - pi[i]))
-        pi[i] = new_pi[i]
+    new_pi /= new_pi.sum()
+    delta = np.abs(new_pi - pi).max()
+    pi[:] = new_pi
     ### update transitions
-    for i in xrange(n):
-        total = 0.
-        for j in xrange(n):
-            total += new_T[i][j]
-        for j in xrange(n):
-            new_T[i][j] /= total
-            delta = max(delta, abs(new_T[i][j] - T[i][j]))
-            T[i][j] = new_T[i][j]
+    new_T /= new_T.sum(axis=1)[:, None]
+    delta = max(delta, np.abs(new_T - T).max())
+    T[:] = new_T
     ### update emissions
-    for i in xrange(n):
-        # update the means
-        if corrector[i] > 0.:
-            new_E[i][0] /= corrector[i]
-            new_E[i][1] /= corrector[i]
-            # corrector[i] = 1.
-            delta = max(delta, abs(new_E[i][0] - E[i][0]))
-            E[i][0] = new_E[i][0]
-            # update the stdevs
-            delta = max(delta, abs(new_E[i][1] - E[i][1]))
-            E[i][1] = new_E[i][1]
+    seen = corrector > 0.
+    if seen.any():
+        # update the means and the stdevs
+        new_E[seen] /= corrector[seen, None]
+        delta = max(delta, np.abs(new_E[seen] - E[seen]).max())
+        E[seen] = new_E[seen]
     return delta
 
 def train(pi, T, E, observations, verbose=False, threshold=1e-6, n_iter=1000):
+    """
+    trains the HMM with the Baum-Welch algorithm. pi, T and E are updated in
+    place.
+    """
+    cur_pi = np.array(pi, dtype=float)
+    cur_T  = np.array(T , dtype=float)
+    cur_E  = np.array(E , dtype=float)
+    observations = [np.asarray(obs, dtype=float) for obs in observations]
     delta = float('inf')
     for it in xrange(n_iter):
         # reset for new iteration
-        new_pi = [0. for _ in pi]
-        new_T  = [[0. for _ in i] for i in T]
-        new_E  = [[0. for _ in i] for i in E]
-        corrector = [0. for _ in xrange(len(T))]
+        new_pi = np.zeros_like(cur_pi)
+        new_T  = np.zeros_like(cur_T)
+        new_E  = np.zeros_like(cur_E)
+        corrector = np.zeros(len(cur_T))
         for h in xrange(len(observations)):
-            probs  = gaussian_prob(observations[h], E)
-            alphas, scalars = get_alpha(probs, pi, T)
-            betas  = get_beta(probs, T, scalars)
-            etas   = get_eta(probs, T, alphas, betas)
-            gammas = get_gamma(T, alphas, betas)
-            baum_welch_optimization(observations[h], T, E, new_pi, new_T, corrector,
-                                    new_E, etas, gammas)
-        delta = update_parameters(corrector, pi, new_pi, T, new_T, E, new_E)
+            probs  = gaussian_prob(observations[h], cur_E)
+            alphas, scalars = get_alpha(probs, cur_pi, cur_T)
+            betas  = get_beta(probs, cur_T, scalars)
+            etas   = get_eta(probs, cur_T, alphas, betas)
+            gammas = get_gamma(cur_T, alphas, betas)
+            baum_welch_optimization(observations[h], cur_T, cur_E, new_pi,
+                                    new_T, corrector, new_E, etas, gammas)
+        delta = update_parameters(corrector, cur_pi, new_pi, cur_T, new_T,
+                                  cur_E, new_E)
         if verbose:
             print ("\rTraining: %03i/%04i (diff: %.8f)") % (it, n_iter, delta),
             sys.stdout.flush()
@@ -120,87 +101,81 @@ def train(pi, T, E, observations, verbose=False, threshold=1e-6, n_iter=1000):
             break
     if verbose:
         print "\n"
+    # copy back the trained parameters
+    pi[:] = cur_pi.tolist()
+    for i in xrange(len(T)):
+        T[i][:] = cur_T[i].tolist()
+        E[i][:] = cur_E[i].tolist()
 
 def get_eta(probs, T, alphas, betas):
     """
     for Baum-Welch: probability of being in states i and j at times t and t+1
+
+    :returns: a NumPy array with states i, states j and times t as axes
     """
-    n = len(T)
-    m = len(probs[0])
-    etas = [[[0.  for _ in xrange(m - 1)] for _ in xrange(n)] for _ in xrange(n)]
-    for k in xrange(m - 1):
-        tot = 0.
-        for i in xrange(n):
-            for j in xrange(n):
-                etas[i][j][k] += alphas[i][k] * T[i][j] * probs[j][k+1] * betas[j][k+1]
-                tot += etas[i][j][k]
-        for i in xrange(n):
-            for j in xrange(n):
-                etas[i][j][k] /= tot
+    T = np.asarray(T, dtype=float)
+    etas = (alphas[:, None, :-1] * T[:, :, None] *
+            (probs[:, 1:] * betas[:, 1:])[None, :, :])
+    etas /= etas.sum(axis=(0, 1))
     return etas
 
 def get_gamma(T, alphas, betas):
     """
     for Baum-Welch: probability of being in state i at time t
     """
-    n = len(T)
-    m = len(alphas[0])
-    return [[alphas[i][k] * betas[i][k]  for k in xrange(m)] for i in xrange(n)]
+    return alphas * betas
 
 def gaussian_prob(x, E):
     """
     of x to follow the gaussian with given E
     https://en.wikipedia.org/wiki/Normal_distribution
-    """
-    probs = []
-    for d, (mu, sd) in enumerate(E):
-        pi2sd = (2. * pi_num * sd)**-0.5
-        inv2sd = 1. / (2. * sd)
-        probs.append([])
-        for obs in x:
-            p = pi2sd * exp(-(obs - mu)**2 * inv2sd)
-            probs[d].append(p)
-    return probs
+
+    :returns: a NumPy array with one row per state, and one column per
+       observation
+    """
+    x = np.asarray(x, dtype=float)
+    E = np.asarray(E, dtype=float)
+    mu, sd = E[:, 0, None], E[:, 1, None]
+    pi2sd = (2. * pi_num * sd)**-0.5
+    inv2sd = 1. / (2. * sd)
+    return pi2sd * exp(-(x[None, :] - mu)**2 * inv2sd)
 
 def get_alpha(probs, pi, T):
     """
-    computes alphas using forward algorithm
+    computes alphas using forward algorithm (scaled at each time step)
     """
-    n = len(T)
-    m = len(probs[0])
-    alphas = [[0. for _ in xrange(m)] for _ in xrange(n)]
-    scalars = [0. for _ in xrange(m)]
+    T = np.asarray(T, dtype=float)
+    # time steps in rows, to work on contiguous vectors
+    probs = np.ascontiguousarray(probs.T)
+    m, n = probs.shape
+    alphas = np.empty((m, n))
+    scalars = np.empty(m)
+    ones = np.ones(n)
 
     # initialize alpha for each state
-    for i in xrange(n):
-        alphas[i][0] = pi[i] * probs[i][0]
-        scalars[0] += alphas[i][0]
-    for i in xrange(n):
-        alphas[i][0] /= scalars[0]
+    alpha = np.asarray(pi, dtype=float) * probs[0]
+    scalars[0] = alpha.dot(ones)
+    np.divide(alpha, scalars[0], alphas[0])
     for k in xrange(1, m):
-        for i in xrange(n):
-            for j in xrange(n):
-                # all transition probabilities to become "i" times previous alpha
-                alphas[i][k] += alphas[j][k-1] * T[j][i]
-            # times probablity to belong to this states
-            alphas[i][k] *= probs[i][k]
-            scalars[k] += alphas[i][k]
-        for i in xrange(n):
-            alphas[i][k] /= scalars[k]
-    return alphas, scalars
+        # all transition probabilities to become "i" times previous alpha,
+        # times probablity to belong to this states
+        alpha = alphas[k - 1].dot(T)
+        alpha *= probs[k]
+        scalars[k] = alpha.dot(ones)
+        np.divide(alpha, scalars[k], alphas[k])
+    return alphas.T, scalars
 
 def get_beta(probs, T, scalars):
     """
     computes betas using backward algorithm
     """
-    n = len(T)
-    m = len(probs[0])
+    T = np.asarray(T, dtype=float)
+    probs = np.ascontiguousarray(probs.T)
+    m, n = probs.shape
     # intialize beta at 1.0
-    betas = [[0. for _ in xrange(m - 1)] + [1.0] for _ in xrange(n)]
-    for k in xrange(-2, -m - 1, -1):
-        for i in xrange(n):
-            for j in xrange(n):
-                betas[i][k] += betas[j][k + 1] * probs[j][k + 1] * T[i][j]
-            betas[i][k] /= scalars[k + 1]
-    return betas
-
+    betas = np.empty((m, n))
+    betas[-1] = 1.
+    for k in xrange(m - 2, -1, -1):
+        beta = T.dot(betas[k + 1] * probs[k + 1])
+        np.divide(beta, scalars[k + 1], betas[k])
+    return betas.T
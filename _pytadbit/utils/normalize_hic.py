@@ -51,6 +51,8 @@ matrix W of size N:
 
 """
 
+import numpy as np
+
 def _update_S(W):
     S = {}
     meanS = 0.0
@@ -95,7 +97,10 @@ def iterative(hic_data, bads=None, iterations=0, max_dev=0.00001,
               verbose=False, **kwargs):
     """
     Implementation of iterative correction Imakaev 2012
-    
+
+    HiC_data objects are normalized with NumPy arrays (see
+    :func:`iterative_sparse`), other dictionaries cell by cell.
+
     :param hic_data: dictionary containing the interaction data
     :param None bads: dictionary with column not to be considered
     :param None remove: columns not to consider
@@ -105,6 +110,9 @@ def iterative(hic_data, bads=None, iterations=0, max_dev=0.00001,
        mean value of all raws
     :returns: a vector of biases (length equal to the size of the matrix)
     """
+    if hasattr(hic_data, 'get_upper_triangle'):
+        return iterative_sparse(hic_data, bads=bads, iterations=iterations,
+                                max_dev=max_dev, verbose=verbose)
     if verbose:
         print 'iterative correction'
     size = len(hic_data)
@@ -145,7 +153,163 @@ def iterative(hic_data, bads=None, iterations=0, max_dev=0.00001,
     return B
 
 
-def expected(hic_data, bads=None, signal_to_noise=0.05, inter_chrom=False, **kwargs):
+def iterative_sparse(hic_data, bads=None, iterations=0, max_dev=0.00001,
+                     verbose=False, **kwargs):
+    """
+    Implementation of iterative correction Imakaev 2012, on the upper triangle
+    of the matrix stored in NumPy arrays (in compressed sparse row order). Row
+    sums and bias scaling are vectorized.
+
+    Same parameters and results as :func:`iterative`.
+
+    :param hic_data: HiC_data object
+    :param None bads: dictionary with column not to be considered
+    :param 0 iterations: number of iterations to do (99 if a fully smoothed
+       matrix with no visibility differences between columns is desired)
+    :param 0.00001 max_dev: maximum difference allowed between a row and the
+       mean value of all raws
+    :returns: a vector of biases (length equal to the size of the matrix)
+    """
+    if verbose:
+        print 'iterative correction'
+    size = len(hic_data)
+    if verbose:
+        print "  - copying matrix"
+    rows, cols, vals = hic_data.get_upper_triangle()
+    if bads:
+        good = _good_bins(size, bads)
+        keep = good[rows] & good[cols]
+        rows, cols, vals = rows[keep], cols[keep], vals[keep]
+    vals = vals.astype(float)
+    present = np.zeros(size, dtype=bool)
+    present[rows] = True
+    present[cols] = True
+    npresent = present.sum()
+    if npresent == 0:
+        raise ZeroDivisionError('ERROR: normalization failed, all bad columns')
+    B = np.ones(size)
+    if verbose:
+        print "  - computing baises"
+    for it in xrange(iterations + 1):
+        S = _row_sums(rows, cols, vals, size)
+        meanS = S[present].sum() / npresent
+        DB = S / meanS
+        B[present] *= DB[present]
+        if iterations == 0: # exit before, we do not need to update W
+            break
+        # whole empty rows are not scaled
+        DB[DB == 0] = 1.
+        vals /= DB[rows]
+        vals /= DB[cols]
+        if _deviation(S, present, meanS, it, verbose) < max_dev:
+            break
+    return _final_bias(B, present, meanS)
+
+
+def iterative_out_of_core(chunks, size, bads=None, iterations=0,
+                          max_dev=0.00001, verbose=False, **kwargs):
+    """
+    Implementation of iterative correction Imakaev 2012, for matrices that do
+    not fit in memory. At each iteration the interactions are read chunk by
+    chunk, and divided by the current biases; only vectors of the size of the
+    matrix (row sums and biases) are kept in memory.
+
+    Same results as :func:`iterative`.
+
+    :param chunks: function returning an iterator over the cells of the upper
+       triangle of the matrix, as chunks of three arrays (rows, columns and
+       values). A same cell may appear in several chunks.
+    :param size: number of rows (and columns) of the matrix
+    :param None bads: dictionary with column not to be considered
+    :param 0 iterations: number of iterations to do (99 if a fully smoothed
+       matrix with no visibility differences between columns is desired)
+    :param 0.00001 max_dev: maximum difference allowed between a row and the
+       mean value of all raws
+    :returns: a vector of biases (length equal to the size of the matrix)
+    """
+    if verbose:
+        print 'iterative correction (out of core)'
+    good = _good_bins(size, bads)
+    present = None
+    B = np.ones(size)
+    if verbose:
+        print "  - computing baises"
+    for it in xrange(iterations + 1):
+        S = np.zeros(size)
+        if present is None:
+            seen = np.zeros(size, dtype=bool)
+        for rows, cols, vals in chunks():
+            keep = good[rows] & good[cols]
+            rows, cols = rows[keep], cols[keep]
+            # current state of the matrix
+            vals = vals[keep] / B[rows]
+            vals /= B[cols]
+            S += _row_sums(rows, cols, vals, size)
+            if present is None:
+                seen[rows] = True
+                seen[cols] = True
+        if present is None:
+            present = seen
+            npresent = present.sum()
+            if npresent == 0:
+                raise ZeroDivisionError(
+                    'ERROR: normalization failed, all bad columns')
+        meanS = S[present].sum() / npresent
+        DB = S / meanS
+        # whole empty rows are not scaled
+        DB[DB == 0] = 1.
+        B[present] *= DB[present]
+        if iterations == 0:
+            break
+        if _deviation(S, present, meanS, it, verbose) < max_dev:
+            break
+    B[present & (S == 0)] = 0.
+    return _final_bias(B, present, meanS)
+
+
+def _good_bins(size, bads):
+    """
+    :returns: an array of booleans, False for bad columns
+    """
+    good = np.ones(size, dtype=bool)
+    if bads:
+        good[[b for b in bads if b < size]] = False
+    return good
+
+
+def _row_sums(rows, cols, vals, size):
+    """
+    sums of the rows of a symmetric matrix given its upper triangle, off
+    diagonal cells count in the sum of both their row and column
+    """
+    lower = rows != cols
+    return (np.bincount(rows, weights=vals, minlength=size) +
+            np.bincount(cols[lower], weights=vals[lower], minlength=size))
+
+
+def _deviation(S, present, meanS, it, verbose):
+    """
+    :returns: the maximum deviation of the sum of a row to the mean
+    """
+    S = S[present]
+    dev = max(abs(S.min() / meanS - 1), abs(S.max() / meanS - 1))
+    if verbose:
+        print '   %15.3f %15.3f %15.3f %4s %9.5f' % (S.min(), meanS, S.max(),
+                                                     it, dev)
+    return dev
+
+
+def _final_bias(B, present, meanS):
+    """
+    scales biases by the mean sum of rows, empty or bad rows get a bias of 1
+    """
+    B[present & (B != 0)] *= meanS**.5
+    B[~present | (B == 0)] = 1.
+    return dict(enumerate(B.tolist()))
+
+
+def expected(hic_data, bads=None, signal_to_noise=0.05, inter_chrom=False,
+             normalized=False, **kwargs):
     """
     Computes the expected values by averaging observed interactions at a given
     distance in a given HiC matrix.
@@ -156,9 +320,13 @@ def expected(hic_data, bads=None, signal_to_noise=0.05, inter_chrom=False, **kwa
        if not enough reads are observed at a given distance the observations
        of the distance+1 are summed. a signal to noise ratio of < 0.05
        corresponds to > 400 reads.
+    :param False normalized: average interactions normalized by the biases
+       of hic_data
     
     :returns: a vector of biases (length equal to the size of the matrix)
     """
+    if normalized and not hic_data.bias:
+        raise Exception('ERROR: experiment not normalized yet')
     min_n = signal_to_noise ** -2. # equals 400 when default
 
     size = len(hic_data)
@@ -168,38 +336,74 @@ def expected(hic_data, bads=None, signal_to_noise=0.05, inter_chrom=False, **kwa
     except AttributeError:
         pass
 
-    if size > 1200:
-        import sys
-        sys.setrecursionlimit(size + 100)
+    sums, counts = _diagonal_sums(hic_data, bads or {}, size,
+                                  hic_data.bias if normalized else None)
 
     expc = {}
     dist = 0
     while dist < size:
-        diag = []
-        new_dist, val = _meandiag(hic_data, dist, diag, min_n, size, bads)
+        new_dist, val = _pool_diagonals(sums, counts, dist, min_n, size)
         for dist in range(dist, new_dist + 1):
             expc[dist] = val
     return expc
 
-def _meandiag(hic_data, dist, diag, min_n, size, bads):
+
+def _diagonal_sums(hic_data, bads, size, bias=None):
+    """
+    sums the interactions (normalized if bias is given), and counts the cells,
+    found at each distance from the diagonal, within chromosomes (rows in bads
+    are skipped)
+
+    :returns: two numpy arrays, indexed by distance, with the sum of
+       interactions and the number of cells
+    """
+    nbins = len(hic_data)
     if hic_data.section_pos:
-        for crm in hic_data.section_pos:
-            for i in xrange(hic_data.section_pos[crm][0],
-                            hic_data.section_pos[crm][1] - dist):
-                if i in bads:
-                    continue
-                diag.append(hic_data[i, i + dist])
-    else:
-        for i in xrange(size - dist):
-            if i in bads:
-                continue
-            diag.append(hic_data[i, i + dist])
-    sum_diag = sum(diag)
-    if len(diag) == 0:
-        return dist + 1, 0.
-    if sum_diag > min_n:
-        return dist + 1, float(sum_diag) / len(diag)
-    elif dist >= size:
-        return dist + 1, float(sum_diag) / len(diag)
+        sections = sorted(hic_data.section_pos.values())
     else:
-        return _meandiag(hic_data, dist + 1, diag, min_n, size, bads)
+        sections = [(0, nbins)]
+    # chromosome of each bin (-1 outside chromosomes), and distance from each
+    # bin to the end of its chromosome
+    crm = np.empty(nbins, dtype=np.int64)
+    crm.fill(-1)
+    last = np.zeros(nbins, dtype=np.int64)
+    for k, (beg, end) in enumerate(sections):
+        crm[beg:end] = k
+        last[beg:end] = end - 1
+    good = crm >= 0
+    good[[b for b in bads if b < nbins]] = False
+
+    rows, cols, vals = hic_data.get_upper_triangle()
+    keep = good[rows] & (crm[rows] == crm[cols])
+    rows, cols, vals = rows[keep], cols[keep], vals[keep]
+    if bias:
+        bias = np.array([bias.get(i, 1.) for i in xrange(nbins)])
+        vals = vals / bias[rows] / bias[cols]
+    length = size + 2
+    sums = np.bincount(cols - rows, weights=vals, minlength=length)
+    # a row contributes one cell to each distance up to the end of its
+    # chromosome
+    maxd = (last - np.arange(nbins))[good]
+    counts = np.bincount(maxd, minlength=length)[::-1].cumsum()[::-1]
+    return sums, counts
+
+
+def _pool_diagonals(sums, counts, dist, min_n, size):
+    """
+    pools the diagonals from dist on, until more than min_n interactions are
+    summed
+
+    :returns: the distance following the last pooled diagonal, and the mean
+       value of the cells in the pooled diagonals
+    """
+    sum_diag = 0.
+    num_diag = 0
+    while True:
+        if dist < len(sums):
+            sum_diag += sums[dist]
+            num_diag += counts[dist]
+        if num_diag == 0:
+            return dist + 1, 0.
+        if sum_diag > min_n or dist >= size:
+            return dist + 1, float(sum_diag) / num_diag
+        dist += 1
@@ -168,6 +168,46 @@ def zscore(values):
         values[i] = (values[i] - mean_v) / std_v
 
 
+def zscore_array(values):
+    """
+    Same as :func:`zscore` but on a NumPy array of values.
+
+    :param values: NumPy array of values
+
+    :returns: a new NumPy array with the Z-score of the log10 of the values
+    """
+    values = np.asarray(values, dtype=float)
+    # Set the virtual minimum of the matrix to half the non-null real minimum
+    minv = values[values != 0].min() / 2
+    logv = np.empty_like(values)
+    positive = values > 0
+    logv[positive] = np.log10(values[positive])
+    logv[~positive] = np.log10(minv)
+    logv[np.isnan(values)] = float('nan')
+    return (logv - logv.mean()) / logv.std()
+
+
+def zscores_to_dict(rows, cols, values):
+    """
+    Converts Z-scores in coordinate format into the dictionary of dictionaries
+    used in the modelling (e.g.: ``{'1': {'2': 0.5, '3': -0.2}}``)
+
+    :param rows: NumPy array of row indexes, sorted
+    :param cols: NumPy array of column indexes
+    :param values: NumPy array of Z-scores
+
+    :returns: a dictionary of dictionaries, with rows and columns as strings
+    """
+    zscores = {}
+    if not len(rows):
+        return zscores
+    bounds = np.flatnonzero(np.diff(rows)) + 1
+    for beg, end in zip([0] + bounds.tolist(), bounds.tolist() + [len(rows)]):
+        zscores[str(rows[beg])] = dict(zip(
+            [str(j) for j in cols[beg:end].tolist()], values[beg:end].tolist()))
+    return zscores
+
+
 def calinski_harabasz(scores, clusters):
     """
     Implementation of the CH score [CalinskiHarabasz1974]_, that has shown to be
@@ -22,6 +22,10 @@ into compressed BAM format.
 #    - quality is missing (*)
 #    - TC tag indicating single (1) or multi (2) contact
 #
+# If the reads were parsed with integer read IDs (read_ids option of
+#  parse_map), IDs are translated back to the original read names, using the
+#  file given in the "# READ IDS" line of the header.
+#
 # Each pair of contacts porduces two lines in the output SAM
 #
 
@@ -29,19 +33,30 @@ into compressed BAM format.
 # dependencies
 
 from argparse                     import ArgumentParser
+from itertools                    import izip
+from pytadbit.mapping.filter      import is_bitmask_fresh
+from mmap                         import mmap, ACCESS_READ
+import numpy as np
 import sys
 import os
 import collections
 
 # get arguments
 
-def map2sam (line, flag):
+def map2sam (line, flag, read_name=None):
     """
     translate map + flag into hic-sam (two lines per contact)
+
+    :param None read_name: function returning the name of a read from its
+       integer ID, if reads were parsed with read IDs
     """
     (qname,
      rname, pos, s1, l1, e1, e2,
      rnext, pnext, s2, l2, e3, e4) = line.strip().split('\t')
+    if read_name:
+        # ID followed by the marks of multiple contacts (~N~ or #N/M)
+        rid = qname.split('#', 1)[0].split('~', 1)[0]
+        qname = read_name(int(rid)) + qname[len(rid):]
 
     # store mapped length and strand in a single value
     mapq = ('-' * (s1 == '0')) + l1
@@ -98,10 +113,24 @@ def main():
     line = fhandler.next()
     # chromosome lengths
     pos_fh = 0
+    read_name = None
     
     while line.startswith('#'):
-        (_, _, cr, ln) = line.replace("\t", " ").strip().split(" ")
-        print "\t".join(("@SQ", "SN:" + cr, "LN:" + ln))
+        if line.startswith('# CRM '):
+            (_, _, cr, ln) = line.replace("\t", " ").strip().split(" ")
+            print "\t".join(("@SQ", "SN:" + cr, "LN:" + ln))
+        elif line.startswith('# READ IDS\t'):
+            names_path = line.rstrip('\n').split('\t', 1)[1]
+            # relative paths are taken from the working directory of the
+            # parsing, or from the directory of the input file
+            if not os.path.exists(names_path):
+                names_path = os.path.join(os.path.dirname(infile),
+                                          names_path)
+            if not os.path.exists(names_path):
+                raise Exception('ERROR: file with read names not found: %s\n'
+                                % names_path)
+            sys.stderr.write('Using read names:\n   %s\n' % names_path)
+            read_name = get_read_names(names_path)
         pos_fh += len(line)
         line = fhandler.next()
     
@@ -116,8 +145,14 @@ def main():
     print "\t".join(("@CO" ,"E3:i", "Position of the left RE site of second read"))
     print "\t".join(("@CO" ,"E4:i", "Position of the right RE site of second read"))    
     
-    # open and init filter files
-    if not opts.valid:
+    # open and init filter files (the bitmask of the filters already
+    # corresponds to the flag, if present and computed from this infile)
+    bitmask = infile + '_filters.bin'
+    use_bitmask = is_bitmask_fresh(infile, bitmask)
+    if not opts.valid and os.path.exists(bitmask) and not use_bitmask:
+        sys.stderr.write('WARNING: %s does not correspond to the current '
+                         'input, using filter files\n' % bitmask)
+    if not opts.valid and not use_bitmask:
         filter_line, filter_handler = get_filters(infile)
     
     fhandler.seek(pos_fh)
@@ -125,7 +160,13 @@ def main():
         for line in fhandler:
             flag = 0
             # get output in sam format
-            sys.stdout.write(map2sam(line, flag))
+            sys.stdout.write(map2sam(line, flag, read_name))
+    elif use_bitmask:
+        sys.stderr.write('Using filter bitmask:\n   %s\n' % bitmask)
+        flags = np.fromfile(bitmask, dtype=np.uint16)
+        for line, flag in izip(fhandler, flags.tolist()):
+            # get output in sam format
+            sys.stdout.write(map2sam(line, flag, read_name))
     else:
         for line in fhandler:
             flag = 0
@@ -139,15 +180,30 @@ def main():
                     except StopIteration:
                         pass
             # get output in sam format
-            sys.stdout.write(map2sam(line, flag))
+            sys.stdout.write(map2sam(line, flag, read_name))
     
     # close file handlers
     fhandler.close()
-    if not opts.valid:
+    if not opts.valid and not use_bitmask:
         for i in filter_handler:
             filter_handler[i].close()    
 
 
+def get_read_names(names_path):
+    """
+    index the file with the original read names (line N being the name of
+    the read with ID N)
+
+    :returns: a function returning the name of a read from its ID
+    """
+    fhandler = open(names_path)
+    names = mmap(fhandler.fileno(), 0, access=ACCESS_READ)
+    fhandler.close()
+    ends = np.flatnonzero(np.frombuffer(names, dtype=np.uint8) == ord('\n'))
+    begs = np.concatenate(([0], ends[:-1] + 1))
+    return lambda rid: names[begs[rid]:ends[rid]]
+
+
 def get_filters(infile):
     """
     get all filters
@@ -158,7 +214,7 @@ def get_filters(infile):
     filter_files = {}
     sys.stderr.write('Using filter files:\n')
     for fname in os.listdir(dirname):
-        if fname.startswith(basename + "_"):
+        if fname.startswith(basename + "_") and fname.endswith('.tsv'):
             key = fname.replace(basename + "_", "").replace(".tsv", "")
             filter_files[key] = dirname + "/" + fname
             sys.stderr.write('   - %-20s %s\n' %(key, fname))
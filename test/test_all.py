@@ -8,26 +8,54 @@ import matplotlib
 matplotlib.use('Agg')
 
 import unittest
-from pytadbit                             import Chromosome, load_chromosome
+from pytadbit                             import Chromosome, load_chromosome, Experiment
 from pytadbit                             import tadbit, batch_tadbit
 from pytadbit.tad_clustering.tad_cmo      import optimal_cmo
 from pytadbit.modelling.structuralmodels        import load_structuralmodels
 from pytadbit.modelling.impmodel                import load_impmodel_from_cmm
 from pytadbit.eqv_rms_drms                import rmsdRMSD_wrapper
-from pytadbit.parsers.genome_parser       import parse_fasta
+from pytadbit.parsers.genome_parser       import parse_fasta, load_genome
 from pytadbit.mapping.restriction_enzymes import map_re_sites, RESTRICTION_ENZYMES
+from pytadbit.mapping.restriction_enzymes import index_re_sites
+from pytadbit.mapping.restriction_enzymes import re_fragment_bounds
+from pytadbit.mapping.restriction_enzymes import religateds
+from pytadbit.mapping.full_mapper         import _ligation_patterns
+from pytadbit.mapping.full_mapper         import _split_read_re
+from pytadbit.mapping.full_mapper         import full_mapping, transform_fastq
+from pytadbit.parsers.map_parser          import parse_map, merge_parsed_reads
+from pytadbit.parsers.map_parser          import _parse_map_file
+from pytadbit.parsers.map_parser          import read_names_path
 from pytadbit.parsers.hic_parser          import load_hic_data_from_reads, read_matrix
+from pytadbit.parsers.hic_parser          import autoreader
+from pytadbit.hic_data                    import HiC_data, SparseHiC_data
+from pytadbit.parsers.hic_binary_parser   import write_hic_binary, load_hic_binary
+from pytadbit.parsers.hic_binary_parser   import build_hic_pyramid
 from pytadbit.mapping.analyze             import hic_map, plot_distance_vs_interactions
 from pytadbit.mapping.analyze             import insert_sizes, plot_iterative_mapping
 from pytadbit.mapping.analyze             import correlate_matrices, eig_correlate_matrices
 from pytadbit.mapping.filter              import filter_reads, apply_filter
+from pytadbit.mapping.filter              import is_bitmask_fresh
+from pytadbit.mapping                     import merge_2d_beds, get_intersection
+from pytadbit.parsers.reads_cache         import write_reads_cache, load_reads_cache
+from pytadbit.parsers.reads_cache         import is_cache_fresh
+from pytadbit.utils.file_handling         import magic_open, magic_write
+from pytadbit.utils.file_handling         import BgzfReader
+from pytadbit.utils.normalize_hic         import iterative, expected
+from pytadbit.utils                       import hmm
+from pytadbit.utils.tadmaths              import zscore
 
 from random                               import random, seed
-from os                                   import system, path, chdir
-from re                                   import finditer
+from math                                 import isnan
+from collections                          import OrderedDict
+from bisect                               import bisect_right as bisect
+from os                                   import system, path, chdir, utime
+from os                                   import listdir
+from re                                   import finditer, compile, sub
 from warnings                             import warn, catch_warnings, simplefilter
 from distutils.spawn                      import find_executable
 
+import numpy as np
+import gzip
 import sys
 
 
@@ -46,6 +74,69 @@ def check_hic(hic, size):
     return True
 
 
+class MatrixDict(dict):
+    """
+    plain dictionary with the cells of a Hi-C matrix, its length being the
+    size of the matrix (processed cell by cell by normalization functions)
+    """
+    def __init__(self, hic_data):
+        super(MatrixDict, self).__init__(hic_data.iteritems())
+        self.size = len(hic_data)
+
+    def __len__(self):
+        return self.size
+
+
+def write_random_reads(fnam, crm_lengths, nreads, prefix='read'):
+    """
+    writes a file with random pairs of reads, as generated by
+    get_intersection, with read names sorted
+
+    :returns: the chromosome and position of both reads of each pair
+    """
+    out = open(fnam, 'w')
+    for crm, clen in crm_lengths:
+        out.write('# CRM %s\t%d\n' % (crm, clen))
+    reads = []
+    for num in xrange(nreads):
+        (cr1, len1), (cr2, len2) = [crm_lengths[int(random() * len(crm_lengths))]
+                                    for _ in xrange(2)]
+        ps1, ps2 = int(random() * len1), int(random() * len2)
+        reads.append((cr1, ps1, cr2, ps2))
+        out.write('%s%06d\t%s\t%d\t1\t75\t%d\t%d\t%s\t%d\t0\t75\t%d\t%d\n'
+                  % (prefix, num, cr1, ps1, ps1 - 10, ps1 + 10,
+                     cr2, ps2, ps2 - 10, ps2 + 10))
+    out.close()
+    return reads
+
+
+def write_random_maps(prefix):
+    """
+    writes MAP files of both read ends, for three iterations of the mapping,
+    with reads found in several iterations (multiple contacts)
+
+    :returns: the random genome, and the paths to the MAP files of each read
+       end
+    """
+    genome = OrderedDict((crm, ''.join('ACGT'[int(random() * 4)]
+                                       for _ in xrange(clen)))
+                         for crm, clen in [('chr1', 20000), ('chr2', 15000)])
+    names = ['R%05d' % int(random() * 100000) for _ in xrange(2000)]
+    fnames = []
+    for end in (1, 2):
+        fnames.append([])
+        for num in (1, 2, 3):
+            fnames[-1].append('%s%d.map.%d' % (prefix, end, num))
+            out = open(fnames[-1][-1], 'w')
+            for name in names[num * 300:num * 300 + 900]:
+                crm = genome.keys()[int(random() * 2)]
+                out.write('%s\t%s\tHHH\t1\t%s:%s:%d:3\n' % (
+                    name, 'A' * (20 + num * 5), crm, '+-'[random() > 0.5],
+                    1 + int(random() * (len(genome[crm]) - 100))))
+            out.close()
+    return genome, fnames
+
+
 class TestTadbit(unittest.TestCase):
     """
     test main tadbit functions
@@ -339,6 +430,19 @@ class TestTadbit(unittest.TestCase):
         hic_data = exp.hic_data[0]
         hic_data.find_compartments(label_compartments='cluster')
         self.assertEqual(len(hic_data.compartments[None]), 39)
+        # chromosomes processed in parallel
+        hic_data = HiC_data(hic_data.items(), len(hic_data), resolution=20000)
+        hic_data.add_sections([59, 39], chr_names=['c1', 'c2'], binned=True)
+        hic_data.find_compartments(label_compartments='cluster')
+        cmprts = hic_data.compartments
+        hic_data.compartments = {}
+        hic_data.find_compartments(label_compartments='cluster', ncpus=2)
+        self.assertEqual(cmprts, hic_data.compartments)
+        # expected values already given (e.g. loaded with the matrix) are used
+        expc = dict(hic_data.expected)
+        hic_data.expected = expc
+        hic_data.find_compartments(label_compartments='cluster')
+        self.assertTrue(hic_data.expected is expc)
         # self.assertEqual(round(hic_data.compartments[None][24]['dens'], 5),
         #                  0.75434)
         if CHKTIME:
@@ -803,6 +907,1190 @@ class TestTadbit(unittest.TestCase):
             self.assertEqual(True, True)
             print '20', time() - t0
 
+    def test_21_sparse_hic_data(self):
+        """
+        Hi-C data stored in NumPy arrays
+        """
+        if ONLY and ONLY != '21':
+            return
+        if CHKTIME:
+            t0 = time()
+        hic_data = read_matrix(PATH + '/20Kb/chrT/chrT_A.tsv', resolution=20000)
+        sparse = hic_data.to_sparse()
+        self.assertEqual(sparse, hic_data)
+        self.assertEqual(sparse[12, 3], hic_data[3, 12])
+        self.assertEqual(sum(sparse.values()), sum(hic_data.values()))
+        sparse.filter_columns(silent=True)
+        hic_data.filter_columns(silent=True)
+        self.assertEqual(sparse.bads, hic_data.bads)
+        sparse.normalize_hic(silent=True)
+        hic_data.normalize_hic(silent=True)
+        self.assertEqual([round(sparse.bias[i], 5) for i in sparse.bias],
+                         [round(hic_data.bias[i], 5) for i in hic_data.bias])
+        # out of core normalization
+        sparse.normalize_hic(silent=True, memory=1)
+        self.assertEqual([round(sparse.bias[i], 5) for i in sparse.bias],
+                         [round(hic_data.bias[i], 5) for i in hic_data.bias])
+        sparse.bias = hic_data.bias
+        for focus in [None, (3, 20), (3, 20, 10, 40)]:
+            self.assertEqual(
+                sparse.get_array(focus=focus, normalized=True).tolist(),
+                hic_data.get_matrix(focus=focus, normalized=True))
+            self.assertEqual(
+                sparse.get_array(focus=focus, diagonal=False).tolist(),
+                hic_data.get_matrix(focus=focus, diagonal=False))
+        sparse[3, 12] = 0
+        self.assertEqual(sparse[12, 3], 0)
+        self.assertFalse(3 * len(sparse) + 12 in sparse)
+        self.assertEqual(len(sparse.keys()), len(hic_data.keys()) - 2)
+        # deleting cells, stored or just assigned
+        size = len(sparse)
+        self.assertTrue(5 * size + 7 in sparse)
+        del sparse[7, 5]
+        self.assertFalse(5 * size + 7 in sparse)
+        self.assertEqual(sparse[5, 7], 0)
+        sparse[1, 2] = 10
+        del sparse[1 * size + 2]
+        self.assertEqual(sparse[2, 1], 0)
+        self.assertRaises(KeyError, sparse.__delitem__, (1, 2))
+        self.assertEqual(len(sparse.keys()), len(hic_data.keys()) - 4 -
+                         2 * (hic_data[1, 2] != 0))
+        # resizing keeps the row and column of the cells
+        sparse[40, 45] = 3
+        sparse.add_sections([30, 50], chr_names=['c1', 'c2'], binned=True)
+        self.assertEqual(len(sparse), 82)
+        self.assertEqual(sparse[45, 40], 3)
+        self.assertEqual(sparse[81, 80], hic_data[80, 81])
+        self.assertEqual(sparse[2, 30], hic_data[2, 30])
+        sparse.add_sections([30, 30], chr_names=['c1', 'c2'], binned=True)
+        self.assertEqual(sparse[45, 40], 3)
+        self.assertEqual(len(sparse.get_upper_triangle()[0]),
+                         len([k for k in sparse.iterkeys()
+                              if k / 62 <= k % 62]))
+        # columns with NaNs removed by Experiment
+        exp = Experiment('lala', 20000, hic_data=[hic_data.get_matrix()])
+        exp.hic_data[0] = exp.hic_data[0].to_sparse()
+        exp.hic_data[0][3, 4] = float('nan')
+        exp.filter_columns(silent=True)
+        self.assertFalse(3 * exp.size + 4 in exp.hic_data[0])
+        self.assertFalse(4 * exp.size + 3 in exp.hic_data[0])
+        if CHKTIME:
+            self.assertEqual(True, True)
+            print '21', time() - t0
+
+    def test_22_hic_binary(self):
+        """
+        Hi-C data stored in memory-mapped binary file
+        """
+        if ONLY and ONLY != '22':
+            return
+        if CHKTIME:
+            t0 = time()
+        hic_data = read_matrix(PATH + '/20Kb/chrT/chrT_A.tsv', resolution=20000)
+        hic_data.add_sections([39, 29, 29], chr_names=['c1', 'c2', 'c3'],
+                              binned=True)
+        hic_data.filter_columns(silent=True)
+        hic_data.normalize_hic(silent=True)
+        write_hic_binary(hic_data, 'lala-hic.bin')
+        binary = load_hic_binary('lala-hic.bin')
+        self.assertEqual(binary, hic_data.to_sparse())
+        self.assertEqual(binary.bias, hic_data.bias)
+        self.assertEqual(sorted(binary.bads), sorted(hic_data.bads))
+        binary = load_hic_binary('lala-hic.bin', focus=['c3', 'c1'])
+        self.assertEqual(binary.section_pos, {'c1': (0, 40), 'c3': (40, 70)})
+        self.assertEqual(binary.get_matrix(focus='c3', normalized=True),
+                         hic_data.get_matrix(focus='c3', normalized=True))
+        self.assertEqual(binary.get_matrix(focus=('c1', 'c3')),
+                         hic_data.get_matrix(focus=('c1', 'c3')))
+        # multi-resolution
+        write_hic_binary([hic_data, hic_data.rebin(60000)], 'lala-hic.bin')
+        binary = load_hic_binary('lala-hic.bin', focus='c2', resolution=60000)
+        exp = Experiment('lala', 20000,
+                         hic_data=[hic_data.get_matrix(focus='c2')])
+        exp.set_resolution(60000)
+        self.assertEqual(dict(binary.iteritems()),
+                         dict(exp.hic_data[0].iteritems()))
+        binary = load_hic_binary('lala-hic.bin', focus='c2:200000-400000')
+        self.assertEqual(binary.get_matrix(),
+                         hic_data.get_matrix(focus=(51, 61)))
+        # resolutions that can not be derived from the finest one
+        self.assertRaisesRegexp(Exception, 'not a multiple of 20000',
+                                build_hic_pyramid, 'lala-reads.tsv',
+                                [20000, 50000], 'lala-hic.bin')
+        system('rm -f lala-hic.bin')
+        if CHKTIME:
+            self.assertEqual(True, True)
+            print '22', time() - t0
+
+    def test_23_hic_data_blocks(self):
+        """
+        matrices extracted by blocks from non-symmetric Hi-C data
+        """
+        if ONLY and ONLY != '23':
+            return
+        if CHKTIME:
+            t0 = time()
+        seed(1)
+        size = 30
+        hic_data = HiC_data([(i, int(random() * 10)) for i in xrange(size**2)
+                             if random() > 0.7], size, dict_sec={})
+        hic_data.bias = dict((i, 1 + random()) for i in xrange(size))
+        for focus in [None, (1, 30), (3, 20), (3, 20, 1, 30)]:
+            self.assertEqual(hic_data.get_array(focus=focus).tolist(),
+                             hic_data.get_matrix(focus=focus))
+            self.assertEqual(
+                hic_data.get_array(focus=focus, normalized=True).tolist(),
+                hic_data.get_matrix(focus=focus, normalized=True))
+        hic_data.write_matrix('lala-blocks.tsv')
+        # rows written as in yield_matrix
+        self.assertEqual([[int(v) for v in l.split()[2:]]
+                          for l in open('lala-blocks.tsv')
+                          if not l.startswith('#')],
+                         [[hic_data[i, j] for j in xrange(size)]
+                          for i in xrange(size)])
+        system('rm -f lala-blocks.tsv')
+        if CHKTIME:
+            self.assertEqual(True, True)
+            print '23', time() - t0
+
+    def test_24_iterative_sparse(self):
+        """
+        vectorized ICE normalization against the cell by cell one
+        """
+        if ONLY and ONLY != '24':
+            return
+        if CHKTIME:
+            t0 = time()
+        hic_data = read_matrix(PATH + '/20Kb/chrT/chrT_A.tsv', resolution=20000)
+        hic_data.filter_columns(silent=True)
+        for iterations in [0, 5, 100]:
+            bias1 = iterative(hic_data, bads=hic_data.bads,
+                              iterations=iterations, max_dev=0.001)
+            bias2 = iterative(MatrixDict(hic_data), bads=hic_data.bads,
+                              iterations=iterations, max_dev=0.001)
+            self.assertEqual(sorted(bias1), sorted(bias2))
+            for i in bias1:
+                self.assertAlmostEqual(bias1[i], bias2[i], places=6)
+        if CHKTIME:
+            self.assertEqual(True, True)
+            print '24', time() - t0
+
+    def test_25_expected(self):
+        """
+        expected counts per diagonal, and their cache
+        """
+        if ONLY and ONLY != '25':
+            return
+        if CHKTIME:
+            t0 = time()
+        hic_data = read_matrix(PATH + '/20Kb/chrT/chrT_A.tsv', resolution=20000)
+        hic_data.filter_columns(silent=True)
+        # values from the loop over diagonals
+        exp = hic_data.get_expected()
+        self.assertEqual(len(exp), 102)
+        self.assertEqual([round(exp[d], 3) for d in (0, 1, 5, 20, 50)],
+                         [378.232, 120.429, 45.809, 9.861, 2.582])
+        exp2 = hic_data.get_expected(signal_to_noise=0.1)
+        self.assertEqual([round(exp2[d], 3) for d in (0, 1, 5, 20, 50)],
+                         [378.232, 120.429, 45.809, 9.861, 2.429])
+        # inter-chromosomal cells are not counted
+        hic_data2 = HiC_data(hic_data.items(), len(hic_data), resolution=20000)
+        hic_data2.add_sections([59, 39], chr_names=['c1', 'c2'], binned=True)
+        hic_data2.bads = hic_data.bads
+        exp3 = hic_data2.get_expected()
+        self.assertEqual(len(exp3), 62)
+        self.assertEqual([round(exp3[d], 3) for d in (0, 1, 5, 20, 50)],
+                         [378.232, 120.186, 46.135, 9.763, 2.127])
+        # cached by parameters
+        self.assertTrue(hic_data.get_expected() is exp)
+        self.assertTrue(hic_data.get_expected(signal_to_noise=0.1) is exp2)
+        # and forgotten when the data changes
+        hic_data[10, 11] = hic_data[10, 11] + 1
+        self.assertFalse(hic_data.get_expected() is exp)
+        # normalized counts
+        hic_data.normalize_hic(silent=True)
+        exp = hic_data.get_expected(normalized=True)
+        size = len(hic_data)
+        norm = HiC_data([(p, v / hic_data.bias[p / size]
+                          / hic_data.bias[p % size])
+                         for p, v in hic_data.iteritems()], size,
+                        resolution=20000)
+        norm.bads = hic_data.bads
+        exp2 = norm.get_expected()
+        self.assertEqual(sorted(exp), sorted(exp2))
+        for d in exp:
+            self.assertAlmostEqual(exp[d], exp2[d], places=6)
+        # and forgotten when the biases change
+        hic_data.bias = dict((i, b * 2) for i, b in hic_data.bias.iteritems())
+        exp2 = hic_data.get_expected(normalized=True)
+        self.assertNotEqual(exp, exp2)
+        self.assertEqual(exp2, expected(hic_data, bads=hic_data.bads,
+                                        normalized=True))
+        if CHKTIME:
+            self.assertEqual(True, True)
+            print '25', time() - t0
+
+    def test_26_hmm(self):
+        """
+        vectorized HMM against loops over states and observations
+        """
+        if ONLY and ONLY != '26':
+            return
+        if CHKTIME:
+            t0 = time()
+        from math import log as mlog, exp as mexp, pi as mpi
+        seed(1)
+        n = 3
+        pi = [random() + 0.1 for _ in xrange(n)]
+        pi = [p / sum(pi) for p in pi]
+        T = []
+        for _ in xrange(n):
+            row = [random() + 0.1 for _ in xrange(n)]
+            T.append([t / sum(row) for t in row])
+        E = [[-1., 0.5], [0., 0.2], [1.5, 1.]]
+        observations = [[E[int(random() * n)][0] + random() - 0.5
+                         for _ in xrange(m)] for m in (80, 50)]
+        probs = [[[(2 * mpi * E[i][1])**-0.5 *
+                   mexp(-(x - E[i][0])**2 / (2 * E[i][1])) for x in obs]
+                  for i in xrange(n)] for obs in observations]
+        for obs, prob in zip(observations, probs):
+            self.assertTrue(np.allclose(hmm.gaussian_prob(obs, E), prob))
+        # Viterbi
+        for prob in probs:
+            m = len(prob[0])
+            log_V = [mlog(pi[i]) + mlog(prob[i][0]) for i in xrange(n)]
+            backpt = []
+            for k in xrange(1, m):
+                prevs = [max(xrange(n), key=lambda p: log_V[p] + mlog(T[p][s]))
+                         for s in xrange(n)]
+                backpt.append(prevs)
+                log_V = [log_V[prevs[s]] + mlog(T[prevs[s]][s]) +
+                         mlog(prob[s][k]) for s in xrange(n)]
+            states = [max(xrange(n), key=lambda s: log_V[s])]
+            for prevs in reversed(backpt):
+                states.insert(0, prevs[states[0]])
+            path, lik = hmm.best_path(prob, pi, T)
+            self.assertEqual(path, states)
+            self.assertAlmostEqual(lik, max(log_V), places=6)
+        # one round of Baum-Welch
+        new_pi = [0.] * n
+        new_T = [[0.] * n for _ in xrange(n)]
+        new_E = [[0., 0.] for _ in xrange(n)]
+        corrector = [0.] * n
+        for obs, prob in zip(observations, probs):
+            m = len(obs)
+            alphas = []
+            scalars = []
+            alpha = [pi[i] * prob[i][0] for i in xrange(n)]
+            for k in xrange(m):
+                if k:
+                    alpha = [sum(alphas[-1][i] * T[i][j] for i in xrange(n)) *
+                             prob[j][k] for j in xrange(n)]
+                scalars.append(sum(alpha))
+                alphas.append([a / scalars[-1] for a in alpha])
+            betas = [[1.] * n]
+            for k in xrange(m - 2, -1, -1):
+                betas.insert(0, [sum(T[i][j] * prob[j][k + 1] * betas[0][j]
+                                     for j in xrange(n)) / scalars[k + 1]
+                                 for i in xrange(n)])
+            for k in xrange(m):
+                for i in xrange(n):
+                    gamma = alphas[k][i] * betas[k][i]
+                    corrector[i] += gamma
+                    new_E[i][0] += gamma * obs[k]
+                    new_E[i][1] += gamma * (obs[k] - E[i][0])**2
+            for k in xrange(m - 1):
+                eta = [[alphas[k][i] * T[i][j] * prob[j][k + 1] *
+                        betas[k + 1][j] for j in xrange(n)] for i in xrange(n)]
+                tot = sum(sum(e) for e in eta)
+                for i in xrange(n):
+                    for j in xrange(n):
+                        if not k:
+                            new_pi[i] += eta[i][j] / tot
+                        new_T[i][j] += eta[i][j] / tot
+        new_pi = [p / sum(new_pi) for p in new_pi]
+        new_T = [[t / sum(row) for t in row] for row in new_T]
+        new_E = [[e / corrector[i] for e in new_E[i]] for i in xrange(n)]
+        hmm.train(pi, T, E, observations, n_iter=1)
+        self.assertTrue(np.allclose(pi, new_pi))
+        self.assertTrue(np.allclose(T, new_T))
+        self.assertTrue(np.allclose(E, new_E))
+        if CHKTIME:
+            self.assertEqual(True, True)
+            print '26', time() - t0
+
+    def test_27_set_resolution(self):
+        """
+        re-binning of an Experiment against the sum of cells one by one
+        """
+        if ONLY and ONLY != '27':
+            return
+        if CHKTIME:
+            t0 = time()
+        exp = Experiment('lala', 20000,
+                         hic_data=PATH + '/20Kb/chrT/chrT_A.tsv')
+        exp.normalize_hic(silent=True)
+        hic_data = exp.hic_data[0]
+        norm = exp.norm[0]
+        size = exp.size
+        def coarsen(mtrx, fact):
+            new_size = (size - 1) / fact + 1
+            new = {}
+            for i in xrange(size):
+                for j in xrange(size):
+                    pos = i / fact * new_size + j / fact
+                    new[pos] = new.get(pos, 0) + mtrx[i * size + j]
+            return dict((k, v) for k, v in new.iteritems() if v)
+        for sparse in [False, True]:
+            if sparse:
+                exp.hic_data = [hic_data.to_sparse()]
+                exp._resolutions = {}
+            for fact in [3, 7, 3]:
+                exp.set_resolution(20000 * fact, keep_original=True)
+                self.assertEqual(exp.size, (size - 1) / fact + 1)
+                self.assertEqual(dict(exp.hic_data[0].iteritems()),
+                                 coarsen(hic_data, fact))
+                new = coarsen(norm, fact)
+                self.assertEqual(sorted(exp.norm[0].keys()), sorted(new))
+                for pos in new:
+                    self.assertAlmostEqual(exp.norm[0][pos], new[pos],
+                                           places=6)
+            exp.set_resolution(20000, keep_original=True)
+        self.assertEqual(dict(exp.hic_data[0].iteritems()),
+                         dict(hic_data.iteritems()))
+        if CHKTIME:
+            self.assertEqual(True, True)
+            print '27', time() - t0
+
+    def test_28_zscores(self):
+        """
+        Z-scores of the interactions against the pair by pair computation
+        """
+        if ONLY and ONLY != '28':
+            return
+        if CHKTIME:
+            t0 = time()
+        exp = Experiment('lala', 20000,
+                         hic_data=PATH + '/20Kb/chrT/chrT_A.tsv')
+        exp.filter_columns(silent=True)
+        exp.normalize_hic(silent=True)
+        size = exp.size
+        def pairs(start, end):
+            values = {}
+            for i in xrange(start, end):
+                if i in exp._zeros:
+                    continue
+                for j in xrange(i + 1, end):
+                    if j in exp._zeros or not exp.norm[0][i * size + j]:
+                        continue
+                    values[(i - start, j - start)] = exp.norm[0][i * size + j]
+            return values
+        for start, end in [(0, size), (10, 60)]:
+            values = pairs(start, end)
+            zscores = values.copy()
+            zscore(zscores)
+            if (start, end) == (0, size):
+                exp.get_hic_zscores()
+                new, new_values = exp._zscores, None
+            else:
+                new, new_values, zeros = exp._sub_experiment_zscore(start + 1,
+                                                                    end)
+                self.assertEqual(sorted(zeros), sorted(z - start
+                                                       for z in exp._zeros
+                                                       if start <= z < end))
+            self.assertEqual(sorted((int(i), int(j)) for i in new
+                                    for j in new[i]), sorted(zscores))
+            for i, j in zscores:
+                self.assertAlmostEqual(new[str(i)][str(j)], zscores[(i, j)],
+                                       places=6)
+            if new_values is None:
+                continue
+            for i in xrange(end - start):
+                for j in xrange(end - start):
+                    val = values.get((min(i, j), max(i, j)), float('nan'))
+                    if isnan(val):
+                        self.assertTrue(isnan(new_values[i][j]))
+                    else:
+                        self.assertAlmostEqual(new_values[i][j], val, places=6)
+        if CHKTIME:
+            self.assertEqual(True, True)
+            print '28', time() - t0
+
+    def test_29_matrix_writers(self):
+        """
+        matrices and coordinate tables written by blocks against cell by cell
+        """
+        if ONLY and ONLY != '29':
+            return
+        if CHKTIME:
+            t0 = time()
+        seed(1)
+        hic_data = read_matrix(PATH + '/20Kb/chrT/chrT_A.tsv', resolution=20000)
+        hic_data.add_sections([39, 29, 29], chr_names=['c1', 'c2', 'c3'],
+                              binned=True)
+        size = len(hic_data)
+        hic_data.bias = dict((i, 0.5 + random()) for i in xrange(size))
+        names = sorted(hic_data.sections, key=lambda x: hic_data.sections[x])
+        names = ['%s:%d-%d' % (c, b * 20000, (b + 1) * 20000) for c, b in names]
+        def norm(i, j):
+            return hic_data[i, j] / hic_data.bias[i] / hic_data.bias[j]
+        # dense matrix, with row names
+        beg, end = hic_data.section_pos['c2']
+        hic_data.write_matrix('lala-matrix.tsv', focus='c2')
+        self.assertEqual(
+            [l for l in open('lala-matrix.tsv') if not l.startswith('#')],
+            ['%s\t%s\n' % (names[i].replace(':', '\t'),
+                           '\t'.join(str(hic_data[i, j])
+                                     for j in xrange(beg, end)))
+             for i in xrange(beg, end)])
+        hic_data.write_matrix('lala-matrix.tsv', normalized=True)
+        rows = [map(float, l.split()[2:]) for l in open('lala-matrix.tsv')
+                if not l.startswith('#')]
+        for i in xrange(size):
+            for j in xrange(size):
+                self.assertAlmostEqual(rows[i][j], norm(i, j), places=6)
+        # sparse and compressed
+        hic_data.write_matrix('lala-matrix.tsv.gz', sparse=True, compress=True)
+        self.assertEqual(
+            [map(int, l.split()) for l in gzip.open('lala-matrix.tsv.gz')
+             if not l.startswith('#')],
+            [[i, j, hic_data[i, j]] for i in xrange(size)
+             for j in xrange(i, size) if hic_data[i, j]])
+        # written in BGZF blocks, read back in parallel
+        fhandler = magic_open('lala-matrix.tsv.gz', cpus=2)
+        self.assertTrue(isinstance(fhandler, BgzfReader))
+        self.assertEqual(fhandler.read(),
+                         gzip.open('lala-matrix.tsv.gz').read())
+        fhandler.close()
+        # coordinate tables, diagonal excluded
+        hic_data.write_coord_table('lala-coords.tsv', format='long-range')
+        self.assertEqual(
+            open('lala-coords.tsv').readlines(),
+            ['%s\t%s\t%d\n' % (names[i], names[j], hic_data[i, j])
+             for i in xrange(size) for j in xrange(i + 1, size)
+             if hic_data[i, j]])
+        hic_data.write_coord_table('lala-coords.tsv', normalized=True)
+        cells = [(i, j) for i in xrange(size) for j in xrange(i + 1, size)
+                 if hic_data[i, j]]
+        lines = open('lala-coords.tsv').readlines()
+        self.assertEqual(len(lines), len(cells))
+        for num, ((i, j), line) in enumerate(zip(cells, lines), 1):
+            line = line.split('\t')
+            col, val = line[3].split(',')
+            self.assertEqual(line[:3], names[i].replace('-', ':').split(':'))
+            self.assertEqual(col, names[j])
+            self.assertAlmostEqual(float(val), norm(i, j), places=5)
+            self.assertEqual(line[4:], [str(num), '.\n'])
+        system('rm -f lala-matrix.tsv lala-matrix.tsv.gz lala-coords.tsv')
+        if CHKTIME:
+            self.assertEqual(True, True)
+            print '29', time() - t0
+
+    def test_30_bulk_reader(self):
+        """
+        matrices read in bulk against the autoreader
+        """
+        if ONLY and ONLY != '30':
+            return
+        if CHKTIME:
+            t0 = time()
+        hic_data = read_matrix(PATH + '/20Kb/chrT/chrT_A.tsv', resolution=20000)
+        hic_data.add_sections([39, 29, 29], chr_names=['c1', 'c2', 'c3'],
+                              binned=True)
+        hic_data.filter_columns(silent=True)
+        hic_data.normalize_hic(silent=True)
+        hic_data.write_matrix('lala-raw.tsv')
+        hic_data.write_matrix('lala-norm.tsv', normalized=True)
+        for fnam, hic in [(PATH + '/20Kb/chrT/chrT_A.tsv', True),
+                          ('lala-raw.tsv', True), ('lala-norm.tsv', False)]:
+            bulk = read_matrix(fnam, hic=hic)
+            auto = read_matrix(fnam, hic=hic, parser=autoreader)
+            self.assertEqual(dict(bulk), dict(auto))
+            self.assertEqual(bulk.sections, auto.sections)
+            self.assertEqual(bulk.chromosomes, auto.chromosomes)
+            self.assertEqual(bulk.bads, auto.bads)
+            self.assertEqual(bulk.resolution, auto.resolution)
+            sparse = read_matrix(fnam, hic=hic, sparse=True)
+            self.assertTrue(isinstance(sparse, SparseHiC_data))
+            self.assertEqual(sparse, auto.to_sparse())
+        # the type of values does not depend on the previous read
+        matrix = autoreader(open('lala-raw.tsv'))[0]
+        self.assertTrue(all(isinstance(v, int) for v in matrix))
+        # several files in parallel
+        self.assertEqual(
+            [dict(m) for m in read_matrix(['lala-raw.tsv', 'lala-norm.tsv'],
+                                          one=False, ncpus=2)],
+            [dict(m) for m in read_matrix(['lala-raw.tsv', 'lala-norm.tsv'],
+                                          one=False)])
+        system('rm -f lala-raw.tsv lala-norm.tsv')
+        if CHKTIME:
+            self.assertEqual(True, True)
+            print '30', time() - t0
+
+    def test_31_reads_binning(self):
+        """
+        matrices at several resolutions binned from reads, against the
+        matrices filled read by read
+        """
+        if ONLY and ONLY != '31':
+            return
+        if CHKTIME:
+            t0 = time()
+        seed(1)
+        crm_lengths = [('chr1', 250000), ('chr2', 120000), ('chr3', 90000)]
+        reads = write_random_reads('lala-reads.tsv', crm_lengths, 5000)
+        resolutions = [10000, 25000, 100000]
+        matrices = load_hic_data_from_reads('lala-reads.tsv', resolutions,
+                                            chunk=700)
+        sparses = load_hic_data_from_reads('lala-reads.tsv', resolutions,
+                                           chunk=700, sparse=True)
+        for reso, hic_data, sparse in zip(resolutions, matrices, sparses):
+            sections = [(crm, i) for crm, clen in crm_lengths
+                        for i in xrange(clen / reso + 1)]
+            dict_sec = dict((s, i) for i, s in enumerate(sections))
+            size = len(sections)
+            imx = {}
+            for cr1, ps1, cr2, ps2 in reads:
+                pos1 = dict_sec[(cr1, ps1 / reso)]
+                pos2 = dict_sec[(cr2, ps2 / reso)]
+                for pos in (pos1 * size + pos2, pos2 * size + pos1):
+                    imx[pos] = imx.get(pos, 0) + 1
+            self.assertEqual(len(hic_data), size)
+            self.assertEqual(hic_data.sections, dict_sec)
+            self.assertEqual(dict(hic_data), imx)
+            self.assertEqual(sparse, hic_data.to_sparse())
+            # same as reading this resolution alone
+            self.assertEqual(dict(load_hic_data_from_reads('lala-reads.tsv',
+                                                           reso)), imx)
+        # biases computed reading the interactions chunk by chunk, from the
+        # matrix or from the reads binned in a temporary file
+        hic_data.normalize_hic(silent=True, factor=None)
+        system('mkdir -p lala-tmp')
+        for kwargs in [{'memory': 1}, {'source': 'lala-reads.tsv'}]:
+            sparse.normalize_hic(silent=True, factor=None, tmp_dir='lala-tmp',
+                                 **kwargs)
+            self.assertEqual(sorted(sparse.bias), sorted(hic_data.bias))
+            for i in hic_data.bias:
+                self.assertAlmostEqual(sparse.bias[i], hic_data.bias[i])
+        self.assertRaises(OSError, sparse.normalize_hic, silent=True,
+                          source='lala-reads.tsv', tmp_dir='lala-no-dir')
+        self.assertEqual(listdir('lala-tmp'), [])
+        system('rm -rf lala-reads.tsv* lala-tmp')
+        if CHKTIME:
+            self.assertEqual(True, True)
+            print '31', time() - t0
+
+    def test_32_reads_cache(self):
+        """
+        binary columns of files with pairs of reads
+        """
+        if ONLY and ONLY != '32':
+            return
+        if CHKTIME:
+            t0 = time()
+        seed(1)
+        crm_lengths = [('chr1', 250000), ('chr2', 120000)]
+        reads = write_random_reads('lala-reads1.tsv', crm_lengths, 3000)
+        write_reads_cache('lala-reads1.tsv', chunk=700)
+        lengths, columns = load_reads_cache('lala-reads1.tsv')
+        self.assertEqual(lengths.items(), crm_lengths)
+        self.assertEqual(zip([lengths.keys()[c] for c in columns['crm1']],
+                             columns['pos1'].tolist(),
+                             [lengths.keys()[c] for c in columns['crm2']],
+                             columns['pos2'].tolist()), reads)
+        self.assertEqual(columns['end2'].tolist(),
+                         [r[3] + 10 for r in reads])
+        # matrices from the binary columns and from the text
+        cached = load_hic_data_from_reads('lala-reads1.tsv', 50000)
+        system('rm -rf lala-reads1.tsv_columns')
+        self.assertEqual(load_reads_cache('lala-reads1.tsv'), None)
+        self.assertEqual(dict(cached), dict(load_hic_data_from_reads(
+            'lala-reads1.tsv', 50000)))
+        # stale if the file changes, even within the same second
+        write_reads_cache('lala-reads1.tsv')
+        self.assertTrue(is_cache_fresh('lala-reads1.tsv'))
+        mtime = path.getmtime('lala-reads1.tsv')
+        utime('lala-reads1.tsv', (mtime, mtime + 0.25))
+        self.assertFalse(is_cache_fresh('lala-reads1.tsv'))
+        # merged files get their own binary columns
+        write_random_reads('lala-reads2.tsv', crm_lengths, 2000,
+                           prefix='other')
+        nreads = merge_2d_beds('lala-reads1.tsv', 'lala-reads2.tsv',
+                               'lala-merged.tsv')
+        self.assertEqual(nreads, 5000)
+        lengths, columns = load_reads_cache('lala-merged.tsv')
+        lines = [l.split('\t') for l in open('lala-merged.tsv')
+                 if not l.startswith('#')]
+        self.assertEqual(len(lines), 5000)
+        self.assertEqual(columns['pos1'].tolist(), [int(l[2]) for l in lines])
+        self.assertEqual(columns['beg2'].tolist(), [int(l[11]) for l in lines])
+        system('rm -rf lala-reads1.tsv* lala-reads2.tsv* lala-merged.tsv*')
+        if CHKTIME:
+            self.assertEqual(True, True)
+            print '32', time() - t0
+
+    def test_33_parse_map_parallel(self):
+        """
+        MAP files parsed in parallel, and sorted chunks merged at once
+        """
+        if ONLY and ONLY != '33':
+            return
+        if CHKTIME:
+            t0 = time()
+        seed(1)
+        genome, fnames = write_random_maps('lala-r')
+        result = parse_map(fnames[0], fnames[1], 'lala-r1.tsv', 'lala-r2.tsv',
+                           genome, re_name='DpnII')
+        self.assertEqual(parse_map(fnames[0], fnames[1], 'lala-p1.tsv',
+                                   'lala-p2.tsv', genome, re_name='DpnII',
+                                   ncpus=2), result)
+        frags = index_re_sites('DpnII', genome)
+        for end in (1, 2):
+            self.assertEqual(open('lala-p%d.tsv' % end).read(),
+                             open('lala-r%d.tsv' % end).read())
+            # small chunks, merged at once
+            tmp_files = []
+            windows = {}
+            for num, fnam in enumerate(fnames[end - 1], 1):
+                windows[num], files = _parse_map_file(
+                    fnam, frags, 'lala-s%d.tsv' % end, '%03d' % num,
+                    max_size=100)
+                tmp_files.extend(files)
+            self.assertEqual(len(tmp_files), 27)
+            self.assertEqual(windows, result[0][end - 1])
+            self.assertEqual(merge_parsed_reads(tmp_files, 'lala-s%d.tsv' % end,
+                                                genome, windows),
+                             result[1][end - 1])
+            self.assertEqual(open('lala-s%d.tsv' % end).read(),
+                             open('lala-r%d.tsv' % end).read())
+            # reads found in several files are joined, sorted by name
+            lines = [l for l in open('lala-r%d.tsv' % end)
+                     if not l.startswith('#')]
+            heads = [l.split('\t', 1)[0] for l in lines]
+            self.assertEqual(heads, sorted(set(heads)))
+            self.assertEqual(sum(l.count('|||') for l in lines),
+                             result[1][end - 1])
+        system('rm -f lala-r?.map.? lala-[rps]?.tsv')
+        if CHKTIME:
+            self.assertEqual(True, True)
+            print '33', time() - t0
+
+    def test_34_re_fragment_bounds(self):
+        """
+        RE fragments of batches of reads against the search read by read
+        """
+        if ONLY and ONLY != '34':
+            return
+        if CHKTIME:
+            t0 = time()
+        seed(1)
+        genome = OrderedDict((crm, ''.join('ACGT'[int(random() * 4)]
+                                           for _ in xrange(clen)))
+                             for crm, clen in [('chr1', 12345),
+                                               ('chr2', 5000)])
+        frag_chunk = 1000
+        frags = map_re_sites('DpnII', genome, frag_chunk=frag_chunk)
+        sites = index_re_sites('DpnII', genome)
+        for crm in genome:
+            clen = len(genome[crm])
+            self.assertEqual(sites[crm][0], 1)
+            self.assertEqual(sites[crm][-1], clen)
+            # random positions, RE sites and reads hanging off the end
+            poss = ([int(random() * clen) for _ in xrange(2000)] +
+                    sites[crm].tolist() + [0, clen - 1, clen, clen + 5])
+            lens = [10] * len(poss)
+            expected = []
+            for pos in poss:
+                frag_piece = frags[crm][pos / frag_chunk]
+                idx = bisect(frag_piece, pos)
+                while idx >= len(frag_piece):
+                    pos -= 1
+                    frag_piece = frags[crm][pos / frag_chunk]
+                    idx = bisect(frag_piece, pos)
+                expected.append((pos, frag_piece[idx - 1 if idx else 0],
+                                 frag_piece[idx]))
+            new = re_fragment_bounds(sites[crm], poss, lens)
+            self.assertEqual(zip(*[a.tolist() for a in new]), expected)
+            self.assertRaises(Exception, re_fragment_bounds, sites[crm],
+                              [clen + 20], [10])
+        if CHKTIME:
+            self.assertEqual(True, True)
+            print '34', time() - t0
+
+    def test_35_genome_cache(self):
+        """
+        genome and RE sites cached on disk
+        """
+        if ONLY and ONLY != '35':
+            return
+        if CHKTIME:
+            t0 = time()
+        seed(1)
+        out = open('lala-genome.fa', 'w')
+        for crm, clen in [('chr1', 12345), ('chr2', 5000)]:
+            seq = ''.join('ACGT'[int(random() * 4)] for _ in xrange(clen))
+            out.write('>%s\n%s\n' % (crm, '\n'.join(
+                seq[p:p + 60] for p in xrange(0, clen, 60))))
+        out.close()
+        genome_seq = parse_fasta('lala-genome.fa', verbose=False)
+        # parent of the cache directory does not exist yet
+        cache_dir = path.join('lala-cache', 'missing', 'genomes')
+        genome = load_genome('lala-genome.fa', cache_dir=cache_dir,
+                             verbose=False)
+        self.assertEqual(genome.keys(), genome_seq.keys())
+        for crm in genome_seq:
+            self.assertEqual(genome.sequence(crm), genome_seq[crm])
+        sites = index_re_sites('DpnII', genome_seq)
+        for new in [genome.re_sites('DpnII'), genome.re_sites('DpnII')]:
+            self.assertEqual(sorted(new), sorted(sites))
+            for crm in sites:
+                self.assertEqual(new[crm].tolist(), sites[crm].tolist())
+        # next load uses the cache, without writing the genome again
+        seq_path = path.join(genome.dirname, 'sequence.bin')
+        utime(seq_path, (1, 1))
+        cached = load_genome('lala-genome.fa', cache_dir=cache_dir,
+                             verbose=False)
+        self.assertEqual(cached.dirname, genome.dirname)
+        self.assertEqual(path.getmtime(seq_path), 1)
+        self.assertEqual(cached.sequence('chr2'), genome_seq['chr2'])
+        # another chromosome filter is another genome
+        other = load_genome('lala-genome.fa', cache_dir=cache_dir,
+                            chr_filter=['chr2'], verbose=False)
+        self.assertNotEqual(other.dirname, genome.dirname)
+        self.assertEqual(other.keys(), ['chr2'])
+        system('rm -rf lala-genome.fa lala-cache')
+        if CHKTIME:
+            self.assertEqual(True, True)
+            print '35', time() - t0
+
+    def test_36_external_sort(self):
+        """
+        intersection of read ends sorted in memory, or by many runs merged
+        """
+        if ONLY and ONLY != '36':
+            return
+        if CHKTIME:
+            t0 = time()
+        seed(2)
+        genome, fnames = write_random_maps('lala-x')
+        parse_map(fnames[0], fnames[1], 'lala-x1.tsv', 'lala-x2.tsv',
+                  genome, re_name='DpnII')
+        # everything in one buffer, as sorted before in memory
+        result = get_intersection('lala-x1.tsv', 'lala-x2.tsv', 'lala-x.tsv')
+        # more than 256 runs, merged by groups
+        self.assertEqual(get_intersection('lala-x1.tsv', 'lala-x2.tsv',
+                                          'lala-y.tsv', buffer_size=3), result)
+        self.assertTrue(result[0] > 3 * 256)
+        self.assertTrue(sum(result[1].values()) > 0)
+        self.assertEqual(open('lala-y.tsv').read(), open('lala-x.tsv').read())
+        self.assertFalse(path.exists('lala-y.tsv_tmp_files'))
+        # sorted by position of read 1, then read 2 and RE fragment
+        starts = {'chr1': 0, 'chr2': len(genome['chr1'])}
+        keys = [(starts[l[1]] + int(l[2]), l[7], int(l[8]), int(l[5]))
+                for l in (l.split('\t') for l in open('lala-x.tsv')
+                          if not l.startswith('#'))]
+        self.assertEqual(keys, sorted(keys))
+        system('rm -rf lala-x?.map.? lala-x?.tsv* lala-[xy].tsv*')
+        if CHKTIME:
+            self.assertEqual(True, True)
+            print '36', time() - t0
+
+    def test_37_fused_filters(self):
+        """
+        all filters in one parallel pass against one filter at a time
+        """
+        if ONLY and ONLY != '37':
+            return
+        if CHKTIME:
+            t0 = time()
+        seed(3)
+        genome, fnames = write_random_maps('lala-f')
+        parse_map(fnames[0], fnames[1], 'lala-f1.tsv', 'lala-f2.tsv',
+                  genome, re_name='DpnII')
+        get_intersection('lala-f1.tsv', 'lala-f2.tsv', 'lala-f.tsv')
+        # compressed input, without .gz extension
+        system('gzip -c lala-f.tsv > lala-fz.tsv')
+        results = {}
+        for fnam, fast in [('lala-f.tsv', False), ('lala-f.tsv', True),
+                           ('lala-fz.tsv', True)]:
+            output = 'lala-out-%s-%d' % (fnam, fast)
+            masked = filter_reads(fnam, output=output, verbose=False,
+                                  fast=fast, ncpus=2,
+                                  savedata=output + '_stats.txt',
+                                  min_dist_to_re=100)
+            results[(fnam, fast)] = (
+                dict((k, masked[k]['reads']) for k in masked),
+                open(output + '_stats.txt').read(),
+                [open(masked[k]['fnam']).read() for k in sorted(masked)],
+                open(masked[1]['bitmask'], 'rb').read())
+        slow = results[('lala-f.tsv', False)]
+        self.assertTrue(slow[1].startswith('Mapped both\t%d\n' % len(
+            [l for l in open('lala-f.tsv') if not l.startswith('#')])))
+        self.assertTrue(sum(slow[0].values()) > 0)
+        self.assertEqual(results[('lala-f.tsv', True)], slow)
+        self.assertEqual(results[('lala-fz.tsv', True)], slow)
+        system('rm -rf lala-f?.map.? lala-f*.tsv* lala-out-*')
+        if CHKTIME:
+            self.assertEqual(True, True)
+            print '37', time() - t0
+
+    def test_38_apply_bitmask(self):
+        """
+        filtering reads with the bitmask against the files of read IDs
+        """
+        if ONLY and ONLY != '38':
+            return
+        if CHKTIME:
+            t0 = time()
+        seed(4)
+        genome, fnames = write_random_maps('lala-b')
+        parse_map(fnames[0], fnames[1], 'lala-b1.tsv', 'lala-b2.tsv',
+                  genome, re_name='DpnII')
+        get_intersection('lala-b1.tsv', 'lala-b2.tsv', 'lala-b.tsv')
+        masked = filter_reads('lala-b.tsv', output='lala-bf', verbose=False,
+                              min_dist_to_re=100, ncpus=2)
+        self.assertTrue(is_bitmask_fresh('lala-b.tsv', masked[1]['bitmask']))
+        no_mask = dict((k, dict((i, v) for i, v in masked[k].iteritems()
+                                if i != 'bitmask')) for k in masked)
+        for filters in [[1, 2, 3, 4, 9, 10], [9], None]:
+            for reverse in [False, True]:
+                with_mask = apply_filter('lala-b.tsv', 'lala-b-mask.tsv',
+                                         masked, filters=filters,
+                                         reverse=reverse, verbose=False)
+                with_ids = apply_filter('lala-b.tsv', 'lala-b-ids.tsv',
+                                        no_mask, filters=filters,
+                                        reverse=reverse, verbose=False)
+                self.assertEqual(with_mask, with_ids)
+                self.assertEqual(open('lala-b-mask.tsv').read(),
+                                 open('lala-b-ids.tsv').read())
+        # only reads caught by filter 4 (extra dangling-ends), except
+        # self-circles
+        apply_filter('lala-b.tsv', 'lala-b-mask.tsv', masked, filters=[1],
+                     include=[4], verbose=False)
+        extra = set(open(masked[4]['fnam']).read().split())
+        circ = set(open(masked[1]['fnam']).read().split())
+        self.assertTrue(extra - circ and circ)
+        self.assertEqual(
+            set(l.split('\t', 1)[0] for l in open('lala-b-mask.tsv')
+                if not l.startswith('#')), extra - circ)
+        # once the input changes, the bitmask is not used anymore
+        lines = open('lala-b.tsv').readlines()
+        out = open('lala-b.tsv', 'w')
+        out.writelines(l for l in lines if l.split('\t', 1)[0] not in circ)
+        out.close()
+        self.assertFalse(is_bitmask_fresh('lala-b.tsv', masked[1]['bitmask']))
+        self.assertEqual(
+            apply_filter('lala-b.tsv', 'lala-b-mask.tsv', masked,
+                         filters=[4], verbose=False),
+            apply_filter('lala-b.tsv', 'lala-b-ids.tsv', no_mask,
+                         filters=[4], verbose=False))
+        self.assertEqual(open('lala-b-mask.tsv').read(),
+                         open('lala-b-ids.tsv').read())
+        self.assertRaises(Exception, apply_filter, 'lala-b.tsv',
+                          'lala-b-mask.tsv', masked, filters=[1],
+                          include=[4], verbose=False)
+        system('rm -rf lala-b?.map.? lala-b*.tsv* lala-bf*')
+        if CHKTIME:
+            self.assertEqual(True, True)
+            print '38', time() - t0
+
+    def test_39_ligation_sites(self):
+        """
+        splitting reads at the ligation sites of several enzymes in a single
+        search, against one search per site
+        """
+        if ONLY and ONLY != '39':
+            return
+        if CHKTIME:
+            t0 = time()
+        def split_per_site(seq, qal, r_enzs, min_seq_len):
+            ligs = dict((lig, (RESTRICTION_ENZYMES[e1].replace('|', ''),
+                               RESTRICTION_ENZYMES[e2].replace('|', '')))
+                        for (e1, e2), lig in religateds(r_enzs).iteritems())
+            halves = {}
+            for lig in ligs:
+                halves.setdefault(lig[:len(lig) / 2], []).append(len(lig))
+            if any(lig in seq for lig in ligs):
+                kind = dict((lig, (len(lig), ) + ligs[lig]) for lig in ligs)
+            else:
+                kind = dict((h, (min(halves[h]), '', '')) for h in halves)
+            frags = []
+            cnt = 0
+            while True:
+                cnt += 1
+                hits = [(seq.find(k), -len(k), k) for k in kind if k in seq]
+                if not hits:
+                    if not frags and cnt == 1:
+                        return None
+                    if len(seq) > min_seq_len:
+                        frags.append((seq, qal, cnt))
+                    return frags
+                pos, _, site = min(hits)
+                len_relg, site1, site2 = kind[site]
+                if pos >= min_seq_len:
+                    frags.append((seq[:pos] + site1,
+                                  qal[:pos] + 'H' * len(site1), cnt))
+                seq = site2 + seq[pos + len_relg:]
+                qal = 'H' * len(site2) + qal[pos + len_relg:]
+        seed(5)
+        for r_enzs in [['DpnII'], ['DpnII', 'HindIII'],
+                       ['HindIII', 'DpnII', 'NcoI']]:
+            first, patterns, sites = _ligation_patterns(r_enzs)
+            # the sites and their lengths do not depend on the enzyme order
+            self.assertEqual(sites, _ligation_patterns(r_enzs[::-1])[2])
+            splitter = (compile(first),
+                        dict((k, compile(v)) for k, v in patterns.iteritems()),
+                        sites)
+            pieces = religateds(r_enzs).values()
+            pieces += [lig[:len(lig) / 2] for lig in pieces]
+            for _ in xrange(2000):
+                seq = ''
+                while len(seq) < 100:
+                    if random() < 0.2:
+                        seq += pieces[int(random() * len(pieces))]
+                    else:
+                        seq += ''.join('ACGT'[int(random() * 4)]
+                                       for _ in xrange(int(random() * 20)))
+                qal = ''.join(chr(33 + int(random() * 40)) for _ in seq)
+                self.assertEqual(_split_read_re(seq, qal, splitter, 10),
+                                 split_per_site(seq, qal, r_enzs, 10))
+        if CHKTIME:
+            self.assertEqual(True, True)
+            print '39', time() - t0
+
+    def test_40_streaming_mapping(self):
+        """
+        transforming reads by blocks, and mapping them with all the steps
+        connected through pipes, against one step after the other
+        """
+        if ONLY and ONLY != '40':
+            return
+        if CHKTIME:
+            t0 = time()
+        seed(6)
+        lig = 'AAGCTAGCTT'
+        out = open('lala-reads.fastq', 'w')
+        for i in xrange(3000):
+            seq = ''.join('ACGT'[int(random() * 4)] for _ in xrange(100))
+            if random() < 0.4:
+                pos = int(random() * 90)
+                seq = seq[:pos] + lig + seq[pos + 10:]
+            qal = ''.join(chr(33 + int(random() * 40)) for _ in seq)
+            out.write('@read%d x\n%s\n+\n%s\n' % (i, seq, qal))
+        out.close()
+        # transformation of reads by blocks, in parallel
+        for trim, r_enz in [(None, None), ((5, 60), None), (None, 'HindIII')]:
+            results = []
+            for ncpus, block in [(1, 100000), (1, 7), (3, 7), (3, 1000)]:
+                transform_fastq('lala-reads.fastq', 'lala-reads.out',
+                                trim=trim, r_enz=r_enz, verbose=False,
+                                light_storage=True, ncpus=ncpus,
+                                reads_per_block=block)
+                results.append(open('lala-reads.out').read())
+            self.assertEqual(len(set(results)), 1)
+            if trim:
+                beg, end = trim
+                lines = open('lala-reads.fastq').readlines()
+                self.assertEqual(results[0], ''.join(
+                    '%s\n%s\n+\n%s\n' % (h.split()[0], s.strip()[beg - 1:end],
+                                          q.strip()[beg - 1:end])
+                    for h, s, q in zip(lines[0::4], lines[1::4], lines[3::4])))
+        # fake GEM mapper, mapping reads without ligation site (or short)
+        out = open('lala-gem-mapper', 'w')
+        out.write("""#!%s
+import sys
+args = sys.argv[1:]
+inp = open(args[args.index('-i') + 1]) if '-i' in args else sys.stdin
+out = (open(args[args.index('-o') + 1] + '.map', 'w') if '-o' in args
+       else sys.stdout)
+for header in inp:
+    seq = next(inp).strip()
+    next(inp)
+    qal = next(inp).strip()
+    uniq = sum(map(ord, seq)) %% 3
+    if len(seq) > 50:
+        uniq = uniq and 'AAGCT' not in seq[10:]
+    out.write('%%s\\t%%s\\t%%s\\t%%s\\t%%s\\n' %% (
+        header[1:].strip(), seq, qal, '1' if uniq else '0:0',
+        'chr1:+:100:%%d' %% len(seq) if uniq else '-'))
+out.close()
+""" % sys.executable)
+        out.close()
+        system('chmod +x lala-gem-mapper')
+        for windows in [None, ((1, 50), (1, 75), (1, 100))]:
+            results = []
+            for streaming in [False, True]:
+                outfiles = full_mapping(
+                    'lala-index', 'lala-reads.fastq', 'lala-mapped%d' % streaming,
+                    r_enz='HindIII', windows=windows, clean=True,
+                    get_nread=True, streaming=streaming,
+                    temp_dir='lala-tmp%d' % streaming, nthreads=2,
+                    gem_binary=path.abspath('lala-gem-mapper'))
+                results.append(
+                    [(path.basename(fnam), nreads, open(fnam).read())
+                     for fnam, nreads in outfiles])
+            self.assertEqual(results[0], results[1])
+            self.assertEqual(results[0][0][1], 3000)
+            self.assertTrue(all(text for _, _, text in results[0]))
+        system('rm -rf lala-reads.* lala-gem-mapper lala-mapped? lala-tmp?')
+        if CHKTIME:
+            self.assertEqual(True, True)
+            print '40', time() - t0
+
+    def test_41_merge_bgzf(self):
+        """
+        merging files of reads compressed in BGZF format, against the merge
+        of the uncompressed files
+        """
+        if ONLY and ONLY != '41':
+            return
+        if CHKTIME:
+            t0 = time()
+        seed(7)
+        crm_lengths = [('chr1', 1000000), ('chr2', 500000)]
+        # same read names in both files
+        write_random_reads('lala-m1.tsv', crm_lengths, 3000)
+        write_random_reads('lala-m2.tsv', crm_lengths, 2000)
+        for fnam in ['lala-m1.tsv', 'lala-m2.tsv']:
+            out = magic_write(fnam + '.gz')
+            out.write(open(fnam).read())
+            out.close()
+            # BGZF blocks are readable as any gzip file
+            self.assertEqual(open(fnam + '.gz', 'rb').read(16)[12:14], 'BC')
+            self.assertEqual(gzip.open(fnam + '.gz').read(),
+                             open(fnam).read())
+            self.assertEqual(magic_open(fnam + '.gz').read(),
+                             open(fnam).read())
+        header = [l for l in open('lala-m1.tsv') if l.startswith('#')]
+        reads = [l for f in ['lala-m2.tsv', 'lala-m1.tsv'] for l in open(f)
+                 if not l.startswith('#')]
+        expected = ''.join(header + sorted(
+            reads, key=lambda l: l.split('\t', 1)[0].split('~')[0]))
+        self.assertEqual(merge_2d_beds('lala-m1.tsv', 'lala-m2.tsv',
+                                       'lala-merged.tsv'), 5000)
+        self.assertEqual(open('lala-merged.tsv').read(), expected)
+        self.assertEqual(merge_2d_beds('lala-m1.tsv.gz', 'lala-m2.tsv.gz',
+                                       'lala-merged.tsv.gz'), 5000)
+        self.assertEqual(gzip.open('lala-merged.tsv.gz').read(), expected)
+        lengths, columns = load_reads_cache('lala-merged.tsv.gz')
+        self.assertEqual(lengths.keys(), ['chr1', 'chr2'])
+        self.assertEqual(columns['pos2'].tolist(),
+                         [int(l.split('\t')[8]) for l in expected.split('\n')
+                          if l and not l.startswith('#')])
+        system('rm -rf lala-m?.tsv* lala-merged.tsv*')
+        if CHKTIME:
+            self.assertEqual(True, True)
+            print '41', time() - t0
+
+    def test_42_read_ids(self):
+        """
+        reads parsed with integer IDs, against reads parsed with their names
+        """
+        if ONLY and ONLY != '42':
+            return
+        if CHKTIME:
+            t0 = time()
+        seed(8)
+        genome, fnames = write_random_maps('lala-i')
+        # some reads only mapped in one of the ends
+        lines = open(fnames[1][0]).readlines()
+        out = open(fnames[1][0], 'w')
+        out.writelines(lines[::2])
+        out.close()
+        names_out = parse_map(fnames[0], fnames[1], 'lala-n1.tsv',
+                              'lala-n2.tsv', genome, re_name='DpnII',
+                              verbose=False)
+        ids_out = parse_map(fnames[0], fnames[1], 'lala-i1.tsv',
+                            'lala-i2.tsv', genome, re_name='DpnII',
+                            verbose=False, read_ids=True)
+        self.assertEqual(names_out, ids_out)
+        names = open(read_names_path('lala-i1.tsv')).read().split()
+        self.assertEqual(names, sorted(set(names)))
+        def decode(fnam, names_fnam='lala-i1.tsv'):
+            """
+            header and reads of a file, with IDs replaced by read names
+            """
+            names = open(read_names_path(names_fnam)).read().split()
+            header = []
+            reads = []
+            for line in open(fnam):
+                if line.startswith('# READ IDS'):
+                    self.assertEqual(line, '# READ IDS\t%s\n' %
+                                     read_names_path(names_fnam))
+                elif line.startswith('#'):
+                    header.append(line)
+                else:
+                    reads.append(sub(r'(^|\|\|\|)(\d+)',
+                                     lambda m: m.group(1) + names[
+                                         int(m.group(2))], line))
+            return header, reads
+        # same IDs in both ends
+        ids = [set(l.split('\t', 1)[0] for l in open(f) if l[0] != '#')
+               for f in ['lala-i1.tsv', 'lala-i2.tsv']]
+        self.assertTrue(ids[0] - ids[1])
+        self.assertEqual(
+            set(names[int(i)] for i in ids[0] | ids[1]), set(names))
+        for end in (1, 2):
+            self.assertEqual(decode('lala-i%d.tsv' % end),
+                             ([l for l in open('lala-n%d.tsv' % end)
+                               if l.startswith('#')],
+                              [l for l in open('lala-n%d.tsv' % end)
+                               if not l.startswith('#')]))
+        # intersection
+        self.assertEqual(
+            get_intersection('lala-n1.tsv', 'lala-n2.tsv', 'lala-n.tsv'),
+            get_intersection('lala-i1.tsv', 'lala-i2.tsv', 'lala-i.tsv'))
+        header, reads = decode('lala-i.tsv')
+        self.assertEqual(header + sorted(reads),
+                         [l for l in open('lala-n.tsv') if l.startswith('#')] +
+                         sorted(l for l in open('lala-n.tsv')
+                                if not l.startswith('#')))
+        # files parsed with different read IDs, or without, are not
+        # intersected
+        parse_map(fnames[0][:2], fnames[1][:2], 'lala-j1.tsv', 'lala-j2.tsv',
+                  genome, re_name='DpnII', verbose=False, read_ids=True)
+        self.assertRaises(Exception, get_intersection, 'lala-i1.tsv',
+                          'lala-j2.tsv', 'lala-x.tsv')
+        self.assertRaises(Exception, get_intersection, 'lala-i1.tsv',
+                          'lala-n2.tsv', 'lala-x.tsv')
+        # merged files with read IDs get a new table of read names, the IDs
+        # of the second file following the ones of the first
+        parse_map(fnames[0][:2], fnames[1][:2], 'lala-k1.tsv', 'lala-k2.tsv',
+                  genome, re_name='DpnII', verbose=False)
+        get_intersection('lala-j1.tsv', 'lala-j2.tsv', 'lala-j.tsv')
+        get_intersection('lala-k1.tsv', 'lala-k2.tsv', 'lala-k.tsv')
+        self.assertEqual(
+            merge_2d_beds('lala-n.tsv', 'lala-k.tsv', 'lala-nk.tsv'),
+            merge_2d_beds('lala-i.tsv', 'lala-j.tsv', 'lala-ij.tsv'))
+        self.assertEqual(
+            open(read_names_path('lala-ij.tsv')).read(),
+            open(read_names_path('lala-i1.tsv')).read() +
+            open(read_names_path('lala-j1.tsv')).read())
+        header, reads = decode('lala-ij.tsv', 'lala-ij.tsv')
+        self.assertEqual(header + sorted(reads),
+                         [l for l in open('lala-nk.tsv')
+                          if l.startswith('#')] +
+                         sorted(l for l in open('lala-nk.tsv')
+                                if not l.startswith('#')))
+        # reads sorted by ID are merged by ID, not as strings
+        read_id = lambda l: int(l.split('\t', 1)[0].split('#')[0])
+        for fnam in ['lala-i.tsv', 'lala-j.tsv']:
+            lines = open(fnam).readlines()
+            out = open(fnam, 'w')
+            out.writelines([l for l in lines if l.startswith('#')] + sorted(
+                [l for l in lines if not l.startswith('#')], key=read_id))
+            out.close()
+        merge_2d_beds('lala-i.tsv', 'lala-j.tsv', 'lala-ij.tsv')
+        ids = [read_id(l) for l in open('lala-ij.tsv') if not l.startswith('#')]
+        self.assertTrue(ids[-1] >= 10)
+        self.assertEqual(ids, sorted(ids))
+        self.assertRaises(Exception, merge_2d_beds, 'lala-i.tsv', 'lala-k.tsv',
+                          'lala-x.tsv')
+        system('rm -rf lala-i?.map.? lala-[nijkx]*.tsv*')
+        if CHKTIME:
+            self.assertEqual(True, True)
+            print '42', time() - t0
+
 
 def generate_random_ali(ali='map'):
     # VARIABLES